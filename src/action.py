@@ -14,6 +14,7 @@
 
 """Carry out voice commands by recognising keywords."""
 
+import ctypes
 import datetime
 import logging
 import subprocess
@@ -25,7 +26,7 @@ import json
 import pprint
 import re
 import RPi.GPIO as GPIO
-import time
+import threading
 import urllib
 import vlc
 import youtube_dl
@@ -164,7 +165,11 @@ class SpeakShellCommandOutput(object):
 
 class VolumeControl(object):
 
-    """Changes the volume and says the new level."""
+    """Changes the volume and says the new level.
+
+    The volume is changed as soon as an interim transcript is stable, and
+    changed back if the final transcript is different.
+    """
     
     GET_VOLUME = r'amixer get Master | grep "Front Left:" | sed "s/.*\[\([0-9]\+\)%\].*/\1/"'
     SET_VOLUME = 'amixer -q set Master %d%%'
@@ -178,10 +183,36 @@ class VolumeControl(object):
         self.say = say
         self.keyword = keyword
         self.value = None
+        # The prepared command, and the volume before it.
+        self._prepared = None
 
     def run(self, voice_command):
+        prepared, self._prepared = self._prepared, None
+        if prepared and prepared[0] == voice_command:
+            self.tell()
+            return
+
+        if not self.change(voice_command):
+            self.say('Please specify a value.')
+            return
+        
+        self.tell()
+
+    def prepare(self, voice_command):
+        if self._mode(voice_command):
+            previous = self.get()
+            if self.change(voice_command):
+                self._prepared = (voice_command, previous)
+
+    def rollback(self, voice_command):
+        prepared, self._prepared = self._prepared, None
+        if prepared and prepared[0] == voice_command:
+            self.set(prepared[1])
+
+    def change(self, voice_command):
+        """Change the volume. Returns False if the command has no value."""
     
-        mode = voice_command.lower().replace(self.keyword, '', 1).strip()
+        mode = self._mode(voice_command)
       
         if mode == VolumeControl.UP:
             self.increment(10)
@@ -197,15 +228,17 @@ class VolumeControl(object):
                 vol = int(match.group())
                 self.set(vol)
             else:
-                self.say('Please specify a value.')
-                return
-        
-        self.tell()
+                return False
+        return True
             
+    def _mode(self, voice_command):
+        return voice_command.lower().replace(self.keyword, '', 1).strip()
+
+    def get(self):
+        return int(subprocess.check_output(VolumeControl.GET_VOLUME, shell=True).strip())
+
     def increment(self, value):
-        res = subprocess.check_output(VolumeControl.GET_VOLUME, shell=True).strip()
-        vol = int(res) + value
-        self.set(vol)
+        self.set(self.get() + value)
     
     def set(self, value):
         vol = max(0, min(100, value))
@@ -218,8 +251,7 @@ class VolumeControl(object):
         
     def tell(self):
         if not self.value:
-            res = subprocess.check_output(VolumeControl.GET_VOLUME, shell=True).strip()
-            self.value = int(res)
+            self.value = self.get()
         self.say(_('Volume at %d %%.') % self.value)
 
 
@@ -292,6 +324,9 @@ class PowerCommand(object):
 
     SHUTDOWN = 0
     RESTART = 1
+
+    # Only for the exact keywords, as this can't be undone.
+    fuzzy_match = False
     
     def __init__(self, say, command):
         self.say = say
@@ -312,17 +347,62 @@ class PowerCommand(object):
 # Makers! Implement your own actions here.
 # =========================================
 
+class VlcMixerOutput(object):
+
+    """Sends the audio of a VLC media player to an audio.Player, where it is
+    mixed with the other sounds and ducked while listening, instead of opening
+    the sound card itself.
+
+    VLC decodes to the Player's output format, so the music isn't converted
+    again.
+    """
+
+    def __init__(self, media_player, player):
+        self._player = player
+        self._stream = None
+
+        output_format = player.get_format()
+        self._sample_rate_hz = output_format.sample_rate_hz
+        # VLC only mixes down to mono or stereo.
+        self._channels = min(output_format.channels, 2)
+
+        # Keep references to the callbacks, as VLC doesn't.
+        self._play_cb = vlc.CallbackDecorators.AudioPlayCb(self._on_play)
+        self._flush_cb = vlc.CallbackDecorators.AudioFlushCb(self._on_flush)
+        media_player.audio_set_callbacks(self._play_cb, None, None, self._flush_cb, None, None)
+        media_player.audio_set_format('S16N', self._sample_rate_hz, self._channels)
+
+    def stop(self):
+        stream, self._stream = self._stream, None
+        if stream:
+            stream.cancel()
+
+    def _on_play(self, _opaque, samples, count, _pts):
+        if not self._stream:
+            self._stream = self._player.add_source(
+                self._sample_rate_hz, sample_width=2, channels=self._channels)
+        self._stream.write(ctypes.string_at(samples, count * self._channels * 2))
+
+    def _on_flush(self, _opaque, _pts):
+        self.stop()
+
+
 class YouTubePlayer(object):
 
-    """Plays song from YouTube."""
+    """Plays song from YouTube.
+
+    run() returns when the song ends, or when stop() is called from another
+    thread, such as an actionbase.ActionExecutor cancelling it.
+    """
     
-    def __init__(self, say, keyword):
+    def __init__(self, say, keyword, player=None):
         self.say = say
         self.keyword = keyword
-        self._init_player()
+        self._init_player(player)
         self._init_gpio(23)
         
     def run(self, voice_command):
+        done = self.done = threading.Event()
     
         track = voice_command.lower().replace(self.keyword, '', 1).strip()
         
@@ -354,6 +434,10 @@ class YouTubePlayer(object):
             self.say('Failed to find ' + track)
             return
    
+        if done.is_set():
+            # Stopped while searching.
+            return
+
         url = track_info['url']
         logging.debug(url)
         media = self.instance.media_new(url)
@@ -367,9 +451,14 @@ class YouTubePlayer(object):
         
         self.player.play()
 
-        self.done = False
-        while not self.done:
-            time.sleep(1)
+        done.wait()
+        if self.done is done and self.mixer_output:
+            self.mixer_output.stop()
+
+    def stop(self):
+        """Stop playing, and return from run()."""
+        self.player.stop()
+        self.done.set()
             
     def _init_gpio(self, channel, polarity=GPIO.FALLING, pull_up_down=GPIO.PUD_UP):
         self.input_value = polarity == GPIO.RISING
@@ -381,42 +470,47 @@ class YouTubePlayer(object):
             logging.info('Event already added')
             GPIO.add_event_callback(channel, self._on_input_event)
             
-    def _init_player(self):
+    def _init_player(self, player):
         self.now_playing = None
-        self.done = False
+        self.done = threading.Event()
         self.instance = vlc.get_default_instance()
         self.player = self.instance.media_player_new()
+        self.mixer_output = player and VlcMixerOutput(self.player, player)
         events = self.player.event_manager()
         events.event_attach(vlc.EventType.MediaPlayerEndReached, self._on_player_event)
         events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._on_player_event)
     
     def _on_input_event(self, channel):
         if GPIO.input(channel) == self.input_value:
-            self.player.stop()
-            self.done = True
+            self.stop()
 
     def _on_player_event(self, event):
         if event.type == vlc.EventType.MediaPlayerEndReached:
-            self.done = True
+            self.done.set()
         elif event.type == vlc.EventType.MediaPlayerEncounteredError:
             self.say("Can't play " + self.now_playing)
-            self.done = True
+            self.done.set()
         
 
 class TuneInRadio(object):
 
-    """Plays a radio stream from TuneIn radio"""
+    """Plays a radio stream from TuneIn radio.
+
+    run() returns when the stream ends, or when stop() is called from another
+    thread, such as an actionbase.ActionExecutor cancelling it.
+    """
     
     BASE_URL = 'http://tunein.com/'
     FILTER_STATIONS = 'Stations'
     
-    def __init__(self, say, keyword):
+    def __init__(self, say, keyword, player=None):
         self.say = say
         self.keyword = keyword
-        self._init_player()
+        self._init_player(player)
         self._init_gpio(23)
         
     def run(self, voice_command):
+        done = self.done = threading.Event()
         
         search_str = voice_command.lower().replace(self.keyword, '', 1).strip()
      
@@ -434,6 +528,10 @@ class TuneInRadio(object):
         if not url:
             self.say("Didn't find any streams")
             return
+
+        if done.is_set():
+            # Stopped while searching.
+            return
         
         logging.debug(url)
         media = self.instance.media_new(url)
@@ -445,9 +543,14 @@ class TuneInRadio(object):
         
         self.player.play()
 
-        self.done = False
-        while not self.done:
-            time.sleep(1)
+        done.wait()
+        if self.done is done and self.mixer_output:
+            self.mixer_output.stop()
+
+    def stop(self):
+        """Stop playing, and return from run()."""
+        self.player.stop()
+        self.done.set()
             
     def _init_gpio(self, channel, polarity=GPIO.FALLING, pull_up_down=GPIO.PUD_UP):
         self.input_value = polarity == GPIO.RISING
@@ -459,26 +562,26 @@ class TuneInRadio(object):
             logging.info('Event already added')
             GPIO.add_event_callback(channel, self._on_input_event)
     
-    def _init_player(self):
+    def _init_player(self, player):
         self.now_playing = None
-        self.done = False
+        self.done = threading.Event()
         self.instance = vlc.get_default_instance()
         self.player = self.instance.media_player_new()
+        self.mixer_output = player and VlcMixerOutput(self.player, player)
         events = self.player.event_manager()
         events.event_attach(vlc.EventType.MediaPlayerEndReached, self._on_player_event)
         events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self._on_player_event)
     
     def _on_input_event(self, channel):
         if GPIO.input(channel) == self.input_value:
-            self.player.stop()
-            self.done = True
+            self.stop()
             
     def _on_player_event(self, event):
         if event.type == vlc.EventType.MediaPlayerEndReached:
-            self.done = True
+            self.done.set()
         elif event.type == vlc.EventType.MediaPlayerEncounteredError:
             self.say("Can't play " + self.now_playing)
-            self.done = True
+            self.done.set()
 
     def _search(self, search_str, search_filter=FILTER_STATIONS):
     
@@ -544,8 +647,11 @@ class TuneInRadio(object):
         return result['Streams']
         
 
-def make_actor(say):
-    """Create an actor to carry out the user's commands."""
+def make_actor(say, player=None):
+    """Create an actor to carry out the user's commands.
+
+    If an audio.Player is given, media is played through it.
+    """
 
     actor = actionbase.Actor()
 
@@ -568,8 +674,8 @@ def make_actor(say):
     actor.add_keyword(_('restart'), PowerCommand(say, PowerCommand.RESTART))
     
     actor.add_keyword(_('volume'), VolumeControl(say, _('volume')))
-    actor.add_keyword(_('play'), YouTubePlayer(say,_('play')))
-    actor.add_keyword(_('radio'), TuneInRadio(say,_('radio')))
+    actor.add_keyword(_('play'), YouTubePlayer(say,_('play'), player))
+    actor.add_keyword(_('radio'), TuneInRadio(say,_('radio'), player))
 
     return actor
 
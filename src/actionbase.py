@@ -16,42 +16,562 @@
 
 This code lets you link keywords to actions. The actions are declared in
 action.py.
+
+Actions have a run(voice_command) method. They can also have
+prepare(voice_command), which is called when interim transcripts match
+before the final transcript arrives, and rollback(voice_command), which undoes
+prepare() if the final transcript turns out to be something else. Actions that
+can't be undone, like shutting down, can set fuzzy_match = False, so that they
+only run when their keyword is heard exactly.
 """
 
+import collections
+from concurrent import futures
+import logging
+import re
+import threading
+
+import tracing
+
+logger = logging.getLogger('actionbase')
+
+# The handler that handles a command. For a KeywordHandler, also the keyword,
+# and where it is in the lowercased command. The score is 1 for an exact
+# match, and the command is what the handler is given: for a fuzzy match, the
+# lowercased command with the keyword in place of what was heard.
+KeywordMatch = collections.namedtuple('KeywordMatch', [
+    'handler', 'keyword', 'start', 'end', 'score', 'command'])
+
+
+class KeywordMatcher(object):
+
+    """Finds all the keywords in a text in one pass, with an Aho-Corasick
+    automaton.
+
+    Keywords are numbered in the order they are added. Adding one extends the
+    trie, but the failure links aren't updated incrementally: they are all
+    recomputed, in time linear in the size of the trie, by the first search
+    after keywords were added. So add keywords in bulk before searching.
+
+    A KeywordMatcher isn't thread-safe, as a search may recompute the links.
+    """
+
+    def __init__(self):
+        self.keywords = []
+        # For each node of the trie: its children by character, the node for
+        # its longest proper suffix, the nearest such suffix node that ends a
+        # keyword, and the keywords that end at the node.
+        self._goto = [{}]
+        self._fail = [0]
+        self._link = [0]
+        self._out = [[]]
+        self._empty = []
+        self._compiled = True
+
+    def add(self, keyword):
+        """Add a keyword, and return its number."""
+        index = len(self.keywords)
+        self.keywords.append(keyword)
+        if not keyword:
+            self._empty.append(index)
+            return index
+
+        goto = self._goto
+        node = 0
+        for char in keyword:
+            child = goto[node].get(char)
+            if child is None:
+                child = goto[node][char] = len(goto)
+                goto.append({})
+                self._out.append([])
+            node = child
+        self._out[node].append(index)
+        self._compiled = False
+        return index
+
+    def find_all(self, text):
+        """Yields (start, end, index) for each occurrence of each keyword in
+        the text.
+        """
+        for index in self._empty:
+            yield 0, 0, index
+        if not self._compiled:
+            self._compile()
+
+        goto, fail, link, out, keywords = (
+            self._goto, self._fail, self._link, self._out, self.keywords)
+        node = 0
+        for end, char in enumerate(text, 1):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+
+            match = node if out[node] else link[node]
+            while match:
+                for index in out[match]:
+                    yield end - len(keywords[index]), end, index
+                match = link[match]
+
+    def find_first(self, text):
+        """Return (start, end, index) for the first-added keyword in the text,
+        at its first occurrence, or None.
+        """
+        best = None
+        for match in self.find_all(text):
+            if best is None or match[2] < best[2] or (
+                    match[2] == best[2] and match[0] < best[0]):
+                best = match
+                if best[2] == 0 and best[0] == 0:
+                    break
+        return best
+
+    def _compile(self):
+        """Compute the failure and output links, breadth first."""
+        goto, out = self._goto, self._out
+        fail = self._fail = [0] * len(goto)
+        link = self._link = [0] * len(goto)
+
+        queue = collections.deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                suffix = fail[node]
+                while suffix and char not in goto[suffix]:
+                    suffix = fail[suffix]
+                # The root's children have the root as their suffix.
+                suffix = goto[suffix].get(char, 0) if node else 0
+                fail[child] = suffix
+                link[child] = suffix if out[suffix] else link[suffix]
+                queue.append(child)
+        self._compiled = True
+
+
+def edit_distance(a, b, max_distance=None):
+    """Return the Levenshtein distance between two strings. If it's more
+    than max_distance, return max_distance + 1 instead.
+    """
+    if len(a) < len(b):
+        a, b = b, a
+    if max_distance is not None and len(a) - len(b) > max_distance:
+        return max_distance + 1
+
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1,
+                               previous[j - 1] + (char_a != char_b)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+_DIGIT_WORDS = ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine']
+
+# Spellings that sound alike, applied in order.
+_PHONETIC_RULES = [
+    ('tch', 'ch'), ('ght', 't'), ('ph', 'f'), ('ck', 'k'), ('wr', 'r'), ('kn', 'n'),
+    ('mb', 'm'), ('ce', 'se'), ('ci', 'si'), ('cy', 'sy'), ('c', 'k'), ('q', 'k'),
+    ('x', 'ks'), ('z', 's'), ('v', 'f'), ('d', 't'), ('b', 'p'),
+]
+
+
+def _respell(word):
+    """Return the word lowercased, with digits spelled out and the spellings in
+    _PHONETIC_RULES replaced.
+    """
+    word = word.lower()
+    if len(word) == 1 and word.isdigit():
+        word = _DIGIT_WORDS[int(word)]
+    for old, new in _PHONETIC_RULES:
+        word = word.replace(old, new)
+    return word
+
+
+def phonetic_key(word):
+    """Return a rough phonetic key for an English word, so that words that
+    sound alike, like 'four', 'for' and '4', or 'lights' and 'lites', have the
+    same key.
+    """
+    word = _respell(word)
+    if not word:
+        return word
+
+    # Keep the first sound, and then only the consonants.
+    key = ['a' if word[0] in 'aeiou' else word[0]]
+    for char in word[1:]:
+        if char not in 'aeiouyhw' and char != key[-1]:
+            key.append(char)
+    return ''.join(key)
+
+
+class FuzzyKeywordIndex(object):
+
+    """Finds keywords that were misheard, as a fallback for KeywordMatcher.
+
+    Commands and keywords are split into words. Each word of the command is
+    matched to keyword words that have the same phonetic_key() or, for words
+    of at least MIN_EDIT_LENGTH letters, that share enough letter bigrams.
+    Both kinds of candidate are compared after respelling, so 'lites' is one
+    edit from 'lights', and are kept if they are within one edit per
+    LETTERS_PER_EDIT letters (at least one), and the shorter word has at
+    least MIN_LENGTH_RATIO of the letters of the longer. The words are then
+    matched to keywords with a trie of keyword words, so a match has one
+    heard word for each word of the keyword.
+
+    A match scores 1 minus the total edit distance over the length of the
+    keyword or the words it matched, whichever is longer, without spaces.
+    """
+
+    MIN_EDIT_LENGTH = 4
+    LETTERS_PER_EDIT = 4
+    MIN_LENGTH_RATIO = 0.75
+
+    def __init__(self):
+        self.keywords = []
+        self._lengths = []
+
+        # Trie of keyword words: the children of each node by word, and the
+        # keywords that end at the node.
+        self._children = [{}]
+        self._out = [[]]
+
+        # The words of all keywords, by phonetic key and by bigram.
+        self._words = set()
+        self._respelled = {}
+        self._phonetic = collections.defaultdict(set)
+        self._bigrams = collections.defaultdict(list)
+
+    def add(self, keyword):
+        """Add a keyword, and return its number."""
+        index = len(self.keywords)
+        words = _WORD_RE.findall(keyword.lower())
+        self.keywords.append(keyword)
+        self._lengths.append(sum(len(word) for word in words))
+        if not words:
+            return index
+
+        node = 0
+        for word in words:
+            child = self._children[node].get(word)
+            if child is None:
+                child = self._children[node][word] = len(self._children)
+                self._children.append({})
+                self._out.append([])
+            node = child
+            self._add_word(word)
+        self._out[node].append(index)
+        return index
+
+    def find(self, text, min_score):
+        """Return (score, start, end, index) for the best match in the text
+        with at least min_score, or None. Of equal scores, the first-added
+        keyword wins.
+        """
+        tokens = list(_WORD_RE.finditer(text))
+        candidates = {}
+        for token in tokens:
+            word = token.group()
+            if word not in candidates:
+                candidates[word] = self._candidates(word)
+
+        best = None
+        for first in range(len(tokens)):
+            states = [(0, 0)]
+            length = 0
+            for token in tokens[first:]:
+                length += len(token.group())
+                states = [(child, cost + word_cost)
+                          for node, cost in states
+                          for word, word_cost in candidates[token.group()]
+                          for child in (self._children[node].get(word),) if child]
+                if not states:
+                    break
+
+                for node, cost in states:
+                    for index in self._out[node]:
+                        score = 1 - cost / max(self._lengths[index], length)
+                        if score >= min_score and (
+                                best is None or (-score, index) < (-best[0], best[3])):
+                            best = (score, tokens[first].start(), token.end(), index)
+        return best
+
+    def _add_word(self, word):
+        if word in self._words:
+            return
+        self._words.add(word)
+        self._respelled[word] = _respell(word)
+        self._phonetic[phonetic_key(word)].add(word)
+        for bigram in _bigrams(word):
+            self._bigrams[bigram].append(word)
+
+    def _candidates(self, word):
+        """Return [(keyword word, cost)] for the keyword words that the word
+        could be.
+        """
+        if word in self._words:
+            return [(word, 0)]
+
+        respelled = _respell(word)
+        max_distance = max(1, len(respelled) // self.LETTERS_PER_EDIT)
+        others = set(self._phonetic.get(phonetic_key(word), ()))
+        if len(word) >= self.MIN_EDIT_LENGTH:
+            bigrams = _bigrams(word)
+            shared = collections.Counter()
+            for bigram in bigrams:
+                shared.update(self._bigrams.get(bigram, ()))
+
+            # Each edit changes at most two bigrams.
+            others.update(other for other, count in shared.items()
+                          if len(other) >= self.MIN_EDIT_LENGTH and
+                          count >= len(bigrams) - 2 * max_distance)
+
+        costs = []
+        for other in others:
+            other_respelled = self._respelled[other]
+            lengths = sorted((len(respelled), len(other_respelled)))
+            if lengths[0] < self.MIN_LENGTH_RATIO * lengths[1]:
+                continue
+            distance = edit_distance(respelled, other_respelled, max_distance)
+            if distance <= max_distance:
+                costs.append((other, distance))
+        return costs
+
+
+_WORD_RE = re.compile(r"[\w']+")
+
+
+def _bigrams(word):
+    word = '^' + word + '$'
+    return {word[i:i + 2] for i in range(len(word) - 1)}
+
 
 class Actor(object):
 
-    """Passes commands on to a list of action handlers."""
+    """Passes commands on to a list of action handlers.
+
+    The keywords are compiled into a KeywordMatcher, so a command is matched
+    against all of them in one pass. Handlers appended to self.handlers are
+    indexed on the next match. With set_fuzzy_matching(), commands that no
+    handler matches are also looked up in a FuzzyKeywordIndex, except for the
+    keywords of actions with fuzzy_match = False. Callers that have a better
+    answer than a guess, like the Assistant's response, can pass fuzzy=False.
+
+    Interim transcripts can be passed to handle_interim() while the user is
+    still speaking. When the same command is in MATCHES_TO_PREPARE interim
+    results in a row, each with at least MIN_STABILITY, the action that
+    handles it is prepared. handle() then runs it for the final transcript,
+    or rolls it back if the final transcript is different.
+    """
+
+    MIN_STABILITY = 0.8
+    MATCHES_TO_PREPARE = 2
 
     def __init__(self):
         self.handlers = []
 
+        # KeywordHandlers are found with a compiled matcher. Other handlers
+        # are checked in turn.
+        self._matcher = KeywordMatcher()
+        self._keyword_handlers = []
+        self._other_handlers = []
+        self._indexed = 0
+        self._last_match = None
+        self._fuzzy = None
+        self._fuzzy_handlers = []
+        self._fuzzy_min_score = None
+        # Guards the index, which is used from the recognition thread, the
+        # event loop and the interim executor.
+        self._index_lock = threading.Lock()
+
+        self._interim_match = None
+        self._interim_matches = 0
+        self._prepared = None
+
     def add_keyword(self, keyword, action):
         self.handlers.append(KeywordHandler(keyword, action))
 
+    def set_fuzzy_matching(self, min_score=0.8):
+        """Match misheard keywords that score at least min_score (between 0
+        and 1), when no handler matches the command exactly. None turns fuzzy
+        matching off.
+        """
+        with self._index_lock:
+            self._fuzzy_min_score = min_score
+            self._last_match = None
+            if min_score is None:
+                self._fuzzy = None
+            elif not self._fuzzy:
+                self._update_index()
+                self._fuzzy = FuzzyKeywordIndex()
+                self._fuzzy_handlers = []
+                for _, handler in self._keyword_handlers:
+                    self._add_fuzzy(handler)
+
     def get_phrases(self):
         """Get a list of all phrases that are expected by the handlers."""
         return [phrase for h in self.handlers for phrase in h.get_phrases()]
 
-    def can_handle(self, command):
+    def can_handle(self, command, fuzzy=True):
         """Check if command is handled without running the handlers.
 
         Returns True if the command would be handled."""
 
-        for handler in self.handlers:
+        return self.match(command, fuzzy) is not None
+
+    def match(self, command, fuzzy=True):
+        """Return a KeywordMatch for the handler that would handle the command,
+        or None. The handler added first wins. If fuzzy is False, misheard
+        keywords aren't matched.
+        """
+        last = self._last_match
+        if last and last[:2] == (command, fuzzy) and self._indexed == len(self.handlers):
+            return last[2]
+
+        with self._index_lock:
+            return self._match_locked(command, fuzzy)
+
+    def _match_locked(self, command, fuzzy):
+        self._update_index()
+        text = command.lower()
+        first = self._matcher.find_first(text)
+        if first:
+            start, end, index = first
+            handler_index, handler = self._keyword_handlers[index]
+            match = KeywordMatch(handler, handler.keyword, start, end, 1.0, command)
+        else:
+            handler_index = len(self.handlers)
+            match = None
+
+        for i, handler in self._other_handlers:
+            if i > handler_index:
+                break
             if handler.can_handle(command):
-                return True
+                match = KeywordMatch(handler, None, None, None, 1.0, command)
+                break
+
+        if not match and fuzzy and self._fuzzy:
+            match = self._match_fuzzy(text)
+
+        self._last_match = (command, fuzzy, match)
+        return match
+
+    def _match_fuzzy(self, text):
+        found = self._fuzzy.find(text, self._fuzzy_min_score)
+        if not found:
+            return None
+
+        score, start, end, index = found
+        handler = self._fuzzy_handlers[index]
+        corrected = text[:start] + handler.keyword + text[end:]
+        logger.info('heard %r as %r (score %.2f)', text[start:end], handler.keyword, score)
+        return KeywordMatch(handler, handler.keyword, start, end, score, corrected)
+
+    def handle_interim(self, command, stability=1.0):
+        """Consider an interim transcript, and prepare the action that handles
+        it once it is stable. If a different command was prepared before, it
+        is rolled back.
+
+        Returns True if an action was prepared."""
+
+        match = None
+        if stability >= self.MIN_STABILITY:
+            keyword_match = self.match(command)
+            match = keyword_match and (keyword_match.handler, keyword_match.command)
+        if match != self._interim_match:
+            self._interim_match = match
+            self._interim_matches = 0
+        if not match:
+            return False
+
+        self._interim_matches += 1
+        if self._interim_matches != self.MATCHES_TO_PREPARE or match == self._prepared:
+            return False
+
+        self._rollback_prepared()
+        handler, command = match
+        # Handlers other than KeywordHandlers may not support preparing.
+        prepare = getattr(handler, 'prepare', None)
+        if prepare and prepare(command):
+            logger.info('prepared action for interim command: %s', command)
+            self._prepared = match
+            return True
         return False
 
-    def handle(self, command):
+    def rollback(self):
+        """Roll back the prepared action, if any, eg when the request fails
+        without a final transcript.
+        """
+        self._rollback_prepared()
+        self._interim_match = None
+        self._interim_matches = 0
+
+    def _rollback_prepared(self):
+        prepared, self._prepared = self._prepared, None
+        if prepared:
+            handler, command = prepared
+            logger.info('rolling back action for interim command: %s', command)
+            rollback = getattr(handler, 'rollback', None)
+            if rollback:
+                rollback(command)
+
+    def handle(self, command, fuzzy=True):
         """Pass command to handlers, stopping after one has handled the command.
+        An action prepared for a different interim command is rolled back.
 
         Returns True if the command was handled."""
 
-        for handler in self.handlers:
-            if handler.handle(command):
-                return True
-        return False
+        match = self._take_match(command, fuzzy)
+        return bool(match) and match.handler.handle(match.command)
+
+    def dispatch(self, command, executor, fuzzy=True):
+        """Like handle(), but runs the action on an ActionExecutor, and
+        returns straight away.
+
+        Returns an ActionHandle, or None if the command isn't handled."""
+
+        match = self._take_match(command, fuzzy)
+        return match and executor.submit(match.handler, match.command)
+
+    def _take_match(self, command, fuzzy):
+        """Match the final transcript, and roll back any action prepared for a
+        different interim command.
+        """
+        match = self.match(command, fuzzy)
+        if match and self._prepared == (match.handler, match.command):
+            self._prepared = None
+        self.rollback()
+        return match
+
+    def _update_index(self):
+        """Index the handlers that have been appended since the last call. If
+        some have been removed, index them all again.
+        """
+        if len(self.handlers) < self._indexed:
+            self._matcher = KeywordMatcher()
+            self._keyword_handlers = []
+            self._other_handlers = []
+            self._indexed = 0
+            if self._fuzzy:
+                self._fuzzy = FuzzyKeywordIndex()
+                self._fuzzy_handlers = []
+
+        for i in range(self._indexed, len(self.handlers)):
+            handler = self.handlers[i]
+            if isinstance(handler, KeywordHandler):
+                self._matcher.add(handler.keyword)
+                if self._fuzzy:
+                    self._add_fuzzy(handler)
+                self._keyword_handlers.append((i, handler))
+            else:
+                self._other_handlers.append((i, handler))
+        self._indexed = len(self.handlers)
+
+    def _add_fuzzy(self, handler):
+        if getattr(handler.action, 'fuzzy_match', True):
+            self._fuzzy.add(handler.keyword)
+            self._fuzzy_handlers.append(handler)
 
 
 class KeywordHandler(object):
@@ -73,3 +593,204 @@ class KeywordHandler(object):
             self.action.run(command)
             return True
         return False
+
+    def prepare(self, command):
+        """Prepare the action, if it supports that.
+
+        Returns True if it was prepared."""
+        prepare = getattr(self.action, 'prepare', None)
+        if not prepare:
+            return False
+        prepare(command)
+        return True
+
+    def rollback(self, command):
+        rollback = getattr(self.action, 'rollback', None)
+        if rollback:
+            rollback(command)
+
+
+class ActionHandle(object):
+
+    """A command running on an ActionExecutor. Use wait() to wait until its
+    action has finished, or cancel() to stop it.
+    """
+
+    def __init__(self, handler, command):
+        self.handler = handler
+        self.command = command
+
+        action = getattr(handler, 'action', handler)
+        self._stop = getattr(action, 'stop', None)
+        self._cancelled = False
+        self._future = None
+
+    def long_running(self):
+        """Returns True if the action can be stopped while it runs, like
+        playing media.
+        """
+        return self._stop is not None
+
+    def cancel(self):
+        """Remove the action from the queue, or ask it to stop if it's
+        running and can be stopped.
+        """
+        self._cancelled = True
+        future = self._future
+        if future and not future.cancel() and not future.done() and self._stop:
+            self._stop()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._future.done()
+
+    def wait(self, timeout=None):
+        """Wait until the action has finished or been cancelled. Returns False
+        on timeout.
+        """
+        done, _ = futures.wait([self._future], timeout)
+        return bool(done)
+
+
+class ActionExecutor(object):
+
+    """Runs actions on a pool of worker threads, so that recognition carries
+    on while they run.
+
+    Actions that have a stop() method are long-running, like playing music.
+    Only one of them runs at a time: starting another cancels the others.
+    """
+
+    def __init__(self, max_workers=4):
+        self._pool = futures.ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._running = set()
+
+    def submit(self, handler, command):
+        """Run handler.handle(command) on a worker. Returns an ActionHandle."""
+        handle = ActionHandle(handler, command)
+        if handle.long_running():
+            for other in self.get_running():
+                if other.long_running():
+                    logger.info('stopping %r for %r', other.command, command)
+                    other.cancel()
+
+        with self._lock:
+            self._running.add(handle)
+        # pylint: disable=protected-access
+        handle._future = self._pool.submit(self._run, handle)
+        handle._future.add_done_callback(lambda _: self._discard(handle))
+        return handle
+
+    def get_running(self):
+        """Return the handles of the actions that are queued or running."""
+        with self._lock:
+            return list(self._running)
+
+    def cancel_all(self):
+        for handle in self.get_running():
+            handle.cancel()
+
+    def shutdown(self, wait=True):
+        """Cancel the actions, and stop the workers."""
+        self.cancel_all()
+        self._pool.shutdown(wait)
+
+    def _discard(self, handle):
+        with self._lock:
+            self._running.discard(handle)
+
+    @staticmethod
+    def _run(handle):
+        if handle.cancelled():
+            return False
+        # Long-running actions last until they're stopped, so they're timed
+        # separately.
+        span = 'actor_handle_long' if handle.long_running() else 'actor_handle'
+        try:
+            with tracing.span(span):
+                return handle.handler.handle(handle.command)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('action for %r failed', handle.command)
+            return False
+
+
+def main():
+    import argparse
+    import random
+    import time
+
+    parser = argparse.ArgumentParser(
+        description='Compare the keyword matcher with checking each handler in turn')
+    parser.add_argument('-k', '--keywords', type=int, default=10000,
+                        help='Number of keywords (default: 10000)')
+    parser.add_argument('-n', '--commands', type=int, default=1000,
+                        help='Number of commands to match (default: 1000)')
+    args = parser.parse_args()
+
+    # Keywords like the ones generated for each room and device.
+    rng = random.Random(0)
+    verbs = ['turn on', 'turn off', 'dim', 'brighten', 'open', 'close', 'lock', 'unlock']
+    rooms = ['room %d' % i for i in range(args.keywords // 40 + 1)]
+    devices = ['light', 'lamp', 'fan', 'blinds', 'heater']
+    keywords = ['%s the %s %s' % (verb, room, device)
+                for room in rooms for device in devices for verb in verbs][:args.keywords]
+    rng.shuffle(keywords)
+
+    class NullAction(object):
+
+        def run(self, voice_command):
+            pass
+
+    actor = Actor()
+    start = time.perf_counter()
+    for keyword in keywords:
+        actor.add_keyword(keyword, NullAction())
+    actor.match('')
+    print('indexed %d keywords in %.1f ms' % (len(keywords), 1000 * (time.perf_counter() - start)))
+
+    commands = ['please %s now' % rng.choice(keywords) for _ in range(args.commands // 2)]
+    commands += ['what is the weather %d' % i for i in range(args.commands - len(commands))]
+
+    start = time.perf_counter()
+    for command in commands:
+        actor.match(command)
+    compiled_s = (time.perf_counter() - start) / len(commands)
+
+    start = time.perf_counter()
+    for command in commands:
+        for handler in actor.handlers:
+            if handler.can_handle(command):
+                break
+    linear_s = (time.perf_counter() - start) / len(commands)
+
+    print('compiled: %.1f us per command' % (1e6 * compiled_s))
+    print('linear scan: %.1f us per command' % (1e6 * linear_s))
+
+    start = time.perf_counter()
+    actor.set_fuzzy_matching()
+    print('fuzzy index: %.1f ms' % (1000 * (time.perf_counter() - start)))
+
+    # Misheard commands: change a letter of one of the longer words.
+    def mishear(keyword):
+        words = keyword.split()
+        long_words = [i for i, word in enumerate(words) if len(word) >= 4]
+        i = rng.choice(long_words)
+        j = rng.randrange(len(words[i]))
+        words[i] = words[i][:j] + rng.choice('aeiou') + words[i][j + 1:]
+        return ' '.join(words)
+
+    misheard = ['please %s now' % mishear(rng.choice(keywords)) for _ in range(args.commands)]
+    found = 0
+    start = time.perf_counter()
+    for command in misheard:
+        found += actor.match(command) is not None
+    fuzzy_s = (time.perf_counter() - start) / len(misheard)
+    print('fuzzy: %.1f us per misheard command, %d%% matched' % (
+        1e6 * fuzzy_s, 100 * found // len(misheard)))
+
+
+if __name__ == '__main__':
+    main()
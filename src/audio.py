@@ -16,12 +16,33 @@
 playback.
 """
 
+import collections
+import ctypes
+import ctypes.util
+import errno
+import functools
+import gc
+import glob
+import hashlib
+import heapq
+import itertools
 import logging
+import math
+import mmap
 import os
+import queue
+import struct
 import subprocess
+import tempfile
 import threading
+import time
+import tracemalloc
 import wave
 
+import numpy as np
+
+import tracing
+
 logger = logging.getLogger('audio')
 
 
@@ -30,17 +51,526 @@ def sample_width_to_string(sample_width):
     return {1: 's8', 2: 's16', 4: 's32'}[sample_width]
 
 
+def _read_fully(stream, view):
+    """Fill the writable view from stream with readinto().
+
+    Returns False if the stream was closed before the view was filled.
+    """
+    n_read = 0
+    n_bytes = len(view)
+    while n_read < n_bytes:
+        n = stream.readinto(view[n_read:])
+        if not n:
+            return False
+        n_read += n
+    return True
+
+
+class Error(Exception):
+    pass
+
+
+class CaptureBackend(object):
+
+    """Base class for a source of raw interleaved audio for the Recorder.
+
+    open() is called on the recording thread, which then calls readinto()
+    until it returns 0. close() can be called from any thread, and should make
+    a blocked readinto() return 0.
+    """
+
+    def open(self):
+        pass
+
+    def readinto(self, view):
+        """Read audio into the writable view and return the number of bytes
+        read, or 0 if the source is closed.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def eof(self):
+        """Returns True if the source ended normally, for example at the end of
+        a replayed file, rather than being interrupted.
+        """
+        return False
+
+
+class ArecordCapture(CaptureBackend):
+
+    """Captures audio with an arecord subprocess."""
+
+    def __init__(self, input_device='default',
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+        self._cmd = [
+            'arecord',
+            '-q',
+            '-t', 'raw',
+            '-D', input_device,
+            '-c', str(channels),
+            '-f', sample_width_to_string(bytes_per_sample),
+            '-r', str(sample_rate_hz),
+        ]
+        self._arecord = None
+
+    def open(self):
+        # Clean up after a previous arecord, if this is a restart.
+        if self._arecord:
+            self._arecord.stdout.close()
+
+        # Unbuffered, so readinto() goes straight from the pipe into the ring.
+        self._arecord = subprocess.Popen(self._cmd, stdout=subprocess.PIPE, bufsize=0)
+
+    def readinto(self, view):
+        return self._arecord.stdout.readinto(view)
+
+    def close(self):
+        if self._arecord:
+            self._arecord.kill()
+            self._arecord.wait()
+
+
+@functools.lru_cache()
+def _load_asound():
+    """Load libasound with ctypes."""
+    path = ctypes.util.find_library('asound')
+    if not path:
+        raise Error('libasound not found')
+
+    lib = ctypes.CDLL(path)
+    lib.snd_pcm_readi.restype = ctypes.c_long
+    lib.snd_pcm_readi.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong]
+    lib.snd_pcm_writei.restype = ctypes.c_long
+    lib.snd_pcm_writei.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_ulong]
+    lib.snd_strerror.restype = ctypes.c_char_p
+    return lib
+
+
+def _alsa_strerror(lib, ret):
+    return lib.snd_strerror(ret).decode('utf-8', 'replace')
+
+
+class _AlsaPcm(object):
+
+    """Common code to open an ALSA PCM in-process with libasound."""
+
+    SND_PCM_STREAM_PLAYBACK = 0
+    SND_PCM_STREAM_CAPTURE = 1
+    SND_PCM_ACCESS_RW_INTERLEAVED = 3
+    SND_PCM_FORMATS = {1: 0, 2: 2, 4: 10}  # S8, S16_LE, S32_LE
+
+    LATENCY_US = 500000
+
+    def __init__(self, device, stream, channels, bytes_per_sample, sample_rate_hz):
+        self._device = device
+        self._stream = stream
+        self._channels = channels
+        self._bytes_per_frame = channels * bytes_per_sample
+        self._format = self.SND_PCM_FORMATS[bytes_per_sample]
+        self._sample_rate_hz = sample_rate_hz
+
+        self._lib = None
+        self._pcm = None
+        self._lock = threading.Lock()
+
+    def _check(self, ret, what):
+        if ret < 0:
+            raise Error('%s failed: %s' % (what, _alsa_strerror(self._lib, ret)))
+        return ret
+
+    def _open_pcm(self):
+        self._lib = _load_asound()
+        self._close_pcm()
+
+        pcm = ctypes.c_void_p()
+        self._check(self._lib.snd_pcm_open(
+            ctypes.byref(pcm), self._device.encode('utf-8'), self._stream, 0),
+            'snd_pcm_open')
+        try:
+            self._check(self._lib.snd_pcm_set_params(
+                pcm, self._format, self.SND_PCM_ACCESS_RW_INTERLEAVED,
+                self._channels, self._sample_rate_hz, 1, self.LATENCY_US),
+                'snd_pcm_set_params')
+        except Error:
+            self._lib.snd_pcm_close(pcm)
+            raise
+
+        with self._lock:
+            self._pcm = pcm
+
+    def _close_pcm(self):
+        with self._lock:
+            if self._pcm:
+                self._lib.snd_pcm_close(self._pcm)
+                self._pcm = None
+
+
+class AlsaCapture(_AlsaPcm, CaptureBackend):
+
+    """Captures audio in-process with libasound, loaded with ctypes.
+
+    Frames are read straight into the Recorder's buffer, without the pipe from
+    an arecord subprocess.
+    """
+
+    def __init__(self, input_device='default',
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+        super().__init__(input_device, self.SND_PCM_STREAM_CAPTURE,
+                         channels, bytes_per_sample, sample_rate_hz)
+        self._closed = False
+
+        # Number of times the capture buffer overran because audio wasn't read
+        # quickly enough.
+        self.overruns = 0
+
+    def open(self):
+        self._open_pcm()
+        self._closed = False
+
+    def readinto(self, view):
+        # The PCM can't be closed while another thread is reading from it, so
+        # close() only sets a flag and the PCM is closed here.
+        if self._closed:
+            self._close_pcm()
+            return 0
+
+        buf = (ctypes.c_char * len(view)).from_buffer(view)
+        while True:
+            frames = self._lib.snd_pcm_readi(
+                self._pcm, buf, len(view) // self._bytes_per_frame)
+            if frames >= 0:
+                return frames * self._bytes_per_frame
+
+            # Recover from overruns, or give up.
+            logger.warning('snd_pcm_readi failed: %s', _alsa_strerror(self._lib, frames))
+            if frames == -errno.EPIPE:
+                self.overruns += 1
+            if self._lib.snd_pcm_recover(self._pcm, frames, 1) < 0:
+                self._close_pcm()
+                return 0
+
+    def close(self):
+        self._closed = True
+
+
+class ReplayCapture(CaptureBackend):
+
+    """Replays audio from a raw or WAV file, or a pipe, in place of a
+    microphone. This is useful to test and benchmark the audio path on
+    machines without a sound card.
+
+    - source: path to a raw or WAV file, or a binary file object with raw audio
+    - realtime: if True, deliver audio at the sample rate, otherwise as fast as
+      possible
+    """
+
+    def __init__(self, source, channels=1, bytes_per_sample=2, sample_rate_hz=16000,
+                 realtime=True):
+        self._source = source
+        self._format = (channels, bytes_per_sample, sample_rate_hz)
+        self._bytes_per_second = channels * bytes_per_sample * sample_rate_hz
+        self._realtime = realtime
+
+        self._file = None
+        self._wav = None
+        self._start_time = None
+        self._n_bytes = 0
+        self._closed = False
+        self._eof = False
+
+    def open(self):
+        self._n_bytes = 0
+        self._closed = False
+        self._eof = False
+
+        if not isinstance(self._source, str):
+            self._file = self._source
+        elif self._source.endswith('.wav'):
+            self._wav = wave.open(self._source, 'rb')
+            wav_format = (self._wav.getnchannels(), self._wav.getsampwidth(),
+                          self._wav.getframerate())
+            if wav_format != self._format:
+                self._wav.close()
+                raise ValueError('%s has format %r, expected %r' % (
+                    self._source, wav_format, self._format))
+        else:
+            self._file = open(self._source, 'rb', buffering=0)
+
+        self._start_time = time.monotonic()
+
+    def readinto(self, view):
+        # As with AlsaCapture, the file is only closed on the reading thread.
+        if self._closed:
+            self._close_file()
+            return 0
+
+        if self._realtime:
+            delay = self._start_time + self._n_bytes / self._bytes_per_second - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        if self._wav:
+            frames = self._wav.readframes(len(view) // self._wav.getsampwidth()
+                                          // self._wav.getnchannels())
+            n = len(frames)
+            view[:n] = frames
+        else:
+            n = self._file.readinto(view)
+
+        if not n:
+            self._eof = True
+            self._close_file()
+            return 0
+
+        self._n_bytes += n
+        return n
+
+    def _close_file(self):
+        if self._wav:
+            self._wav.close()
+            self._wav = None
+        elif self._file and isinstance(self._source, str):
+            self._file.close()
+        self._file = None
+
+    def close(self):
+        self._closed = True
+
+    def eof(self):
+        return self._eof
+
+
+CAPTURE_BACKENDS = {
+    'arecord': ArecordCapture,
+    'alsa': AlsaCapture,
+}
+
+
+def make_capture_backend(name, input_device='default',
+                         channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+    """Create a live capture backend by name: 'arecord' or 'alsa'."""
+    return CAPTURE_BACKENDS[name](input_device, channels, bytes_per_sample, sample_rate_hz)
+
+
+AudioFormat = collections.namedtuple(
+    'AudioFormat', ['channels', 'bytes_per_sample', 'sample_rate_hz'])
+AudioFormat.__doc__ = """The format of raw interleaved signed little-endian
+audio.
+"""
+
+_SAMPLE_DTYPES = {1: np.dtype('i1'), 2: np.dtype('<i2'), 4: np.dtype('<i4')}
+
+
+@functools.lru_cache()
+def _polyphase_filter(up, down, zero_crossings=10):
+    """Design a low-pass filter for resampling by up/down, and split it into
+    polyphase components.
+
+    Returns an array of shape (up, taps_per_phase), where row p has the taps
+    applied to the input for output samples at phase p.
+    """
+    factor = max(up, down)
+    n_taps = 2 * zero_crossings * factor + 1
+    t = np.arange(n_taps) - (n_taps - 1) / 2
+    taps = np.sinc(t / factor) * np.kaiser(n_taps, 5.0) * up / factor
+
+    taps_per_phase = int(math.ceil(n_taps / up))
+    taps = np.concatenate([taps, np.zeros(taps_per_phase * up - n_taps)])
+    phases = taps.reshape(taps_per_phase, up).T
+    phases.setflags(write=False)
+    return phases
+
+
+class Resampler(object):
+
+    """Streaming polyphase resampler for float audio of shape (frames,
+    channels). The filter taps are cached, so resamplers for the same ratio
+    share them.
+    """
+
+    def __init__(self, in_rate_hz, out_rate_hz, channels=1):
+        gcd = math.gcd(in_rate_hz, out_rate_hz)
+        self._up = out_rate_hz // gcd
+        self._down = in_rate_hz // gcd
+        self._phases = _polyphase_filter(self._up, self._down)
+        n_taps = self._phases.shape[1]
+
+        # Past input frames, needed by the next outputs.
+        self._history = np.zeros((n_taps - 1, channels), dtype=np.float32)
+        self._tap_offsets = np.arange(n_taps)
+
+        # Index of the next output frame, and number of input frames seen.
+        # Both are kept small by removing whole periods of up/down frames.
+        self._n_out = 0
+        self._n_in = 0
+
+    def process(self, frames):
+        """Resample the given frames, and return all the output frames that
+        can be computed so far.
+        """
+        buf = np.concatenate([self._history, frames])
+        buf_start = self._n_in - len(self._history)
+        self._n_in += len(frames)
+
+        # Output frame n uses input frames up to n * down // up.
+        n_end = -(-self._n_in * self._up // self._down)
+        out_ix = np.arange(self._n_out, n_end)
+        positions = out_ix * self._down
+        bases = positions // self._up - buf_start
+        taps = self._phases[positions % self._up]
+        windows = buf[bases[:, np.newaxis] - self._tap_offsets]
+        out = np.einsum('nkc,nk->nc', windows, taps)
+
+        self._n_out = n_end
+        self._history = buf[len(buf) - len(self._history):]
+
+        periods = min(self._n_out // self._up, self._n_in // self._down)
+        self._n_out -= periods * self._up
+        self._n_in -= periods * self._down
+
+        return out.astype(np.float32)
+
+
+class FormatConverter(object):
+
+    """Converts chunks of audio between AudioFormats.
+
+    Multiple channels are mixed down to mono, unless a channel is selected.
+    Mono audio can be copied to several channels.
+    """
+
+    def __init__(self, in_format, out_format, channel=None):
+        if out_format.channels != in_format.channels and \
+                out_format.channels != 1 and in_format.channels != 1:
+            raise ValueError("can't convert %d channels to %d" % (
+                in_format.channels, out_format.channels))
+
+        self._in_format = in_format
+        self._out_format = out_format
+        self._channel = channel
+        self._in_dtype = _SAMPLE_DTYPES[in_format.bytes_per_sample]
+        self._out_dtype = _SAMPLE_DTYPES[out_format.bytes_per_sample]
+        self._in_scale = 1 / float(2 ** (8 * in_format.bytes_per_sample - 1))
+        self._out_scale = float(2 ** (8 * out_format.bytes_per_sample - 1))
+
+        self._resampler = None
+        if in_format.sample_rate_hz != out_format.sample_rate_hz:
+            channels = min(in_format.channels, out_format.channels)
+            if channel is not None:
+                channels = 1
+            self._resampler = Resampler(
+                in_format.sample_rate_hz, out_format.sample_rate_hz, channels)
+
+    def convert(self, data):
+        """Convert the audio data, and return a memoryview of the result."""
+        frames = np.frombuffer(data, self._in_dtype).reshape(-1, self._in_format.channels)
+        frames = frames.astype(np.float32) * self._in_scale
+
+        # Reduce channels first, and expand last, so the resampler has as
+        # little to do as possible.
+        if self._channel is not None:
+            frames = frames[:, self._channel:self._channel + 1]
+        elif self._out_format.channels < self._in_format.channels:
+            frames = frames.mean(axis=1, keepdims=True)
+
+        if self._resampler:
+            frames = self._resampler.process(frames)
+
+        if frames.shape[1] < self._out_format.channels:
+            frames = np.repeat(frames, self._out_format.channels, axis=1)
+
+        out = np.clip(np.rint(frames * self._out_scale),
+                      np.iinfo(self._out_dtype).min, np.iinfo(self._out_dtype).max)
+        return memoryview(np.ascontiguousarray(out, dtype=self._out_dtype)).cast('B')
+
+
+AudioChunk = collections.namedtuple('AudioChunk', ['frame', 'timestamp', 'data'])
+AudioChunk.__doc__ = """A chunk of recorded audio.
+
+frame: index of the first frame of the chunk since recording started
+timestamp: time.monotonic() when the first frame was captured
+data: the audio bytes
+"""
+
+
+# Processors that get audio in the same format from the Recorder. key is None
+# for the captured format, or (AudioFormat, channel) for converted audio.
+_Output = collections.namedtuple('_Output', ['key', 'converter', 'processors'])
+
+
+class _Replay(object):
+
+    """Stands in for a processor that is being given the history, and holds
+    back live audio until the history has been passed on.
+    """
+
+    def __init__(self, processor):
+        self.processor = processor
+        self._lock = threading.Lock()
+        # Live audio that arrived during the replay, or None when it's over.
+        self._pending = []
+        self._removed = False
+
+    def add_data(self, data):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(bytes(data))
+                return
+        self.processor.add_data(data)
+
+    def replay(self, history):
+        """Pass on the history, then the live audio that arrived meanwhile."""
+        for data in history:
+            if self._removed:
+                return
+            self.processor.add_data(data)
+
+        while not self._removed:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                if not pending:
+                    self._pending = None
+                    return
+            for data in pending:
+                self.processor.add_data(data)
+
+    def remove(self):
+        self._removed = True
+
+
 class Recorder(threading.Thread):
 
     """Stream audio from microphone in a background thread and run processing
     callbacks. It reads audio in a configurable format from the microphone,
     then converts it to a known format before passing it to the processors.
+
+    Each processor can ask for its own AudioFormat. Audio is converted once
+    per chunk for each format, and shared between the processors that use it.
+    Processors that don't ask for a format get the audio as it was captured.
+
+    Audio is read straight into a preallocated ring of chunks, and processors
+    get a memoryview of the chunk in the ring. The view is only valid during
+    the add_data() call: processors that keep audio around must copy it.
+
+    The ring also keeps the last few seconds of audio, so processors can be
+    given some history when they are attached (see add_processor()).
     """
 
     CHUNK_S = 0.1
 
+    # Minimum number of chunks in the capture ring.
+    RING_CHUNKS = 4
+
+    # Delay before reopening the capture backend after it fails. This doubles
+    # with each failure in a row, up to the maximum.
+    RESTART_DELAY_S = 0.01
+    MAX_RESTART_DELAY_S = 2.0
+
     def __init__(self, input_device='default',
-                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000,
+                 history_s=0, backend=None, max_failures=5):
         """Create a Recorder with the given audio format.
 
         The Recorder will not start until start() is called. start() is called
@@ -50,125 +580,1415 @@ class Recorder(threading.Thread):
         - channels: number of channels in audio read from the mic
         - bytes_per_sample: sample width in bytes (eg 2 for 16-bit audio)
         - sample_rate_hz: sample rate in hertz
+        - history_s: seconds of recent audio to keep for new processors
+        - backend: CaptureBackend to read audio in the given format from
+          (default: ArecordCapture for input_device)
+        - max_failures: number of times in a row the backend can fail before
+          the process exits
         """
 
         super().__init__()
 
-        self._processors = []
+        # List of _Outputs. It's replaced rather than modified, so
+        # _handle_chunk() can iterate over it without holding the lock.
+        self._outputs = []
+        self._lock = threading.Lock()
 
-        self._chunk_bytes = int(self.CHUNK_S * sample_rate_hz) * channels * bytes_per_sample
+        self._format = AudioFormat(channels, bytes_per_sample, sample_rate_hz)
 
-        self._cmd = [
-            'arecord',
-            '-q',
-            '-t', 'raw',
-            '-D', input_device,
-            '-c', str(channels),
-            '-f', sample_width_to_string(bytes_per_sample),
-            '-r', str(sample_rate_hz),
-        ]
-        self._arecord = None
+        self._chunk_frames = int(self.CHUNK_S * sample_rate_hz)
+        self._chunk_bytes = self._chunk_frames * channels * bytes_per_sample
+
+        # One slot more than the history, as the slot being filled isn't part
+        # of the history.
+        history_chunks = int(math.ceil(history_s / self.CHUNK_S))
+        self._ring_size = max(self.RING_CHUNKS, history_chunks + 1)
+        self._ring = bytearray(self._chunk_bytes * self._ring_size)
+        ring_view = memoryview(self._ring)
+        self._ring_chunks = [
+            ring_view[i * self._chunk_bytes:(i + 1) * self._chunk_bytes]
+            for i in range(self._ring_size)]
+        self._ring_timestamps = [0.0] * self._ring_size
+        self._n_chunks = 0
+
+        self._backend = backend or ArecordCapture(
+            input_device, channels, bytes_per_sample, sample_rate_hz)
+        self._max_failures = max_failures
         self._closed = False
+        self._closed_event = threading.Event()
+
+        # Number of times the capture backend was reopened after failing.
+        self.restarts = 0
 
-    def add_processor(self, processor):
-        self._processors.append(processor)
+    def add_processor(self, processor, since=None, fmt=None, channel=None):
+        """Start passing audio to the processor.
+
+        If since is a time.monotonic() timestamp, the processor first gets the
+        recorded audio from that time on, as far as it's still in the history.
+        No audio is lost or repeated between the history and the live audio.
+
+        If fmt is an AudioFormat, the audio is converted to that format. If
+        channel is given, only that channel is used instead of a mix of all of
+        them.
+        """
+        fmt = fmt or self._format
+        if fmt == self._format and channel is None:
+            key = None
+        else:
+            key = (fmt, channel)
+
+        # The history is replayed outside the lock, as the processor may
+        # call del_processor() when it has heard enough. Until then, live
+        # audio is held back by the _Replay.
+        replay = None
+        with self._lock:
+            if since is not None:
+                history = self._get_history(since)
+                replay = _Replay(processor)
+
+            outputs = []
+            added = False
+            for output in self._outputs:
+                if output.key == key:
+                    output = output._replace(
+                        processors=output.processors + (replay or processor,))
+                    added = True
+                outputs.append(output)
+            if not added:
+                converter = key and FormatConverter(self._format, fmt, channel)
+                outputs.append(_Output(key, converter, (replay or processor,)))
+            self._outputs = outputs
+
+        if replay:
+            # A separate converter, so the shared one isn't disturbed.
+            converter = key and FormatConverter(self._format, fmt, channel)
+            replay.replay(converter.convert(chunk.data) if converter else chunk.data
+                          for chunk in history)
 
     def del_processor(self, processor):
-        self._processors.remove(processor)
+        with self._lock:
+            outputs = []
+            for output in self._outputs:
+                processors = []
+                for p in output.processors:
+                    if p is processor or (isinstance(p, _Replay) and p.processor is processor):
+                        if isinstance(p, _Replay):
+                            p.remove()
+                    else:
+                        processors.append(p)
+                if processors:
+                    outputs.append(output._replace(processors=tuple(processors)))
+            self._outputs = outputs
+
+    def get_history(self, since=None):
+        """Return a list of AudioChunks recorded since the given
+        time.monotonic() timestamp, or the whole history, oldest first.
+        """
+        with self._lock:
+            return self._get_history(since)
+
+    def _get_history(self, since):
+        history = []
+        n_history = min(self._n_chunks, self._ring_size - 1)
+        for i in range(self._n_chunks - n_history, self._n_chunks):
+            slot = i % self._ring_size
+            timestamp = self._ring_timestamps[slot]
+            if since is None or timestamp + self.CHUNK_S > since:
+                history.append(AudioChunk(
+                    i * self._chunk_frames, timestamp, bytes(self._ring_chunks[slot])))
+        return history
 
     def run(self):
-        """Reads data from arecord and passes to processors."""
+        """Reads data from the capture backend and passes to processors.
+
+        If the backend fails, it's reopened after a short delay, keeping the
+        processors attached.
+        """
+
+        failures = 0
+        delay = self.RESTART_DELAY_S
+
+        while True:
+            n_chunks = self._n_chunks
+            try:
+                self._backend.open()
+                logger.info("started recording")
+
+                # check for race-condition when __exit__ is called at the same
+                # time as the backend is opened by the background thread
+                if self._closed:
+                    self._backend.close()
+                    return
+
+                self._capture(self._backend)
+            except (Error, OSError):
+                logger.exception('Failed to record audio')
 
-        self._arecord = subprocess.Popen(self._cmd, stdout=subprocess.PIPE)
-        logger.info("started recording")
+            if self._closed:
+                return
+            if self._backend.eof():
+                logger.info('finished recording')
+                return
 
-        # check for race-condition when __exit__ is called at the same time as
-        # the process is started by the background thread
+            # Only back off if the backend fails again without recording.
+            if self._n_chunks > n_chunks:
+                failures = 0
+                delay = self.RESTART_DELAY_S
+            failures += 1
+            if failures > self._max_failures:
+                logger.error('Microphone recorder died unexpectedly, aborting...')
+                # sys.exit doesn't work from background threads, so use
+                # os._exit as an emergency measure.
+                logging.shutdown()
+                os._exit(1)  # pylint: disable=protected-access
+                return
+
+            self._backend.close()
+            logger.warning('Microphone recorder died, restarting in %.2f s', delay)
+            if self._closed_event.wait(delay):
+                return
+            delay = min(delay * 2, self.MAX_RESTART_DELAY_S)
+            self.restarts += 1
+
+    def _capture(self, stream):
+        """Read chunks from a raw stream into the ring until it is closed."""
+        slot = self._n_chunks % self._ring_size
+        while _read_fully(stream, self._ring_chunks[slot]):
+            with self._lock:
+                self._ring_timestamps[slot] = time.monotonic() - self.CHUNK_S
+                self._n_chunks += 1
+                outputs = self._outputs
+            self._handle_chunk(outputs, self._ring_chunks[slot])
+            slot = self._n_chunks % self._ring_size
+
+    def _handle_chunk(self, outputs, chunk):
+        """Convert audio chunk to each format, and send it to the processors.
+        """
+        for output in outputs:
+            data = output.converter.convert(chunk) if output.converter else chunk
+            for p in output.processors:
+                p.add_data(data)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self._closed = True
+        self._closed_event.set()
+        self._backend.close()
+
+
+ProcessorStats = collections.namedtuple('ProcessorStats', [
+    'queue_depth', 'max_queue_depth', 'chunks', 'dropped',
+    'processing_s', 'max_processing_s'])
+
+
+class AsyncProcessor(object):
+
+    """Runs a processor on its own thread behind a bounded queue, so that a
+    slow processor doesn't stall the Recorder.
+
+    When the queue is full, the policy decides what happens:
+    - DROP_OLDEST: the oldest queued chunk is dropped (default)
+    - DROP_NEWEST: the new chunk is dropped
+    - BLOCK: the Recorder waits for the processor. Only use this when the
+      audio is replayed from a file, as a live capture would overrun.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop-oldest'
+    DROP_NEWEST = 'drop-newest'
+
+    def __init__(self, processor, max_chunks=10, policy=DROP_OLDEST):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.DROP_NEWEST):
+            raise ValueError('unknown policy: %r' % policy)
+
+        self.processor = processor
+        self._policy = policy
+        self._queue = queue.Queue(max_chunks)
+        self._closed = False
+
+        self._max_queue_depth = 0
+        self._chunks = 0
+        self._dropped = 0
+        self._processing_s = 0.0
+        self._max_processing_s = 0.0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_data(self, data):
+        """Queue a copy of the data for the processor."""
         if self._closed:
-            self._arecord.kill()
             return
 
-        this_chunk = b''
+        data = bytes(data)
+        if self._policy == self.BLOCK:
+            # Time out now and then, so the Recorder isn't stuck after close().
+            while not self._closed:
+                try:
+                    self._queue.put(data, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+        else:
+            while True:
+                try:
+                    self._queue.put_nowait(data)
+                    break
+                except queue.Full:
+                    self._dropped += 1
+                    if self._policy == self.DROP_NEWEST:
+                        return
+                    try:
+                        self._queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+        self._max_queue_depth = max(self._max_queue_depth, self._queue.qsize())
 
+    def _run(self):
         while True:
-            input_data = self._arecord.stdout.read(self._chunk_bytes)
-            if not input_data:
-                break
+            data = self._queue.get()
+            if data is None:
+                return
 
-            this_chunk += input_data
-            if len(this_chunk) >= self._chunk_bytes:
-                self._handle_chunk(this_chunk[:self._chunk_bytes])
-                this_chunk = this_chunk[self._chunk_bytes:]
+            start = time.monotonic()
+            self.processor.add_data(data)
+            elapsed = time.monotonic() - start
 
-        if not self._closed:
-            logger.error('Microphone recorder died unexpectedly, aborting...')
-            # sys.exit doesn't work from background threads, so use os._exit as
-            # an emergency measure.
-            logging.shutdown()
-            os._exit(1)  # pylint: disable=protected-access
+            self._chunks += 1
+            self._processing_s += elapsed
+            self._max_processing_s = max(self._max_processing_s, elapsed)
 
-    def _handle_chunk(self, chunk):
-        """Send audio chunk to all processors.
+    def get_stats(self):
+        """Return a ProcessorStats with the queue depth, the number of chunks
+        processed and dropped, and the time spent processing them.
         """
-        for p in self._processors:
-            p.add_data(chunk)
+        return ProcessorStats(
+            self._queue.qsize(), self._max_queue_depth, self._chunks, self._dropped,
+            self._processing_s, self._max_processing_s)
+
+    def close(self):
+        """Stop accepting data, and wait for the queued data to be processed."""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+            self._thread.join()
 
     def __enter__(self):
-        self.start()
         return self
 
     def __exit__(self, *args):
-        self._closed = True
-        if self._arecord:
-            self._arecord.kill()
+        self.close()
 
 
-class Player(object):
+class VadEndpointer(object):
 
-    """Plays short audio clips from a buffer or file."""
+    """Finds the end of an utterance locally, by voice activity detection on
+    the energy and zero-crossing rate of 10 ms frames, and passes the audio on
+    to another processor until then.
 
-    def __init__(self, output_device='default'):
-        self._output_device = output_device
+    The end is reached after trailing_silence_s of silence following speech,
+    or after max_utterance_s; then the end callback is called once, and no more audio
+    is passed on. With skip_leading_silence, audio from before the speech
+    starts isn't passed on, apart from the last LEADING_PAD_S of it.
 
-    def play_bytes(self, audio_bytes, sample_rate, sample_width=2):
-        """Play audio from the given bytes-like object.
+    The audio must be 16-bit mono.
+    """
 
-        audio_bytes: audio data (mono)
-        sample_rate: sample rate in Hertz (24 kHz by default)
-        sample_width: sample width in bytes (eg 2 for 16-bit audio)
+    FRAME_S = 0.01
+
+    # Number of consecutive voiced frames that start speech.
+    SPEECH_FRAMES = 3
+
+    # Audio before the start of speech that is kept when skipping leading
+    # silence, so the first sound isn't clipped.
+    LEADING_PAD_S = 0.3
+
+    # A frame is voiced if its RMS level is THRESHOLD times the noise floor,
+    # or FRICATIVE_THRESHOLD times with a high zero-crossing rate.
+    THRESHOLD = 3.0
+    FRICATIVE_THRESHOLD = 1.5
+    FRICATIVE_ZCR = 0.3
+    MIN_NOISE_RMS = 50
+
+    def __init__(self, processor, sample_rate_hz=16000, trailing_silence_s=0.8,
+                 max_utterance_s=15, skip_leading_silence=False, max_leading_silence_s=5):
+        self.processor = processor
+        self._end_cb = None
+        self._frame_samples = int(self.FRAME_S * sample_rate_hz)
+        self._trailing_frames = int(trailing_silence_s / self.FRAME_S)
+        self._max_frames = int(max_utterance_s / self.FRAME_S)
+        self._max_leading_frames = int(max_leading_silence_s / self.FRAME_S)
+        self._pad_bytes = int(self.LEADING_PAD_S * sample_rate_hz) * 2
+        self._skip_leading_silence = skip_leading_silence
+        self.reset()
+
+    def set_end_cb(self, cb):
+        """Callback to invoke at the end of the utterance."""
+        self._end_cb = cb
+
+    def reset(self):
+        """Start looking for a new utterance."""
+        self.speech_started = False
+        self.ended = False
+        self._frames = 0
+        self._voiced_run = 0
+        self._silent_frames = 0
+        self._noise_rms = self.MIN_NOISE_RMS
+        self._leftover = np.zeros(0, dtype='<i2')
+        self._pad = collections.deque()
+        self._pad_len = 0
+
+    def add_data(self, data):
+        if self.ended:
+            return
+
+        for voiced in self._classify(data):
+            self._frames += 1
+            if voiced:
+                self._voiced_run += 1
+                self._silent_frames = 0
+            else:
+                self._voiced_run = 0
+                self._silent_frames += 1
+
+            if not self.speech_started and self._voiced_run >= self.SPEECH_FRAMES:
+                logger.info('speech started after %.2f s', self._frames * self.FRAME_S)
+                self.speech_started = True
+                for chunk in self._pad:
+                    self.processor.add_data(chunk)
+                self._pad.clear()
+
+        if self.speech_started or not self._skip_leading_silence:
+            self.processor.add_data(data)
+        else:
+            self._pad.append(bytes(data))
+            self._pad_len += len(data)
+            while self._pad_len - len(self._pad[0]) >= self._pad_bytes:
+                self._pad_len -= len(self._pad.popleft())
+
+        if self.speech_started and self._silent_frames >= self._trailing_frames:
+            self._end('trailing silence')
+        elif self._frames >= self._max_frames:
+            self._end('max utterance length')
+        elif not self.speech_started and self._skip_leading_silence and \
+                self._frames >= self._max_leading_frames:
+            self._end('no speech')
+
+    def _end(self, reason):
+        logger.info('end of utterance after %.2f s: %s', self._frames * self.FRAME_S, reason)
+        self.ended = True
+        if self._end_cb:
+            self._end_cb()
+
+    def _classify(self, data):
+        """Return whether each complete frame is voiced, and update the noise
+        floor.
         """
+        samples = np.frombuffer(data, dtype='<i2')
+        if len(self._leftover):
+            samples = np.concatenate((self._leftover, samples))
+        n_frames = len(samples) // self._frame_samples
+        self._leftover = samples[n_frames * self._frame_samples:].copy()
+
+        frames = samples[:n_frames * self._frame_samples].reshape(
+            n_frames, self._frame_samples).astype(np.float32)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        signs = np.signbit(frames)
+        zcr = np.mean(signs[:, 1:] != signs[:, :-1], axis=1)
+
+        voiced = []
+        for frame_rms, frame_zcr in zip(rms, zcr):
+            noise = self._noise_rms
+            is_voiced = bool(frame_rms > self.THRESHOLD * noise or (
+                frame_rms > self.FRICATIVE_THRESHOLD * noise and frame_zcr > self.FRICATIVE_ZCR))
+            voiced.append(is_voiced)
+
+            # Follow the noise floor down quickly, and up slowly; very slowly
+            # during speech, so long vowels aren't taken for noise.
+            if frame_rms < noise:
+                rate = 0.1
+            else:
+                rate = 0.001 if is_voiced else 0.01
+            self._noise_rms = max(self.MIN_NOISE_RMS, noise + rate * (frame_rms - noise))
+        return voiced
+
+
+class OutputBackend(object):
+
+    """Base class for a sink of raw interleaved audio for the Player."""
 
-        cmd = [
+    # True if audio that was written may not be played until more follows.
+    # The Player then writes silence while the output is open and idle.
+    NEEDS_SILENCE = False
+
+    def open(self):
+        pass
+
+    def write(self, data):
+        """Write audio, blocking until the device has room for it."""
+        raise NotImplementedError
+
+    def close(self):
+        """Close the output after the written audio has been played."""
+        pass
+
+
+class AplayOutput(OutputBackend):
+
+    """Plays audio with a long-lived aplay subprocess, fed through a pipe.
+
+    aplay only writes whole periods to the device, so the end of a clip is
+    played once the next period is read. It's started with a small buffer,
+    which it starts playing after START_DELAY_US, and kept fed with silence.
+    """
+
+    NEEDS_SILENCE = True
+
+    BUFFER_US = 100000
+    PERIOD_US = 25000
+    START_DELAY_US = 25000
+
+    def __init__(self, output_device='default',
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+        self._cmd = [
             'aplay',
             '-q',
             '-t', 'raw',
-            '-D', self._output_device,
-            '-c', '1',
-            '-f', sample_width_to_string(sample_width),
-            '-r', str(sample_rate),
+            '-D', output_device,
+            '-c', str(channels),
+            '-f', sample_width_to_string(bytes_per_sample),
+            '-r', str(sample_rate_hz),
+            '--buffer-time=%d' % self.BUFFER_US,
+            '--period-time=%d' % self.PERIOD_US,
+            '--start-delay=%d' % self.START_DELAY_US,
         ]
+        self._aplay = None
 
-        aplay = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-        aplay.stdin.write(audio_bytes)
-        aplay.stdin.close()
-        retcode = aplay.wait()
+    def open(self):
+        self._aplay = subprocess.Popen(self._cmd, stdin=subprocess.PIPE)
 
-        if retcode:
-            logger.error('aplay failed with %d', retcode)
+    def write(self, data):
+        self._aplay.stdin.write(data)
+        self._aplay.stdin.flush()
 
-    def play_wav(self, wav_path):
-        """Play audio from the given WAV file. The file should be mono and
-        small enough to load into memory.
+    def close(self):
+        if self._aplay:
+            try:
+                self._aplay.stdin.close()
+            except BrokenPipeError:
+                pass
+            retcode = self._aplay.wait()
+            self._aplay = None
 
-        wav_path: path to wav file
-        """
+            if retcode:
+                logger.error('aplay failed with %d', retcode)
+
+
+class AlsaOutput(_AlsaPcm, OutputBackend):
+
+    """Plays audio in-process with libasound, loaded with ctypes."""
+
+    LATENCY_US = 100000
+
+    def __init__(self, output_device='default',
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+        super().__init__(output_device, self.SND_PCM_STREAM_PLAYBACK,
+                         channels, bytes_per_sample, sample_rate_hz)
+
+        # Number of times the output ran out of audio while playing.
+        self.underruns = 0
+
+    def open(self):
+        self._open_pcm()
+
+    def write(self, data):
+        data = bytes(data)
+        address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+        n_frames = len(data) // self._bytes_per_frame
+
+        written = 0
+        while written < n_frames:
+            frames = self._lib.snd_pcm_writei(
+                self._pcm, address + written * self._bytes_per_frame, n_frames - written)
+            if frames >= 0:
+                written += frames
+                continue
+
+            if frames == -errno.EPIPE:
+                self.underruns += 1
+            self._check(self._lib.snd_pcm_recover(self._pcm, frames, 1), 'snd_pcm_writei')
+
+    def close(self):
+        if self._pcm:
+            self._lib.snd_pcm_drain(self._pcm)
+        self._close_pcm()
+
+
+OUTPUT_BACKENDS = {
+    'aplay': AplayOutput,
+    'alsa': AlsaOutput,
+}
 
+
+def make_output_backend(name, output_device='default',
+                        channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+    """Create an output backend by name: 'aplay' or 'alsa'."""
+    return OUTPUT_BACKENDS[name](output_device, channels, bytes_per_sample, sample_rate_hz)
+
+
+def _find_wav_data(f):
+    """Return the offset and size of the audio data in a WAV file."""
+    riff, _, wave_id = struct.unpack('<4sI4s', f.read(12))
+    if riff != b'RIFF' or wave_id != b'WAVE':
+        raise ValueError('not a WAV file')
+
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            raise ValueError('no data in WAV file')
+        chunk_id, size = struct.unpack('<4sI', header)
+        if chunk_id == b'data':
+            return f.tell(), size
+        # Chunks are padded to an even size.
+        f.seek(size + (size & 1), os.SEEK_CUR)
+
+
+class ClipCache(object):
+
+    """A LRU cache of WAV clips, decoded to the output format of a Player.
+
+    Clips are keyed by path and modification time, so edited files are read
+    again. Clips larger than MMAP_BYTES in the output format are mapped into
+    memory instead of being read. If the file is in another format, it's
+    converted CONVERT_FRAMES at a time to a raw file in cache_dir, once, and
+    that is mapped. Mapped clips count towards the size of the cache too.
+    Clips larger than the cache aren't kept, but mapping them again is cheap.
+    """
+
+    MMAP_BYTES = 1024 * 1024
+    CONVERT_FRAMES = 65536
+
+    def __init__(self, output_format, max_bytes=4 * 1024 * 1024,
+                 cache_dir=os.path.join(tempfile.gettempdir(), 'voice-recognizer-clips')):
+        self._format = output_format
+        self._max_bytes = max_bytes
+        self._cache_dir = cache_dir
+        self._lock = threading.Lock()
+
+        # path -> (mtime, clip, size counted towards max_bytes)
+        self._clips = collections.OrderedDict()
+        self._n_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, wav_path):
+        """Return the audio from the given mono WAV file, in the output format."""
+        mtime = os.stat(wav_path).st_mtime_ns
+        with self._lock:
+            entry = self._clips.get(wav_path)
+            if entry and entry[0] == mtime:
+                self._clips.move_to_end(wav_path)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        clip = self._load(wav_path, mtime)
+        size = len(clip)
+
+        with self._lock:
+            old_entry = self._clips.pop(wav_path, None)
+            if old_entry:
+                self._n_bytes -= old_entry[2]
+            if size <= self._max_bytes:
+                self._clips[wav_path] = (mtime, clip, size)
+                self._n_bytes += size
+                while self._n_bytes > self._max_bytes:
+                    _, (_, _, evicted_size) = self._clips.popitem(last=False)
+                    self._n_bytes -= evicted_size
+
+        return clip
+
+    def _load(self, wav_path, mtime):
+        """Read or map a clip in the output format."""
         with wave.open(wav_path, 'r') as wav:
             if wav.getnchannels() != 1:
                 raise ValueError(wav_path + ' is not a mono file')
 
-            frames = wav.readframes(wav.getnframes())
-            self.play_bytes(frames, wav.getframerate(), wav.getsampwidth())
+            clip_format = AudioFormat(1, wav.getsampwidth(), wav.getframerate())
+            n_frames = wav.getnframes()
+            out_bytes = (n_frames * self._format.sample_rate_hz // clip_format.sample_rate_hz *
+                         self._format.channels * self._format.bytes_per_sample)
+
+            if out_bytes <= self.MMAP_BYTES:
+                frames = wav.readframes(n_frames)
+                if clip_format != self._format:
+                    frames = bytes(FormatConverter(clip_format, self._format).convert(frames))
+                return frames
+
+            if clip_format != self._format:
+                return self._map_converted(wav_path, mtime, wav, clip_format)
+
+        with open(wav_path, 'rb') as f:
+            offset, size = _find_wav_data(f)
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(mapped)[offset:offset + min(size, out_bytes)]
+
+    def _map_converted(self, wav_path, mtime, wav, clip_format):
+        """Map the clip converted to the output format, converting it to a file
+        in the cache directory first if that hasn't been done yet.
+        """
+        key = repr((os.path.abspath(wav_path), tuple(self._format))).encode('utf-8')
+        prefix = os.path.join(self._cache_dir, hashlib.sha1(key).hexdigest())
+        path = '%s-%d.raw' % (prefix, mtime)
+
+        if not os.path.exists(path):
+            logger.info('converting %s to %s', wav_path, path)
+            os.makedirs(self._cache_dir, exist_ok=True)
+            for old_path in glob.glob(prefix + '-*.raw'):
+                os.remove(old_path)
+
+            converter = FormatConverter(clip_format, self._format)
+            fd, tmp_path = tempfile.mkstemp(dir=self._cache_dir)
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    frames = wav.readframes(self.CONVERT_FRAMES)
+                    while frames:
+                        f.write(converter.convert(frames))
+                        frames = wav.readframes(self.CONVERT_FRAMES)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+        with open(path, 'rb') as f:
+            return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+
+class PlaybackHandle(object):
+
+    """Audio queued on a Player. Use wait() to wait until it has been played,
+    or cancel() to stop it.
+    """
+
+    def __init__(self, priority, start_bytes=0, gain=1.0, cond=None):
+        self.priority = priority
+        self.gain = gain
+
+        # Audio is only played once start_bytes have arrived, or all of it.
+        self._start_bytes = start_bytes
+        self._started = False
+        self._played = False
+
+        # Shared with the Player, so it wakes up when audio arrives.
+        self._cond = cond or threading.Condition()
+        self._chunks = collections.deque()
+        self._n_bytes = 0
+        self._ended = False
+        self._cancelled = False
+
+        # Set when all the audio has been written to the output, or the
+        # playback was cancelled.
+        self._finished = threading.Event()
+        self._play_end = 0
+
+        # Gain applied to the last block, to ramp smoothly to a new gain.
+        self._last_gain = None
+
+    def cancel(self):
+        """Stop playing, or remove the audio from the queue."""
+        with self._cond:
+            self._cancelled = True
+            self._chunks.clear()
+            self._cond.notify_all()
+        self._finished.set()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        """Returns True if the audio has been played or cancelled."""
+        return self._finished.is_set() and (
+            self._cancelled or time.monotonic() >= self._play_end)
+
+    def wait(self, timeout=None):
+        """Wait until the audio has been played or cancelled. Returns False
+        on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if not self._finished.wait(timeout):
+            return False
+
+        with self._cond:
+            while not self._cancelled:
+                now = time.monotonic()
+                if now >= self._play_end:
+                    break
+                if deadline is not None and now >= deadline:
+                    return False
+                self._cond.wait(min(self._play_end, deadline or self._play_end) - now)
+        return True
+
+    def _append(self, data):
+        with self._cond:
+            if self._cancelled or self._ended:
+                return
+            self._chunks.append(memoryview(data).cast('B'))
+            self._n_bytes += len(data)
+            self._cond.notify_all()
+
+    def _end(self):
+        """Mark that no more audio will be appended."""
+        with self._cond:
+            self._ended = True
+            self._cond.notify_all()
+
+    def _read(self, max_bytes):
+        """Return up to max_bytes of the audio that has arrived, or None when
+        all of it has been returned or the playback was cancelled. Call with
+        the condition held.
+        """
+        if self._cancelled or (self._ended and not self._chunks):
+            return None
+        if not self._started and not self._ended and self._n_bytes < self._start_bytes:
+            return b''
+
+        self._started = True
+        blocks = []
+        n_bytes = 0
+        while self._chunks and n_bytes < max_bytes:
+            block = self._chunks[0][:max_bytes - n_bytes]
+            if len(block) < len(self._chunks[0]):
+                self._chunks[0] = self._chunks[0][len(block):]
+            else:
+                self._chunks.popleft()
+            blocks.append(block)
+            n_bytes += len(block)
+        self._n_bytes -= n_bytes
+        return blocks[0] if len(blocks) == 1 else b''.join(blocks)
+
+    def _finish(self, play_end):
+        with self._cond:
+            self._play_end = play_end
+            self._cond.notify_all()
+        self._finished.set()
+
+
+class Player(object):
+
+    """Plays audio clips and streams, mixed onto one output.
+
+    Clips are played on a long-lived output stream in a fixed format, so they
+    don't pay for starting aplay and opening the device each time. Clips in
+    other formats are converted. The stream is closed when it has been idle
+    for a while, and reopened for the next clip.
+
+    Clips are queued and played one at a time on a background thread, in order
+    of priority: earcons first, then speech, then responses. The play methods
+    return a PlaybackHandle, which can be used to cancel the clip. Playback is
+    kept only a little ahead of the speaker, so cancelling stops the sound
+    quickly.
+
+    Background sources, such as music, are mixed with the clips. While the
+    Player is ducked, they are played more quietly.
+    """
+
+    EARCON = 0
+    SPEECH = 1
+    RESPONSE = 2
+
+    IDLE_TIMEOUT_S = 10
+
+    # Size of the blocks of audio written to the output, and how far ahead of
+    # the speaker the output is kept filled.
+    BLOCK_S = 0.05
+    LEAD_S = 0.1
+
+    # Gain of background sources while ducked.
+    DUCK_GAIN = 0.2
+
+    def __init__(self, output_device='default', backend=None,
+                 output_format=AudioFormat(1, 2, 16000), clip_cache_bytes=4 * 1024 * 1024):
+        """Create a Player.
+
+        - output_device: name of ALSA device (for a list, run `aplay -L`)
+        - backend: OutputBackend accepting audio in output_format
+          (default: AplayOutput for output_device)
+        - output_format: AudioFormat of the output stream
+        - clip_cache_bytes: size of the cache of WAV files for play_wav()
+        """
+        self._format = output_format
+        self.clip_cache = ClipCache(output_format, clip_cache_bytes)
+        self._backend = backend or AplayOutput(output_device, *output_format)
+        self._bytes_per_second = (output_format.channels * output_format.bytes_per_sample *
+                                  output_format.sample_rate_hz)
+        frame_bytes = output_format.channels * output_format.bytes_per_sample
+        self._block_bytes = int(self.BLOCK_S * output_format.sample_rate_hz) * frame_bytes
+        self._dtype = _SAMPLE_DTYPES[output_format.bytes_per_sample]
+
+        # Guards everything below, and the state of the handles.
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._thread = None
+        self._closing = False
+        self._queue = []  # heap of (priority, seq, handle)
+        self._current = None
+        self._sources = []
+        self._stopped_before = 0
+        self._ducked = 0
+
+        # Only used by the playback thread.
+        self._is_open = False
+        self._play_end = 0
+        # When the last audio that wasn't silence will have been played.
+        self._sound_end = 0
+        self._silence = bytes(self._block_bytes)
+
+    def play_bytes(self, audio_bytes, sample_rate, sample_width=2,
+                   priority=SPEECH, block=True):
+        """Play audio from the given bytes-like object.
+
+        audio_bytes: audio data (mono)
+        sample_rate: sample rate in Hertz (24 kHz by default)
+        sample_width: sample width in bytes (eg 2 for 16-bit audio)
+        priority: EARCON, SPEECH or RESPONSE
+        block: if True, wait until the audio has been played
+
+        Returns a PlaybackHandle.
+        """
+
+        clip_format = AudioFormat(1, sample_width, sample_rate)
+        if clip_format != self._format:
+            audio_bytes = FormatConverter(clip_format, self._format).convert(audio_bytes)
+
+        return self._play(audio_bytes, priority, block)
+
+    def play_wav(self, wav_path, priority=EARCON, block=True):
+        """Play audio from the given WAV file. The file should be mono.
+
+        The decoded audio is kept in the clip cache, so playing the same file
+        again doesn't read it from disk.
+
+        wav_path: path to wav file
+        priority: EARCON, SPEECH or RESPONSE
+        block: if True, wait until the audio has been played
+
+        Returns a PlaybackHandle.
+        """
+
+        return self._play(self.clip_cache.get(wav_path), priority, block)
+
+    def preload_wav(self, wav_path):
+        """Load a WAV file into the clip cache, ready to be played."""
+        self.clip_cache.get(wav_path)
+
+    def open_stream(self, sample_rate, sample_width=2, jitter_s=0.2, priority=RESPONSE):
+        """Return a PlaybackStream to play mono audio as it arrives.
+
+        sample_rate: sample rate in Hertz
+        sample_width: sample width in bytes (eg 2 for 16-bit audio)
+        jitter_s: seconds of audio to buffer before playback starts
+        priority: EARCON, SPEECH or RESPONSE
+        """
+        handle = self._make_handle(priority, jitter_s)
+        self._submit(handle)
+        return PlaybackStream(handle, self._converter(AudioFormat(1, sample_width, sample_rate)))
+
+    def add_source(self, sample_rate, sample_width=2, channels=1, gain=1.0, jitter_s=0.2):
+        """Return a PlaybackStream for a background source, such as music.
+
+        Background sources are mixed with the queued clips instead of waiting
+        for them, and are quieter while the Player is ducked. They aren't
+        affected by stop().
+
+        sample_rate: sample rate in Hertz
+        sample_width: sample width in bytes (eg 2 for 16-bit audio)
+        channels: number of channels
+        gain: initial gain; can be changed with PlaybackStream.set_gain()
+        jitter_s: seconds of audio to buffer before playback starts
+        """
+        handle = self._make_handle(None, jitter_s, gain)
+        with self._cond:
+            self._sources.append(handle)
+            self._start_thread()
+            self._cond.notify_all()
+        return PlaybackStream(handle, self._converter(
+            AudioFormat(channels, sample_width, sample_rate)))
+
+    def get_format(self):
+        """Return the AudioFormat of the output."""
+        return self._format
+
+    def duck(self):
+        """Play background sources more quietly until unduck() is called.
+        Calls can be nested.
+        """
+        with self._cond:
+            self._ducked += 1
+
+    def unduck(self):
+        with self._cond:
+            self._ducked = max(0, self._ducked - 1)
+
+    def stop(self):
+        """Cancel the clip that is playing, and all queued clips."""
+        with self._cond:
+            self._stopped_before = next(self._seq)
+            handles = [handle for _, _, handle in self._queue]
+            if self._current:
+                handles.append(self._current)
+            del self._queue[:]
+            for handle in handles:
+                handle.cancel()
+
+    def close(self):
+        """Stop playing, and close the output stream now."""
+        with self._cond:
+            self.stop()
+            for handle in self._sources:
+                handle.cancel()
+            self._closing = True
+            self._cond.notify_all()
+            thread, self._thread = self._thread, None
+        if thread:
+            thread.join()
+        self._closing = False
+
+    def _converter(self, stream_format):
+        if stream_format != self._format:
+            return FormatConverter(stream_format, self._format)
+        return None
+
+    def _make_handle(self, priority, jitter_s=0, gain=1.0):
+        return PlaybackHandle(priority, int(jitter_s * self._bytes_per_second), gain, self._cond)
+
+    def _play(self, data, priority, block):
+        handle = self._make_handle(priority)
+        handle._append(data)  # pylint: disable=protected-access
+        handle._end()  # pylint: disable=protected-access
+        self._submit(handle)
+        if block:
+            handle.wait()
+        return handle
+
+    def _submit(self, handle):
+        with self._cond:
+            heapq.heappush(self._queue, (handle.priority, next(self._seq), handle))
+            self._start_thread()
+            self._cond.notify_all()
+
+    def _start_thread(self):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Mix and play the audio, and close the output when idle."""
+        while True:
+            with self._cond:
+                blocks = self._next_blocks()
+            if blocks is None:
+                self._close()
+                return
+            if not blocks:
+                logger.info('closing idle audio output')
+                self._close()
+                continue
+
+            handles = [handle for handle, _, _ in blocks if handle]
+            data = self._mix(blocks) if handles else blocks[0][1]
+            try:
+                self._write(data)
+            except (Error, OSError):
+                with self._cond:
+                    for handle in handles:
+                        handle.cancel()
+                continue
+
+            self._play_end = max(self._play_end, time.monotonic()) + \
+                len(data) / self._bytes_per_second
+            if handles:
+                self._sound_end = self._play_end
+
+    def _next_blocks(self):
+        """Wait until the next block is due and return (handle, data, gain)
+        for each source with audio. Returns an empty list if the output has
+        been idle for IDLE_TIMEOUT_S, or None when closing. Until then, an
+        idle output that NEEDS_SILENCE gets a block of silence, with no
+        handle. Call with the condition held.
+        """
+        # pylint: disable=protected-access
+        while not self._closing:
+            # Stay at most LEAD_S ahead of the speaker.
+            now = time.monotonic()
+            if self._play_end - self.LEAD_S > now:
+                self._cond.wait(self._play_end - self.LEAD_S - now)
+                continue
+
+            if not self._current and self._queue:
+                _, seq, self._current = heapq.heappop(self._queue)
+                if seq < self._stopped_before:
+                    self._current.cancel()
+
+            blocks = []
+            handles = [self._current] if self._current else []
+            for handle in handles + self._sources:
+                data = handle._read(self._block_bytes)
+                traced = handle.priority is not None and handle.priority > self.EARCON
+                if data is None:
+                    if traced and handle._played and not handle._cancelled:
+                        tracing.mark('playback_end', self._play_end)
+                    handle._finish(self._play_end)
+                    if handle is self._current:
+                        self._current = None
+                    else:
+                        self._sources.remove(handle)
+                elif data:
+                    if not handle._played:
+                        handle._played = True
+                        if traced:
+                            tracing.mark('playback_start', max(self._play_end, now))
+                    gain = handle.gain
+                    if handle.priority is None and self._ducked:
+                        gain *= self.DUCK_GAIN
+                    blocks.append((handle, data, gain))
+            if blocks:
+                return blocks
+
+            if handles and not self._current:
+                # The clip has finished; start the next one.
+                continue
+
+            if self._is_open and self._backend.NEEDS_SILENCE:
+                if now >= self._sound_end + self.IDLE_TIMEOUT_S:
+                    return []
+                return [(None, self._silence, 1.0)]
+
+            idle_s = max(self._play_end, now) + self.IDLE_TIMEOUT_S - now
+            if not self._cond.wait(idle_s if self._is_open else None) and \
+                    self._is_open and time.monotonic() >= self._play_end + self.IDLE_TIMEOUT_S:
+                return []
+        return None
+
+    def _mix(self, blocks):
+        """Sum the blocks with their gains, saturating at the limits of the
+        sample type.
+        """
+        # pylint: disable=protected-access
+        if len(blocks) == 1:
+            handle, data, gain = blocks[0]
+            if gain == 1.0 and handle._last_gain in (None, 1.0):
+                handle._last_gain = gain
+                return data
+
+        mixed = np.zeros(max(len(data) for _, data, _ in blocks) // self._dtype.itemsize,
+                         dtype=np.float32)
+        for handle, data, gain in blocks:
+            samples = np.frombuffer(data, dtype=self._dtype)
+            last_gain = handle._last_gain
+            if last_gain is not None and last_gain != gain:
+                # Ramp to the new gain over the block, to avoid a click.
+                gain = np.linspace(last_gain, gain, len(samples), dtype=np.float32)
+            mixed[:len(samples)] += samples * gain
+            handle._last_gain = gain if np.isscalar(gain) else gain[-1]
+
+        limits = np.iinfo(self._dtype)
+        np.clip(mixed, limits.min, limits.max, out=mixed)
+        return memoryview(mixed.astype(self._dtype)).cast('B')
+
+    def _write(self, data):
+        """Write to the output stream, opening it if needed. If it has failed,
+        try once more with a new stream.
+        """
+        for attempt in range(2):
+            try:
+                if not self._is_open:
+                    self._backend.open()
+                    self._is_open = True
+                    self._play_end = 0
+                self._backend.write(data)
+                return
+            except (Error, OSError):
+                logger.exception('Failed to play audio')
+                self._close()
+                if attempt:
+                    raise
+
+    def _close(self):
+        if self._is_open:
+            self._is_open = False
+            try:
+                self._backend.close()
+            except (Error, OSError):
+                logger.exception('Failed to close audio output')
+
+
+class PlaybackStream(object):
+
+    """Plays audio that arrives bit by bit, for example from the network.
+
+    Audio is held back until jitter_s seconds have arrived, so that playback
+    doesn't stutter if the next bit arrives a little late. Create it with
+    Player.open_stream() or Player.add_source().
+    """
+
+    def __init__(self, handle, converter):
+        self.handle = handle
+        self._converter = converter
+
+    def write(self, data):
+        """Queue audio for playback."""
+        if self._converter:
+            data = self._converter.convert(data)
+        self.handle._append(data)  # pylint: disable=protected-access
+
+    def set_gain(self, gain):
+        self.handle.gain = gain
+
+    def close(self):
+        """Wait until all the audio has been played, or cancelled."""
+        self.handle._end()  # pylint: disable=protected-access
+        self.handle.wait()
+
+    def cancel(self):
+        self.handle.cancel()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class FlacEncoder(object):
+
+    """Encodes raw audio to a FLAC stream as it arrives, with the flac command
+    line encoder.
+
+    Encoded data is returned as soon as flac produces it, so it can be sent
+    while the user is still speaking. Small blocks keep the delay short, at a
+    small cost in compression.
+    """
+
+    BLOCK_SIZE = 1152
+
+    def __init__(self, channels, bytes_per_sample, sample_rate_hz, compression_level=5):
+        self._cmd = [
+            # Unbuffered, so frames come out as soon as they're encoded.
+            'stdbuf', '-o0',
+            'flac', '--silent', '--stdout', '--force-raw-format',
+            '--endian=little', '--sign=signed',
+            '--channels=%d' % channels,
+            '--bps=%d' % (8 * bytes_per_sample),
+            '--sample-rate=%d' % sample_rate_hz,
+            '--blocksize=%d' % self.BLOCK_SIZE,
+            '-%d' % compression_level,
+            '-',
+        ]
+        self._process = None
+        self._reader = None
+        self._lock = threading.Lock()
+        self._output = []
+
+    def open(self):
+        """Start the encoder. Raises OSError if flac isn't installed."""
+        self._output = []
+        self._process = subprocess.Popen(self._cmd, stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def encode(self, data):
+        """Encode some audio, and return the FLAC data produced so far."""
+        try:
+            self._process.stdin.write(data)
+            self._process.stdin.flush()
+        except BrokenPipeError:
+            raise Error('flac exited with %s' % self._process.poll())
+        return self._take()
+
+    def flush(self):
+        """Finish the stream, and return the rest of the FLAC data."""
+        self._process.stdin.close()
+        self._reader.join()
+        if self._process.wait():
+            raise Error('flac exited with %d' % self._process.returncode)
+        return self._take()
+
+    def close(self):
+        """Stop the encoder without finishing the stream."""
+        if self._process and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+
+    def _take(self):
+        with self._lock:
+            data, self._output = b''.join(self._output), []
+        return data
+
+    def _read(self):
+        stdout = self._process.stdout
+        while True:
+            data = stdout.read1(65536)
+            if not data:
+                stdout.close()
+                return
+            with self._lock:
+                self._output.append(data)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AudioLogFile(object):
+
+    """A WAV file being written by an AudioLogWriter."""
+
+    def __init__(self, writer, path, channels, bytes_per_sample, sample_rate_hz):
+        self.path = path
+        self.format = AudioFormat(channels, bytes_per_sample, sample_rate_hz)
+        self.dropped_bytes = 0
+        self._writer = writer
+        self._wav = None
+
+    def write(self, data):
+        """Queue audio to be written. It's dropped if the queue is full."""
+        self._writer._put(self, data)  # pylint: disable=protected-access
+
+    def close(self):
+        self._writer._put(self, None)  # pylint: disable=protected-access
+
+
+class AudioLogWriter(object):
+
+    """Writes audio logs to WAV files on a background thread, so that a slow
+    disk doesn't hold up the caller.
+
+    At most max_queued_bytes of audio wait to be written; beyond that, audio is
+    dropped rather than blocking. Files are optionally compressed to FLAC once
+    closed. The log directory is kept to max_bytes, and files older than
+    max_age_s are deleted.
+    """
+
+    LOG_EXTENSIONS = ('.wav', '.flac')
+
+    def __init__(self, log_dir, max_bytes=100 * 1024 * 1024, max_age_s=7 * 24 * 3600,
+                 compress=False, max_queued_bytes=1024 * 1024):
+        self.log_dir = log_dir
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.compress = compress
+        self.max_queued_bytes = max_queued_bytes
+        self.dropped_bytes = 0
+
+        os.makedirs(log_dir, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def open_file(self, name, channels, bytes_per_sample, sample_rate_hz):
+        """Start a new log file called name.wav, and return an AudioLogFile."""
+        path = os.path.join(self.log_dir, name + '.wav')
+        log_file = AudioLogFile(self, path, channels, bytes_per_sample, sample_rate_hz)
+        self._put(log_file, b'')
+        return log_file
+
+    def write_file(self, name, data, channels, bytes_per_sample, sample_rate_hz):
+        """Log a complete clip."""
+        log_file = self.open_file(name, channels, bytes_per_sample, sample_rate_hz)
+        log_file.write(data)
+        log_file.close()
+
+    def close(self):
+        """Write the queued audio, and stop the thread."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _put(self, log_file, data):
+        with self._cond:
+            if data and self._queued_bytes + len(data) > self.max_queued_bytes:
+                if not log_file.dropped_bytes:
+                    logger.warning('audio log is behind, dropping audio for %s', log_file.path)
+                log_file.dropped_bytes += len(data)
+                self.dropped_bytes += len(data)
+                return
+            if data:
+                data = bytes(data)
+                self._queued_bytes += len(data)
+            self._queue.append((log_file, data))
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                log_file, data = self._queue.popleft()
+                if data:
+                    self._queued_bytes -= len(data)
+
+            try:
+                self._handle(log_file, data)
+            except (OSError, wave.Error):
+                logger.exception('Failed to write audio log %s', log_file.path)
+
+    def _handle(self, log_file, data):
+        # pylint: disable=protected-access
+        if data is None:
+            if log_file._wav:
+                log_file._wav.close()
+                log_file._wav = None
+                if self.compress:
+                    self._compress(log_file.path)
+                self._apply_retention()
+        elif not data:
+            log_file._wav = wave.open(log_file.path, 'wb')
+            log_file._wav.setnchannels(log_file.format.channels)
+            log_file._wav.setsampwidth(log_file.format.bytes_per_sample)
+            log_file._wav.setframerate(log_file.format.sample_rate_hz)
+        elif log_file._wav:
+            log_file._wav.writeframes(data)
+
+    @staticmethod
+    def _compress(path):
+        try:
+            subprocess.check_call(['flac', '--silent', '--force', '--delete-input-file', path])
+        except (OSError, subprocess.CalledProcessError):
+            logger.exception('Failed to compress %s', path)
+
+    def _apply_retention(self):
+        """Delete the oldest logs until the directory is small enough, and
+        any that are too old.
+        """
+        logs = []
+        for entry in os.scandir(self.log_dir):
+            if entry.is_file() and entry.name.endswith(self.LOG_EXTENSIONS):
+                stat = entry.stat()
+                logs.append((stat.st_mtime, stat.st_size, entry.path))
+        logs.sort()
+
+        total_bytes = sum(size for _, size, _ in logs)
+        oldest = time.time() - self.max_age_s
+        for mtime, size, path in logs:
+            if total_bytes <= self.max_bytes and mtime >= oldest:
+                break
+            os.remove(path)
+            total_bytes -= size
 
 
 class WavDump(object):
@@ -204,6 +2024,103 @@ class WavDump(object):
         self._wav.close()
 
 
+_EncoderStats = collections.namedtuple(
+    '_EncoderStats', ['audio_s', 'cpu_s', 'in_bytes', 'out_bytes'])
+
+
+def benchmark_encoder(raw_path, channels=1, bytes_per_sample=2, sample_rate_hz=16000,
+                      chunk_bytes=3200):
+    """Feed a raw audio file to a FlacEncoder in chunks, as the recognizer
+    does, and measure the CPU time used by the encoder process.
+
+    The process is pinned to one core where supported, so the result shows the
+    cost on a single core of a Pi. Its affinity is restored afterwards.
+    """
+
+    with open(raw_path, 'rb') as f:
+        raw_audio = f.read()
+
+    affinity = None
+    if hasattr(os, 'sched_setaffinity'):
+        affinity = os.sched_getaffinity(0)
+        os.sched_setaffinity(0, {min(affinity)})
+
+    try:
+        children_before = os.times()
+        out_bytes = 0
+        with FlacEncoder(channels, bytes_per_sample, sample_rate_hz) as encoder:
+            for i in range(0, len(raw_audio), chunk_bytes):
+                out_bytes += len(encoder.encode(raw_audio[i:i + chunk_bytes]))
+            out_bytes += len(encoder.flush())
+        children_after = os.times()
+    finally:
+        if affinity:
+            os.sched_setaffinity(0, affinity)
+
+    cpu_s = (children_after.children_user - children_before.children_user +
+             children_after.children_system - children_before.children_system)
+    audio_s = len(raw_audio) / (channels * bytes_per_sample * sample_rate_hz)
+    return _EncoderStats(audio_s, cpu_s, len(raw_audio), out_bytes)
+
+
+_CaptureStats = collections.namedtuple(
+    '_CaptureStats', ['chunks', 'seconds', 'peak_bytes', 'gc_collections'])
+
+
+class _ChunkCounter(object):
+
+    """A processor that only counts chunks, for benchmarking."""
+
+    def __init__(self):
+        self.chunks = 0
+
+    def add_data(self, data):
+        self.chunks += 1
+
+
+def benchmark_capture(raw_path, channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+    """Run the capture loop on a pipe fed from a raw audio file, and measure
+    how much memory it allocates.
+
+    The file is loaded up front so the feeder thread allocates as little as
+    possible while the capture loop is traced.
+    """
+
+    with open(raw_path, 'rb') as f:
+        raw_audio = memoryview(f.read())
+
+    read_fd, write_fd = os.pipe()
+
+    def feed():
+        with os.fdopen(write_fd, 'wb', buffering=0) as pipe:
+            for i in range(0, len(raw_audio), 65536):
+                pipe.write(raw_audio[i:i + 65536])
+
+    recorder = Recorder(channels=channels, bytes_per_sample=bytes_per_sample,
+                        sample_rate_hz=sample_rate_hz)
+    counter = _ChunkCounter()
+    recorder.add_processor(counter)
+
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    gc_collections = gc.get_stats()[0]['collections']
+    tracemalloc.start()
+    start = time.monotonic()
+    with os.fdopen(read_fd, 'rb', buffering=0) as pipe:
+        replay = ReplayCapture(pipe, channels, bytes_per_sample, sample_rate_hz,
+                               realtime=False)
+        replay.open()
+        recorder._capture(replay)  # pylint: disable=protected-access
+    seconds = time.monotonic() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc_collections = gc.get_stats()[0]['collections'] - gc_collections
+
+    feeder.join()
+    return _CaptureStats(counter.chunks, seconds, peak_bytes, gc_collections)
+
+
 def main():
     logging.basicConfig(level=logging.INFO)
 
@@ -211,7 +2128,7 @@ def main():
     import time
 
     parser = argparse.ArgumentParser(description="Test audio wrapper")
-    parser.add_argument('action', choices=['dump', 'play'],
+    parser.add_argument('action', choices=['dump', 'play', 'bench', 'bench-flac'],
                         help='What to do with the audio')
     parser.add_argument('-I', '--input-device', default='default',
                         help='Name of the audio input device')
@@ -221,31 +2138,74 @@ def main():
                         help='Sample width in bytes')
     parser.add_argument('-r', '--rate', type=int, default=16000,
                         help='Sample rate in Hertz')
+    parser.add_argument('-b', '--backend', default='arecord',
+                        choices=sorted(CAPTURE_BACKENDS),
+                        help='Capture backend (default: arecord)')
+    parser.add_argument('--replay',
+                        help='Raw or WAV file to record from instead of the mic')
+    parser.add_argument('--fast', action='store_true',
+                        help='Replay as fast as possible instead of in real time')
     parser.add_argument('-O', '--output-device', default='default',
                         help='Name of the audio output device')
     parser.add_argument('-d', '--duration', default=2, type=float,
                         help='Dump duration in seconds (default: 2)')
-    parser.add_argument('filename', help='Path to WAV file')
+    parser.add_argument('filename', help='Path to WAV file (raw file for bench)')
     args = parser.parse_args()
 
     if args.action == 'dump':
+        if args.replay:
+            backend = ReplayCapture(args.replay, args.channels, args.bytes_per_sample,
+                                    args.rate, realtime=not args.fast)
+        else:
+            backend = make_capture_backend(args.backend, args.input_device, args.channels,
+                                           args.bytes_per_sample, args.rate)
+
         recorder = Recorder(
             input_device=args.input_device,
             channels=args.channels,
             bytes_per_sample=args.bytes_per_sample,
-            sample_rate_hz=args.rate)
+            sample_rate_hz=args.rate,
+            backend=backend)
 
         dumper = WavDump(args.filename, args.duration, args.channels,
                          args.bytes_per_sample, args.rate)
 
-        with recorder, dumper:
-            recorder.add_processor(dumper)
+        # Don't lose audio when replaying, and don't stall the mic otherwise.
+        policy = AsyncProcessor.BLOCK if args.replay else AsyncProcessor.DROP_OLDEST
+
+        with dumper, AsyncProcessor(dumper, policy=policy) as async_dumper:
+            recorder.add_processor(async_dumper)
+
+            with recorder:
+                while not dumper.is_done() and recorder.is_alive():
+                    time.sleep(0.1)
 
-            while not dumper.is_done():
-                time.sleep(0.1)
+        logger.info('dump stats: %s', async_dumper.get_stats())
 
     elif args.action == 'play':
-        Player(args.output_device).play_wav(args.filename)
+        player = Player(args.output_device)
+        player.play_wav(args.filename)
+        player.close()
+
+    elif args.action == 'bench':
+        stats = benchmark_capture(args.filename, args.channels,
+                                  args.bytes_per_sample, args.rate)
+        print('chunks: %d' % stats.chunks)
+        print('time: %.3f ms (%.1f us/chunk)' % (
+            stats.seconds * 1000, stats.seconds * 1e6 / max(stats.chunks, 1)))
+        print('peak traced memory: %d bytes' % stats.peak_bytes)
+        print('gen0 collections: %d' % stats.gc_collections)
+
+    elif args.action == 'bench-flac':
+        stats = benchmark_encoder(args.filename, args.channels,
+                                  args.bytes_per_sample, args.rate)
+        print('audio: %.1f s' % stats.audio_s)
+        print('encoder CPU: %.3f s (%.1f%% of one core in real time)' % (
+            stats.cpu_s, 100 * stats.cpu_s / max(stats.audio_s, 1e-9)))
+        print('size: %d -> %d bytes (%.1f%%)' % (
+            stats.in_bytes, stats.out_bytes, 100 * stats.out_bytes / max(stats.in_bytes, 1)))
+        print('bitrate: %.1f kbit/s' % (8 * stats.out_bytes / max(stats.audio_s, 1e-9) / 1000))
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,367 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A local stand-in for the Cloud Speech and Embedded Assistant APIs.
+
+It implements StreamingRecognize and Converse on an insecure port, and plays
+back scripted turns: interim and final transcripts, endpointer events and
+response audio. Latency, jitter, errors and throttling can be injected, so
+the request pipeline can be tested and benchmarked offline.
+
+Run it with a script, then point the recognizer at it:
+
+    python3 src/fake_speech_server.py --port 50051 --script turns.json
+    python3 src/main.py --speech-endpoint localhost:50051
+
+The script is a JSON list of turns, used in order for successive requests:
+
+    [{"transcript": "what time is it", "interim": ["what", "what time"],
+      "speech_end_s": 1.5, "response_s": 1.0}]
+"""
+
+import collections
+from concurrent import futures
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+import wave
+
+from google.cloud.grpc.speech.v1beta1 import cloud_speech_pb2 as cloud_speech
+from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
+import grpc
+import numpy as np
+
+logger = logging.getLogger('fake_speech_server')
+
+AUDIO_SAMPLE_SIZE = 2  # bytes per sample
+AUDIO_SAMPLE_RATE_HZ = 16000
+AUDIO_BYTES_PER_S = AUDIO_SAMPLE_SIZE * AUDIO_SAMPLE_RATE_HZ
+
+# Size of the response audio messages.
+RESPONSE_CHUNK_BYTES = 3200
+
+Turn = collections.namedtuple('Turn', [
+    # Final transcript, and interim transcripts sent while audio arrives. The
+    # final transcript can be a list of segments, each sent as a separate
+    # final result, as when single_utterance is off.
+    'transcript', 'interim',
+    # Stability of the interim results, from 0 to 1.
+    'stability',
+    # Seconds of audio after which the end of the utterance is reported.
+    'speech_end_s',
+    # Response audio for Converse: a WAV file, or else a tone this long.
+    'response_wav', 'response_s',
+    'dialog_follow_on',
+    # gRPC status code name, eg 'UNAVAILABLE', to fail with after
+    # error_after_s seconds of audio.
+    'error', 'error_after_s',
+])
+
+_TURN_DEFAULTS = {
+    'transcript': '', 'interim': (), 'stability': 0.5, 'speech_end_s': 1.0,
+    'response_wav': None, 'response_s': 0, 'dialog_follow_on': False,
+    'error': None, 'error_after_s': 0,
+}
+
+
+def make_turn(**kwargs):
+    """Return a Turn, with defaults for the fields that aren't given."""
+    fields = dict(_TURN_DEFAULTS)
+    fields.update(kwargs)
+    return Turn(**fields)
+
+
+def load_script(path):
+    """Load a list of turns from a JSON file."""
+    with open(path) as f:
+        return [make_turn(**turn) for turn in json.load(f)]
+
+
+ServerStats = collections.namedtuple('ServerStats', [
+    'calls', 'errors', 'throttled', 'audio_bytes'])
+
+
+class FakeSpeechServer(object):
+
+    """Serves the scripted turns.
+
+    Args:
+        turns: list of Turns, used in order and then repeated
+        port: port to listen on, or 0 for any free port
+        latency_s: delay before the first response after the end of speech
+        jitter_s: random extra delay of up to this long before each response
+        error_rate: probability of failing a call with UNAVAILABLE
+        uplink_bytes_per_s: if set, read request audio no faster than this
+        max_concurrent: if set, fail calls beyond this many with
+            RESOURCE_EXHAUSTED
+        seed: seed for the random delays and errors
+    """
+
+    def __init__(self, turns=None, port=0, latency_s=0, jitter_s=0, error_rate=0,
+                 uplink_bytes_per_s=None, max_concurrent=None, seed=None):
+        self._turns = turns or [make_turn(transcript='what time is it', response_s=1.0)]
+        self._port = port
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.error_rate = error_rate
+        self.uplink_bytes_per_s = uplink_bytes_per_s
+        self.max_concurrent = max_concurrent
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._next_turn = 0
+        self._active = 0
+        self._calls = 0
+        self._errors = 0
+        self._throttled = 0
+        self._audio_bytes = 0
+        self._server = None
+        self.target = None
+
+    def start(self):
+        """Start serving, and return the 'host:port' target."""
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=16))
+        cloud_speech.add_SpeechServicer_to_server(_SpeechServicer(self), self._server)
+        embedded_assistant_pb2.add_EmbeddedAssistantServicer_to_server(
+            _AssistantServicer(self), self._server)
+        port = self._server.add_insecure_port('localhost:%d' % self._port)
+        self._server.start()
+        self.target = 'localhost:%d' % port
+        logger.info('serving on %s', self.target)
+        return self.target
+
+    def stop(self):
+        if self._server:
+            self._server.stop(0)
+            self._server = None
+
+    def get_stats(self):
+        with self._lock:
+            return ServerStats(self._calls, self._errors, self._throttled, self._audio_bytes)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _session(self, requests, get_audio, context):
+        """Play one turn, reading audio with get_audio(request). Yields
+        events: ('start_of_speech',), ('interim', text, stability), ('end_of_speech',),
+        ('final', text, dialog_follow_on) and ('audio', data), after the
+        configured delays.
+        Injected errors are set on the context, ending the session.
+        """
+        with self._lock:
+            self._calls += 1
+            turn = self._turns[self._next_turn % len(self._turns)]
+            self._next_turn += 1
+            throttled = self.max_concurrent is not None and self._active >= self.max_concurrent
+            if throttled:
+                self._throttled += 1
+            else:
+                self._active += 1
+
+        if throttled:
+            self._fail(context, grpc.StatusCode.RESOURCE_EXHAUSTED, 'too many concurrent calls')
+            return
+
+        try:
+            if self._random.random() < self.error_rate:
+                self._fail(context, grpc.StatusCode.UNAVAILABLE, 'injected error')
+                return
+
+            yield from self._play_turn(turn, requests, get_audio, context)
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _play_turn(self, turn, requests, get_audio, context):
+        next(requests, None)  # config
+
+        received = 0
+        start = time.monotonic()
+        interim = list(turn.interim)
+        speech_started = False
+        speech_ended = False
+
+        for request in requests:
+            data = get_audio(request)
+            received += len(data)
+            with self._lock:
+                self._audio_bytes += len(data)
+            received_s = received / AUDIO_BYTES_PER_S
+
+            if self.uplink_bytes_per_s:
+                # Don't read the next request until this one "arrives".
+                delay = start + received / self.uplink_bytes_per_s - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if turn.error and received_s >= turn.error_after_s:
+                self._fail(context, getattr(grpc.StatusCode, turn.error), 'injected error')
+                return
+
+            if speech_ended:
+                continue
+
+            if not speech_started:
+                speech_started = True
+                yield self._delayed(('start_of_speech',))
+
+            # Spread the interim results over the speech.
+            n_interim = len(turn.interim)
+            while interim and received_s >= turn.speech_end_s * (
+                    n_interim - len(interim) + 1) / (n_interim + 1):
+                yield self._delayed(('interim', interim.pop(0), turn.stability))
+
+            if received_s >= turn.speech_end_s:
+                speech_ended = True
+                yield self._delayed(('end_of_speech',))
+
+        if turn.error:
+            self._fail(context, getattr(grpc.StatusCode, turn.error), 'injected error')
+            return
+
+        if not speech_ended:
+            yield self._delayed(('end_of_speech',))
+
+        time.sleep(self.latency_s)
+        yield self._delayed(('final', turn.transcript, turn.dialog_follow_on))
+
+        response_audio = self._response_audio(turn)
+        for i in range(0, len(response_audio), RESPONSE_CHUNK_BYTES):
+            yield self._delayed(('audio', response_audio[i:i + RESPONSE_CHUNK_BYTES]))
+
+    def _delayed(self, event):
+        if self.jitter_s:
+            time.sleep(self._random.uniform(0, self.jitter_s))
+        return event
+
+    def _fail(self, context, code, details):
+        logger.info('failing call with %s', code)
+        with self._lock:
+            self._errors += 1
+        context.set_code(code)
+        context.set_details(details)
+
+    @staticmethod
+    def _response_audio(turn):
+        if turn.response_wav:
+            with wave.open(turn.response_wav) as wav:
+                return wav.readframes(wav.getnframes())
+
+        t = np.arange(int(turn.response_s * AUDIO_SAMPLE_RATE_HZ)) / AUDIO_SAMPLE_RATE_HZ
+        return np.rint(4096 * np.sin(2 * np.pi * 440 * t)).astype('<i2').tobytes()
+
+
+class _SpeechServicer(cloud_speech.SpeechServicer):
+
+    """Serves StreamingRecognize from the FakeSpeechServer's turns."""
+
+    def __init__(self, server):
+        self._server = server
+
+    def StreamingRecognize(self, request_iterator, context):
+        response = cloud_speech.StreamingRecognizeResponse
+        for event in self._server._session(  # pylint: disable=protected-access
+                request_iterator, lambda request: request.audio_content, context):
+            if event[0] == 'start_of_speech':
+                yield response(endpointer_type=response.START_OF_SPEECH)
+            elif event[0] == 'end_of_speech':
+                yield response(endpointer_type=response.END_OF_SPEECH)
+                yield response(endpointer_type=response.END_OF_AUDIO)
+            elif event[0] == 'interim':
+                yield response(results=[_result(event[1], is_final=False, stability=event[2])])
+            elif event[0] == 'final':
+                segments = event[1] if isinstance(event[1], list) else [event[1]]
+                for segment in segments:
+                    yield response(results=[_result(segment, is_final=True)])
+
+
+def _result(transcript, is_final, stability=0):
+    return cloud_speech.StreamingRecognitionResult(
+        alternatives=[cloud_speech.SpeechRecognitionAlternative(
+            transcript=transcript, confidence=0.9)],
+        is_final=is_final,
+        stability=stability)
+
+
+class _AssistantServicer(embedded_assistant_pb2.EmbeddedAssistantServicer):
+
+    """Serves Converse from the FakeSpeechServer's turns."""
+
+    def __init__(self, server):
+        self._server = server
+        self._conversations = itertools.count(1)
+
+    def Converse(self, request_iterator, context):
+        response = embedded_assistant_pb2.ConverseResponse
+        result = embedded_assistant_pb2.ConverseResult
+        for event in self._server._session(  # pylint: disable=protected-access
+                request_iterator, lambda request: request.audio_in, context):
+            if event[0] == 'end_of_speech':
+                yield response(event_type=response.END_OF_UTTERANCE)
+            elif event[0] == 'final':
+                yield response(result=result(
+                    spoken_request_text=(' '.join(event[1]) if isinstance(event[1], list)
+                                         else event[1]),
+                    conversation_state=b'fake-%d' % next(self._conversations),
+                    microphone_mode=(result.DIALOG_FOLLOW_ON if event[2]
+                                     else result.CLOSE_MICROPHONE)))
+            elif event[0] == 'audio':
+                yield response(audio_out=embedded_assistant_pb2.AudioOut(audio_data=event[1]))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=50051, help='Port to listen on')
+    parser.add_argument('--script', help='JSON file with the turns to play')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds before the result after the end of speech')
+    parser.add_argument('--jitter', type=float, default=0,
+                        help='Random extra seconds before each response')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Fraction of calls to fail with UNAVAILABLE')
+    parser.add_argument('--uplink', type=float,
+                        help='Limit the upload to this many bytes per second')
+    parser.add_argument('--max-concurrent', type=int,
+                        help='Fail calls beyond this many with RESOURCE_EXHAUSTED')
+    args = parser.parse_args()
+
+    turns = load_script(args.script) if args.script else None
+    server = FakeSpeechServer(
+        turns, args.port, latency_s=args.latency, jitter_s=args.jitter,
+        error_rate=args.error_rate, uplink_bytes_per_s=args.uplink,
+        max_concurrent=args.max_concurrent)
+
+    with server:
+        try:
+            while True:
+                time.sleep(10)
+                logger.info('%s', server.get_stats())
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
@@ -16,19 +16,25 @@
 """Main recognizer loop: wait for a trigger then perform and handle
 recognition."""
 
+from concurrent import futures
+import json
 import logging
 import os
+import signal
 import sys
 import threading
 import time
 
 import configargparse
-from googlesamples.assistant import auth_helpers
+import google.oauth2.credentials
+import google_auth_oauthlib.flow
 
 import audio
 import action
+import actionbase
 import i18n
 import speech
+import tracing
 import tts
 
 # =============================================================================
@@ -63,13 +69,41 @@ OLD_SERVICE_CREDENTIALS = os.path.expanduser('~/credentials.json')
 ASSISTANT_CREDENTIALS = os.path.join(VR_CACHE_DIR, 'assistant_credentials.json')
 ASSISTANT_OAUTH_SCOPE = 'https://www.googleapis.com/auth/assistant-sdk-prototype'
 
+# The format of the audio sent to the speech APIs.
+SPEECH_FORMAT = audio.AudioFormat(
+    channels=1, bytes_per_sample=speech.AUDIO_SAMPLE_SIZE,
+    sample_rate_hz=speech.AUDIO_SAMPLE_RATE_HZ)
+
+
+def load_credentials(path, scopes):
+    """Load OAuth credentials saved by save_credentials()."""
+    with open(path) as f:
+        data = json.load(f)
+    return google.oauth2.credentials.Credentials(
+        token=data['access_token'], refresh_token=data['refresh_token'],
+        token_uri=data['token_uri'], client_id=data['client_id'],
+        client_secret=data['client_secret'], scopes=scopes)
+
+
+def save_credentials(path, credentials):
+    """Save OAuth credentials, in the format used by earlier versions of the
+    Assistant SDK.
+    """
+    with open(path, 'w') as f:
+        json.dump({
+            'access_token': credentials.token,
+            'refresh_token': credentials.refresh_token,
+            'token_uri': credentials.token_uri,
+            'client_id': credentials.client_id,
+            'client_secret': credentials.client_secret,
+        }, f)
+
 
 def try_to_get_credentials(client_secrets):
     """Try to get credentials, or print an error and quit on failure."""
 
     if os.path.exists(ASSISTANT_CREDENTIALS):
-        return auth_helpers.load_credentials(
-            ASSISTANT_CREDENTIALS, scopes=[ASSISTANT_OAUTH_SCOPE])
+        return load_credentials(ASSISTANT_CREDENTIALS, scopes=[ASSISTANT_OAUTH_SCOPE])
 
     if not os.path.exists(VR_CACHE_DIR):
         os.mkdir(VR_CACHE_DIR)
@@ -92,9 +126,13 @@ See the "Turn on the Assistant API" section of the Voice Recognizer
 User's Guide for more info.""")
         sys.exit(1)
 
-    credentials = auth_helpers.credentials_flow_interactive(
+    flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
         client_secrets, scopes=[ASSISTANT_OAUTH_SCOPE])
-    auth_helpers.save_credentials(ASSISTANT_CREDENTIALS, credentials)
+    if os.getenv('DISPLAY'):
+        credentials = flow.run_local_server()
+    else:
+        credentials = flow.run_console()
+    save_credentials(ASSISTANT_CREDENTIALS, credentials)
     logging.info('OAuth credentials initialized: %s', ASSISTANT_CREDENTIALS)
     return credentials
 
@@ -120,6 +158,29 @@ def main():
                         help='Name of the audio input device')
     parser.add_argument('-O', '--output-device', default='default',
                         help='Name of the audio output device')
+    parser.add_argument('--playback-backend', default='aplay',
+                        choices=sorted(audio.OUTPUT_BACKENDS),
+                        help='How to play to the audio output device: with an '
+                        'aplay subprocess, or in-process with libasound')
+    parser.add_argument('--output-rate', type=int, default=48000,
+                        help='Sample rate to play at. Speech and sounds are '
+                        'converted to it, so music is played at full quality '
+                        '(default: 48000)')
+    parser.add_argument('--output-channels', type=int, default=2,
+                        help='Number of channels to play (default: 2)')
+    parser.add_argument('--input-channels', type=int, default=1,
+                        help='Number of channels to record (default: 1)')
+    parser.add_argument('--input-rate', type=int, default=speech.AUDIO_SAMPLE_RATE_HZ,
+                        help='Sample rate to record at. Audio is converted to '
+                        'the rate needed for speech recognition (default: %d)' %
+                        speech.AUDIO_SAMPLE_RATE_HZ)
+    parser.add_argument('--capture-backend', default='arecord',
+                        choices=sorted(audio.CAPTURE_BACKENDS),
+                        help='How to read from the audio input device: with an '
+                        'arecord subprocess, or in-process with libasound')
+    parser.add_argument('--capture-max-failures', type=int, default=5,
+                        help='Number of times in a row the audio input can fail '
+                        'to restart before the service exits (default: 5)')
     parser.add_argument('-T', '--trigger', default='gpio',
                         choices=['clap', 'gpio', 'ok-google'], help='Trigger to use')
     parser.add_argument('--cloud-speech', action='store_true',
@@ -131,7 +192,15 @@ def main():
     parser.add_argument('-p', '--pid-file',
                         help='File containing our process id for monitoring')
     parser.add_argument('--audio-logging', action='store_true',
-                        help='Log all requests and responses to WAV files in /tmp')
+                        help='Log all requests and responses to audio files')
+    parser.add_argument('--audio-log-dir', default=speech.AUDIO_LOG_DIR,
+                        help='Directory for audio logs (default: %s)' % speech.AUDIO_LOG_DIR)
+    parser.add_argument('--audio-log-max-mb', type=float, default=100,
+                        help='Delete the oldest audio logs beyond this size (default: 100)')
+    parser.add_argument('--audio-log-max-days', type=float, default=7,
+                        help='Delete audio logs older than this (default: 7)')
+    parser.add_argument('--audio-log-flac', action='store_true',
+                        help='Compress audio logs to FLAC (needs the flac encoder)')
     parser.add_argument('--assistant-always-responds', action='store_true',
                         help='Play Assistant responses for local actions.'
                         ' You should make sure that you have IFTTT applets for'
@@ -144,21 +213,73 @@ def main():
                         default=os.path.expanduser('~/cloud_speech.json'),
                         help='Path to service account credentials for the '
                         'Cloud Speech API')
+    parser.add_argument('--speech-endpoint',
+                        help='host:port of a server to use instead of the '
+                        'Google APIs, without credentials (for testing with '
+                        'fake_speech_server.py)')
     parser.add_argument('--trigger-sound', default=None,
                         help='Sound when trigger is activated (WAV format)')
+    parser.add_argument('--audio-encoding', default='LINEAR16', choices=speech.ENCODINGS,
+                        help='Encoding of the audio sent for recognition. FLAC '
+                        'needs the flac encoder, and uses less bandwidth '
+                        '(default: LINEAR16)')
+    parser.add_argument('--min-audio-request', type=float, default=0,
+                        help='Seconds of audio to wait for before sending a '
+                        'request (default: 0, send each chunk as it arrives)')
+    parser.add_argument('--max-audio-request', type=float, default=0.5,
+                        help='Maximum seconds of queued audio to join into one '
+                        'request when the network lags (default: 0.5)')
+    parser.add_argument('--local-endpointer', action='store_true',
+                        help='Detect the end of speech locally, instead of '
+                        'waiting for the server to')
+    parser.add_argument('--trailing-silence', type=float, default=0.8,
+                        help='With --local-endpointer, seconds of silence that '
+                        'end the request (default: 0.8)')
+    parser.add_argument('--max-utterance', type=float, default=15,
+                        help='With --local-endpointer, maximum seconds of audio '
+                        'to send (default: 15)')
+    parser.add_argument('--skip-leading-silence', action='store_true',
+                        help="With --local-endpointer, don't send the silence "
+                        'before the speech starts')
+    parser.add_argument('--interim-commands', action='store_true',
+                        help='With --cloud-speech, prepare local commands from '
+                        'interim transcripts, before the final transcript, '
+                        'eg change the volume straight away')
+    parser.add_argument('--fuzzy-commands', action='store_true',
+                        help='Also run local commands whose keywords were '
+                        'misheard, eg "lites on" for "lights on". With the '
+                        'Assistant, only when it has no response')
+    parser.add_argument('--fuzzy-min-score', type=float, default=0.8,
+                        help='With --fuzzy-commands, how close a misheard '
+                        'keyword must be, from 0 to 1 (default: 0.8)')
+    parser.add_argument('--preroll', type=float, default=0.3,
+                        help='Seconds of audio from before the trigger to send '
+                        'with the request (default: 0.3)')
 
     args = parser.parse_args()
 
     create_pid_file(args.pid_file)
+
+    # Log the latency of each stage with: kill -USR1 <pid>
+    signal.signal(signal.SIGUSR1, lambda *args: tracing.log_stats())
     i18n.set_language_code(args.language, gettext_install=True)
 
-    player = audio.Player(args.output_device)
+    output_format = audio.AudioFormat(
+        args.output_channels, speech.AUDIO_SAMPLE_SIZE, args.output_rate)
+    player = audio.Player(
+        args.output_device,
+        backend=audio.make_output_backend(args.playback_backend, args.output_device,
+                                          *output_format),
+        output_format=output_format)
 
     if args.cloud_speech:
         credentials_file = os.path.expanduser(args.cloud_speech_secrets)
         if not os.path.exists(credentials_file) and os.path.exists(OLD_SERVICE_CREDENTIALS):
             credentials_file = OLD_SERVICE_CREDENTIALS
-        recognizer = speech.CloudSpeechRequest(credentials_file)
+        recognizer = speech.CloudSpeechRequest(credentials_file, args.speech_endpoint)
+    elif args.speech_endpoint:
+        credentials = None
+        recognizer = speech.AssistantSpeechRequest(None, args.speech_endpoint)
     else:
         credentials = try_to_get_credentials(
             os.path.expanduser(args.assistant_secrets))
@@ -175,10 +296,16 @@ def main():
             sys.exit(1)
         do_assistant_library(args, credentials, player, status_ui)
     else:
+        backend = audio.make_capture_backend(
+            args.capture_backend, args.input_device, channels=args.input_channels,
+            bytes_per_sample=speech.AUDIO_SAMPLE_SIZE,
+            sample_rate_hz=args.input_rate)
         recorder = audio.Recorder(
-            input_device=args.input_device, channels=1,
+            input_device=args.input_device, channels=args.input_channels,
             bytes_per_sample=speech.AUDIO_SAMPLE_SIZE,
-            sample_rate_hz=speech.AUDIO_SAMPLE_RATE_HZ)
+            sample_rate_hz=args.input_rate,
+            history_s=args.preroll, backend=backend,
+            max_failures=args.capture_max_failures)
         with recorder:
             do_recognition(args, recorder, recognizer, player, status_ui)
 
@@ -202,7 +329,9 @@ installed with:
         sys.exit(1)
 
     say = tts.create_say(player)
-    actor = action.make_actor(say)
+    actor = action.make_actor(say, player)
+    if args.fuzzy_commands:
+        actor.set_fuzzy_matching(args.fuzzy_min_score)
 
     def process_event(event):
         logging.info(event)
@@ -219,10 +348,12 @@ installed with:
             status_ui.status('thinking')
 
         elif event.type == EventType.ON_RECOGNIZING_SPEECH_FINISHED and \
-                event.args and actor.can_handle(event.args['text']):
+                event.args and actor.can_handle(event.args['text'], fuzzy=False):
             if not args.assistant_always_responds:
                 assistant.stop_conversation()
-            actor.handle(event.args['text'])
+            # Run the action on a worker, so that events are still handled
+            # while it plays media.
+            actor.dispatch(event.args['text'], executor, fuzzy=False)
 
         elif event.type == EventType.ON_CONVERSATION_TURN_FINISHED:
             status_ui.status('ready')
@@ -231,22 +362,34 @@ installed with:
                 event.args and event.args['is_fatal']:
             sys.exit(1)
 
-    with Assistant(credentials) as assistant:
-        for event in assistant.start():
-            process_event(event)
+    executor = actionbase.ActionExecutor()
+    try:
+        with Assistant(credentials) as assistant:
+            for event in assistant.start():
+                process_event(event)
+    finally:
+        executor.shutdown(wait=False)
 
 
 def do_recognition(args, recorder, recognizer, player, status_ui):
     """Configure and run the recognizer."""
     say = tts.create_say(player)
 
-    actor = action.make_actor(say)
+    actor = action.make_actor(say, player)
+    if args.fuzzy_commands:
+        actor.set_fuzzy_matching(args.fuzzy_min_score)
 
     if args.cloud_speech:
         action.add_commands_just_for_cloud_speech_api(actor, say)
 
     recognizer.add_phrases(actor)
-    recognizer.set_audio_logging_enabled(args.audio_logging)
+    recognizer.set_audio_logging_enabled(
+        args.audio_logging, args.audio_log_dir,
+        max_bytes=int(args.audio_log_max_mb * 1024 * 1024),
+        max_age_s=args.audio_log_max_days * 24 * 3600,
+        compress=args.audio_log_flac)
+    recognizer.set_audio_encoding(args.audio_encoding)
+    recognizer.set_audio_request_size(args.min_audio_request, args.max_audio_request)
 
     if args.trigger == 'gpio':
         import triggers.gpio
@@ -260,9 +403,17 @@ def do_recognition(args, recorder, recognizer, player, status_ui):
         logger.error("Unknown trigger '%s'", args.trigger)
         return
 
+    vad = None
+    if args.local_endpointer:
+        vad = audio.VadEndpointer(
+            recognizer, SPEECH_FORMAT.sample_rate_hz,
+            trailing_silence_s=args.trailing_silence, max_utterance_s=args.max_utterance,
+            skip_leading_silence=args.skip_leading_silence)
+
     mic_recognizer = SyncMicRecognizer(
         actor, recognizer, recorder, player, say, triggerer, status_ui,
-        args.assistant_always_responds)
+        args.assistant_always_responds, args.preroll, vad,
+        args.cloud_speech and args.interim_commands, actionbase.ActionExecutor())
 
     with mic_recognizer:
         if sys.stdout.isatty():
@@ -295,6 +446,7 @@ class StatusUi(object):
 
         if trigger_sound and os.path.exists(os.path.expanduser(trigger_sound)):
             self.trigger_sound = os.path.expanduser(trigger_sound)
+            self.player.preload_wav(self.trigger_sound)
         else:
             if trigger_sound:
                 logger.warning(
@@ -323,24 +475,57 @@ class SyncMicRecognizer(object):
     # pylint: disable=too-many-instance-attributes
 
     def __init__(self, actor, recognizer, recorder, player, say, triggerer,
-                 status_ui, assistant_always_responds):
+                 status_ui, assistant_always_responds, preroll_s=0, vad=None,
+                 interim_commands=False, executor=None):
         self.actor = actor
         self.player = player
         self.recognizer = recognizer
         self.recognizer.set_endpointer_cb(self.endpointer_cb)
+        self.recognizer.set_response_audio_cb(self.response_audio_cb)
         self.recorder = recorder
         self.say = say
         self.triggerer = triggerer
         self.triggerer.set_callback(self.recognize)
         self.status_ui = status_ui
         self.assistant_always_responds = assistant_always_responds
+        self.preroll_s = preroll_s
+
+        # Local commands run on the executor, if given, so that long ones,
+        # like playing music, don't hold up the next request.
+        self.executor = executor
+
+        # With a local endpointer, the audio goes through it to the recognizer.
+        self.vad = vad
+        self._processor = recognizer
+        if vad:
+            vad.set_end_cb(self._local_end)
+            self._processor = vad
+        self._listening = False
+
+        # Interim transcripts are passed to the actor in order, off the
+        # recognizer's event loop.
+        self._interim_executor = None
+        if interim_commands:
+            self._interim_executor = futures.ThreadPoolExecutor(max_workers=1)
+            self.recognizer.set_interim_cb(self.interim_cb)
 
         self.running = False
 
         self.recognizer_event = threading.Event()
 
+        # Stream playing the current response, and whether it was skipped.
+        self._response_stream = None
+        self._response_skipped = False
+
+        # A trigger while the response is playing stops it and starts a new
+        # request.
+        self._playing_response = False
+        self._barge_in = False
+        self._ducked = False
+
     def __enter__(self):
         self.running = True
+        self.recognizer.prewarm()
         threading.Thread(target=self._recognize).start()
         self.triggerer.start()
         self.status_ui.status('ready')
@@ -348,23 +533,83 @@ class SyncMicRecognizer(object):
     def __exit__(self, *args):
         self.running = False
         self.recognizer_event.set()
+        if self.executor:
+            self.executor.shutdown(wait=False)
 
         self.recognizer.end_audio()
 
-    def recognize(self):
+    def recognize(self, preroll_s=None):
         if self.recognizer_event.is_set():
-            # Duplicate trigger (eg multiple button presses)
+            if self._playing_response and not self._barge_in:
+                logger.info('stopping response for new request')
+                self._barge_in = True
+                self.player.stop()
+            # Otherwise, duplicate trigger (eg multiple button presses)
             return
 
-        self.status_ui.status('listening')
+        # Start passing audio to the recognizer before the trigger sound is
+        # played, as that blocks. The recorder only keeps the pre-roll, so
+        # this keeps both it and the speech during the trigger sound.
+        tracing.start_trace()
+        if preroll_s is None:
+            preroll_s = self.preroll_s
         self.recognizer.reset()
-        self.recorder.add_processor(self.recognizer)
+        if self.vad:
+            self.vad.reset()
+        self._listening = True
+        self.recorder.add_processor(self._processor, since=time.monotonic() - preroll_s,
+                                    fmt=SPEECH_FORMAT)
+
+        # Make sure the connection is up before the audio is sent.
+        self.recognizer.prewarm()
+
+        # Keep media quiet until the response has arrived.
+        if not self._ducked:
+            self._ducked = True
+            self.player.duck()
+
+        self.status_ui.status('listening')
         # Tell recognizer to run
         self.recognizer_event.set()
 
     def endpointer_cb(self):
-        self.recorder.del_processor(self.recognizer)
-        self.status_ui.status('thinking')
+        # Called by the local endpointer and the server, whichever is first.
+        tracing.mark('endpointer')
+        if self._listening:
+            self._listening = False
+            self.recorder.del_processor(self._processor)
+            self.status_ui.status('thinking')
+
+    def _local_end(self):
+        self.recognizer.end_audio()
+        self.endpointer_cb()
+
+    def interim_cb(self, transcript, stability):
+        self._interim_executor.submit(self.actor.handle_interim, transcript, stability)
+
+    def _wait_for_interim(self):
+        if self._interim_executor:
+            self._interim_executor.submit(lambda: None).result()
+
+    def response_audio_cb(self, transcript, audio_data):
+        """Play the response as it arrives, unless it's for a local command."""
+        if self._response_skipped:
+            return
+
+        if not self._response_stream:
+            # The Assistant has an answer, so misheard keywords aren't
+            # guessed.
+            if transcript and not self.assistant_always_responds and \
+                    self.actor.can_handle(transcript, fuzzy=False):
+                self._response_skipped = True
+                return
+
+            logger.info('Playing response audio...')
+            self._response_stream = self.player.open_stream(
+                speech.AUDIO_SAMPLE_RATE_HZ, speech.AUDIO_SAMPLE_SIZE)
+            self._start_response()
+
+        self._response_stream.write(audio_data)
 
     def _recognize(self):
         while self.running:
@@ -373,38 +618,98 @@ class SyncMicRecognizer(object):
                 break
 
             logger.info('recognizing...')
+            self._response_stream = None
+            self._response_skipped = False
             try:
                 self._handle_result(self.recognizer.do_request())
             except speech.Error:
                 logger.exception('Unexpected error')
                 self.say(_('Unexpected error. Try again or check the logs.'))
-
+            # Undo any action prepared for an interim command that wasn't
+            # confirmed.
+            self._wait_for_interim()
+            self.actor.rollback()
+            # The response has been played, so later marks, eg from a local
+            # action, aren't counted for the next interaction.
+            tracing.end_trace()
+            logger.info('channel: %s', self.recognizer.get_channel_stats())
+            logger.info('credentials: %s', self.recognizer.get_credential_stats())
+
+            self._playing_response = False
             self.recognizer_event.clear()
-            if self.recognizer.dialog_follow_on:
+            if self._barge_in:
+                self._barge_in = False
                 self.recognize()
+            elif self.recognizer.dialog_follow_on:
+                # No pre-roll, as that would be the end of the response.
+                self.recognize(preroll_s=0)
             else:
+                self._unduck()
                 self.triggerer.start()
                 self.status_ui.status('ready')
 
+    def _unduck(self):
+        if self._ducked:
+            self._ducked = False
+            self.player.unduck()
+
     def _handle_result(self, result):
-        if result.transcript and self.actor.handle(result.transcript):
+        stream, self._response_stream = self._response_stream, None
+        self._wait_for_interim()
+
+        # Media stays ducked until the response has been played. A local
+        # command without a response may start media, so it's unducked first.
+        respond = result.response_audio and self.assistant_always_responds
+        # Misheard keywords are only guessed if the Assistant has no answer.
+        fuzzy = not result.response_audio
+        if (not respond and result.transcript and
+                self.actor.can_handle(result.transcript, fuzzy)):
+            if stream:
+                # The response started playing before the transcript arrived,
+                # but the local command replaces it.
+                stream.cancel()
+                stream = None
+            self._unduck()
+
+        if result.transcript and self._handle_command(result.transcript, fuzzy):
             logger.info('handled local command: %s', result.transcript)
-            if result.response_audio and self.assistant_always_responds:
-                self._play_assistant_response(result.response_audio)
+            if respond:
+                self._play_assistant_response(result.response_audio, stream)
         elif result.response_audio:
-            self._play_assistant_response(result.response_audio)
+            self._play_assistant_response(result.response_audio, stream)
         elif result.transcript:
             logger.warning('%r was not handled', result.transcript)
         else:
             logger.warning('no command recognized')
 
-    def _play_assistant_response(self, audio_bytes):
+    def _handle_command(self, command, fuzzy=True):
+        tracing.mark('actor_dispatch')
+        if self.executor:
+            # The executor times the action.
+            return self.actor.dispatch(command, self.executor, fuzzy) is not None
+        with tracing.span('actor_handle'):
+            return self.actor.handle(command, fuzzy)
+
+    def _start_response(self):
+        """Listen for triggers while the response plays, to allow barge-in."""
+        self._playing_response = True
+        self.triggerer.start()
+
+    def _play_assistant_response(self, audio_bytes, stream=None):
+        """Play the response, or wait for the stream that is already playing it
+        to finish.
+        """
         bytes_per_sample = speech.AUDIO_SAMPLE_SIZE
         sample_rate_hz = speech.AUDIO_SAMPLE_RATE_HZ
         logger.info('Playing %.4f seconds of audio...',
                     len(audio_bytes) / (bytes_per_sample * sample_rate_hz))
-        self.player.play_bytes(audio_bytes, sample_width=bytes_per_sample,
-                               sample_rate=sample_rate_hz)
+        if stream:
+            stream.close()
+        else:
+            self._start_response()
+            self.player.play_bytes(audio_bytes, sample_width=bytes_per_sample,
+                                   sample_rate=sample_rate_hz,
+                                   priority=audio.Player.RESPONSE)
 
 
 if __name__ == '__main__':
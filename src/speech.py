@@ -15,11 +15,17 @@
 """Classes for speech interaction."""
 
 from abc import abstractmethod
+import asyncio
+import atexit
 import collections
+import datetime
 import logging
 import os
 import tempfile
+import threading
+import time
 import wave
+import weakref
 
 import google.auth
 import google.auth.exceptions
@@ -29,9 +35,13 @@ from google.cloud.grpc.speech.v1beta1 import cloud_speech_pb2 as cloud_speech
 from google.rpc import code_pb2 as error_code
 from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
 import grpc
+import grpc.aio
+import requests
 from six.moves import queue
 
+import audio
 import i18n
+import tracing
 
 logger = logging.getLogger('speech')
 
@@ -39,6 +49,13 @@ AUDIO_SAMPLE_SIZE = 2  # bytes per sample
 AUDIO_SAMPLE_RATE_HZ = 16000
 
 
+# Audio encodings for requests. FLAC is about half the size of LINEAR16, for
+# slow uplinks.
+ENCODINGS = ('LINEAR16', 'FLAC')
+
+# Default directory for audio logs.
+AUDIO_LOG_DIR = os.path.join(tempfile.gettempdir(), 'voice-recognizer-audio')
+
 _Result = collections.namedtuple('_Result', ['transcript', 'response_audio'])
 
 
@@ -46,49 +63,422 @@ class Error(Exception):
     pass
 
 
+CredentialStats = collections.namedtuple('CredentialStats', [
+    'expiry', 'refreshes', 'failures', 'last_refresh_s', 'max_refresh_s'])
+
+
+class _CredentialManager(object):
+
+    """Refreshes OAuth tokens in the background before they expire, so that
+    requests don't wait for a refresh inside gRPC's auth plugin.
+
+    Refreshes share a pooled HTTP session, instead of making a new one each
+    time.
+    """
+
+    REFRESH_MARGIN_S = 300
+    RETRY_DELAY_S = 5
+    MAX_RETRY_DELAY_S = 300
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.request = google.auth.transport.requests.Request(requests.Session())
+
+        self._lock = threading.Lock()
+        self._thread = None
+        self._refreshes = 0
+        self._failures = 0
+        self._last_refresh_s = None
+        self._max_refresh_s = 0
+
+    def start(self):
+        """Start refreshing in the background."""
+        with self._lock:
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def refresh(self):
+        """Refresh the token now. Raises GoogleAuthError on failure."""
+        start = time.monotonic()
+        try:
+            self.credentials.refresh(self.request)
+        except google.auth.exceptions.GoogleAuthError:
+            with self._lock:
+                self._failures += 1
+            raise
+
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._refreshes += 1
+            self._last_refresh_s = elapsed
+            self._max_refresh_s = max(self._max_refresh_s, elapsed)
+        logger.info('refreshed credentials in %.3f s', elapsed)
+
+    def get_stats(self):
+        """Return a CredentialStats with the token expiry, and the number and
+        duration of refreshes.
+        """
+        with self._lock:
+            return CredentialStats(self.credentials.expiry, self._refreshes, self._failures,
+                                   self._last_refresh_s, self._max_refresh_s)
+
+    def _seconds_until_refresh(self):
+        """Return how long until the token should be refreshed, or None if it
+        never expires.
+        """
+        expiry = self.credentials.expiry
+        if expiry is None:
+            return None if self.credentials.valid else 0
+        remaining = (expiry - datetime.datetime.utcnow()).total_seconds()
+        return max(0, remaining - self.REFRESH_MARGIN_S)
+
+    def _run(self):
+        retry_delay = self.RETRY_DELAY_S
+        while True:
+            delay = self._seconds_until_refresh()
+            if delay is None:
+                return
+            time.sleep(delay)
+
+            try:
+                self.refresh()
+                retry_delay = self.RETRY_DELAY_S
+            except google.auth.exceptions.GoogleAuthError:
+                logger.exception('Failed to refresh credentials, retrying in %d s', retry_delay)
+                time.sleep(retry_delay)
+                retry_delay = min(2 * retry_delay, self.MAX_RETRY_DELAY_S)
+
+
+_loop = None
+_loop_thread = None
+_loop_lock = threading.Lock()
+
+# The channel factories of all requests, to close their channels at shutdown.
+_factories = weakref.WeakSet()
+
+SHUTDOWN_TIMEOUT_S = 5
+
+
+def _get_loop():
+    """Return the event loop that runs requests for the synchronous API,
+    starting it on a daemon thread the first time.
+    """
+    global _loop, _loop_thread  # pylint: disable=global-statement
+    with _loop_lock:
+        if not _loop:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, daemon=True)
+            _loop_thread.start()
+            atexit.register(shutdown)
+        return _loop
+
+
+def shutdown():
+    """Close the channels, cancel the requests that are still running on the
+    shared event loop, and stop it. This is called at exit.
+    """
+    global _loop, _loop_thread  # pylint: disable=global-statement
+    with _loop_lock:
+        loop, _loop = _loop, None
+        thread, _loop_thread = _loop_thread, None
+    if not loop:
+        return
+
+    atexit.unregister(shutdown)
+    try:
+        asyncio.run_coroutine_threadsafe(_close_loop(), loop).result(SHUTDOWN_TIMEOUT_S)
+    except Exception:  # pylint: disable=broad-except
+        logger.exception('Failed to shut down the event loop cleanly')
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(SHUTDOWN_TIMEOUT_S)
+    if not thread.is_alive():
+        loop.close()
+
+
+async def _close_loop():
+    for factory in list(_factories):
+        await factory.reset()
+
+    tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.get_event_loop().shutdown_asyncgens()
+
+
+def _submit(coro):
+    """Run a coroutine on the shared loop, and return a concurrent Future."""
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def _run_sync(coro):
+    """Run a coroutine on the shared loop, and wait for its result. Don't call
+    this from a coroutine.
+    """
+    future = _submit(coro)
+    try:
+        return future.result()
+    except BaseException:
+        future.cancel()
+        raise
+
+
+def _set_done(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class _AudioQueue(object):
+
+    """A queue of audio chunks. Any thread can put() chunks, and a coroutine
+    can wait for them with get().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = collections.deque()
+        self._waiter = None
+
+    def put(self, item):
+        with self._lock:
+            self._items.append(item)
+            waiter, self._waiter = self._waiter, None
+        if waiter:
+            loop, future = waiter
+            loop.call_soon_threadsafe(_set_done, future)
+
+    def get_nowait(self):
+        """Return the next chunk. Raises queue.Empty if there is none."""
+        with self._lock:
+            if not self._items:
+                raise queue.Empty
+            return self._items.popleft()
+
+    async def get(self):
+        """Wait for the next chunk and return it."""
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._items.popleft()
+                loop = asyncio.get_event_loop()
+                future = loop.create_future()
+                self._waiter = (loop, future)
+            await future
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+ChannelStats = collections.namedtuple('ChannelStats', [
+    'state', 'connection_age_s', 'channels_created', 'reconnects'])
+
+
 class _ChannelFactory(object):
 
-    """Creates gRPC channels with a given configuration."""
+    """Keeps a long-lived grpc.aio channel to the API host, so that requests
+    don't pay for DNS, TCP and TLS setup.
 
-    def __init__(self, api_host, credentials):
-        self._api_host = api_host
-        self._credentials = credentials
+    Keepalive pings stop idle connections from being dropped silently. If the
+    connection fails anyway, gRPC reconnects, and a channel whose request
+    failed with UNAVAILABLE is replaced by reset().
 
-        self._checked = False
+    The channel belongs to the event loop that created it. If it's used from
+    another loop, a new channel is made there.
 
-    def make_channel(self):
-        """Creates a secure channel."""
+    If an endpoint is given, such as 'localhost:50051' for the fake server in
+    fake_speech_server.py, an insecure channel to it is used instead, and no
+    credentials are needed.
+    """
+
+    KEEPALIVE_OPTIONS = [
+        ('grpc.keepalive_time_ms', 30000),
+        ('grpc.keepalive_timeout_ms', 10000),
+        ('grpc.keepalive_permit_without_calls', 1),
+        ('grpc.http2.max_pings_without_data', 0),
+    ]
 
-        request = google.auth.transport.requests.Request()
-        target = self._api_host + ':443'
+    PREWARM_TIMEOUT_S = 10
+    CLOSE_GRACE_S = 0.05
 
-        if not self._checked:
-            # Refresh now, to catch any errors early. Otherwise, they'll be
-            # raised and swallowed somewhere inside gRPC.
-            self._credentials.refresh(request)
-            self._checked = True
+    def __init__(self, api_host, credentials, endpoint=None):
+        self._api_host = endpoint or api_host
+        self._endpoint = endpoint
+        self.credential_manager = None if endpoint else _CredentialManager(credentials)
+        _factories.add(self)
+
+        self._checked = False
 
-        return google.auth.transport.grpc.secure_authorized_channel(
-            self._credentials, request, target)
+        # Guards the stats, which are read from other threads.
+        self._lock = threading.Lock()
+        self._channel = None
+        self._channel_loop = None
+        self._watcher = None
+        self._state = None
+        self._connected_at = None
+        self._was_connected = False
+        self._channels_created = 0
+        self._reconnects = 0
+
+    async def make_channel(self):
+        """Returns the secure channel, creating it if needed."""
+        loop = asyncio.get_event_loop()
+        if self._channel and self._channel_loop is not loop:
+            logger.info('channel to %s is used from another event loop', self._api_host)
+            self._discard_channel()
+
+        if not self._channel:
+            if not self._endpoint and not self._checked:
+                # Refresh now, to catch any errors early. Otherwise, they'll
+                # be raised and swallowed somewhere inside gRPC. After that,
+                # the token is refreshed in the background.
+                manager = self.credential_manager
+                await loop.run_in_executor(None, manager.refresh)
+                manager.start()
+                self._checked = True
+
+            # Another request may have made one while this one waited.
+            if not self._channel:
+                self._channel = self._create_channel()
+                self._channel_loop = loop
+                self._watcher = loop.create_task(self._watch(self._channel))
+        return self._channel
+
+    async def prewarm(self):
+        """Connect, if not connected already."""
+        try:
+            channel = await self.make_channel()
+        except google.auth.exceptions.GoogleAuthError:
+            logger.exception('Failed to prewarm channel to %s', self._api_host)
+            return
+
+        try:
+            await asyncio.wait_for(channel.channel_ready(), self.PREWARM_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            logger.warning('channel to %s is not ready', self._api_host)
+
+    async def reset(self):
+        """Close the channel, so that the next request makes a new one."""
+        watcher = self._watcher
+        channel = self._discard_channel()
+        if channel:
+            await self._close(channel, watcher)
+
+    def get_stats(self):
+        """Return a ChannelStats with the connectivity state, how long the
+        connection has been up, and how often channels were created and
+        reconnected.
+        """
+        with self._lock:
+            age = self._connected_at and time.monotonic() - self._connected_at
+            return ChannelStats(self._state, age, self._channels_created, self._reconnects)
+
+    def _discard_channel(self):
+        """Forget the channel. A channel of another loop is closed there.
+        Returns the channel of this loop, if any, for the caller to close.
+        """
+        channel, self._channel = self._channel, None
+        loop, self._channel_loop = self._channel_loop, None
+        watcher, self._watcher = self._watcher, None
+        with self._lock:
+            self._state = None
+            self._connected_at = None
+
+        if not channel:
+            return None
+        if loop is asyncio.get_event_loop():
+            return channel
+        if not loop.is_closed():
+            asyncio.run_coroutine_threadsafe(self._close(channel, watcher), loop)
+        return None
+
+    async def _close(self, channel, watcher):
+        watcher.cancel()
+        await asyncio.gather(watcher, return_exceptions=True)
+        await channel.close()
+        # gRPC's poller thread delivers the last completions of the channel
+        # shortly after. Let them arrive, in case the loop is about to be
+        # closed.
+        await asyncio.sleep(self.CLOSE_GRACE_S)
+        logger.info('closed channel to %s', self._api_host)
+
+    def _create_channel(self):
+        with self._lock:
+            self._channels_created += 1
+
+        if self._endpoint:
+            return grpc.aio.insecure_channel(self._endpoint, options=self.KEEPALIVE_OPTIONS)
+
+        manager = self.credential_manager
+        call_credentials = grpc.metadata_call_credentials(
+            google.auth.transport.grpc.AuthMetadataPlugin(manager.credentials, manager.request))
+        channel_credentials = grpc.composite_channel_credentials(
+            grpc.ssl_channel_credentials(), call_credentials)
+        return grpc.aio.secure_channel(self._api_host + ':443', channel_credentials,
+                                       options=self.KEEPALIVE_OPTIONS)
+
+    async def _watch(self, channel):
+        # An idle channel only connects when asked to.
+        state = channel.get_state(try_to_connect=True)
+        while state != grpc.ChannelConnectivity.SHUTDOWN:
+            self._on_state_change(state)
+            await channel.wait_for_state_change(state)
+            state = channel.get_state()
+
+    def _on_state_change(self, state):
+        with self._lock:
+            if state == self._state:
+                return
+            if state == grpc.ChannelConnectivity.READY:
+                if self._was_connected:
+                    self._reconnects += 1
+                self._was_connected = True
+                self._connected_at = time.monotonic()
+            else:
+                self._connected_at = None
+            self._state = state
+        logger.info('channel to %s is %s', self._api_host, state.name)
 
 
 class GenericSpeechRequest(object):
 
-    """Common base class for Cloud Speech and Assistant APIs."""
+    """Common base class for Cloud Speech and Assistant APIs.
+
+    Requests are made with grpc.aio: do_request_async() is a coroutine, and
+    do_request() runs it on a shared event loop thread. Audio can be added
+    from any thread.
+    """
 
     # TODO(rodrigoq): Refactor audio logging.
     # pylint: disable=attribute-defined-outside-init,too-many-instance-attributes
 
     DEADLINE_SECS = 185
 
-    def __init__(self, api_host, credentials):
+    # Default limit on the audio joined into one request.
+    MAX_REQUEST_S = 0.5
+
+    def __init__(self, api_host, credentials, endpoint=None):
         self.dialog_follow_on = False
-        self._audio_queue = queue.Queue()
+        self._audio_queue = _AudioQueue()
         self._phrases = []
-        self._channel_factory = _ChannelFactory(api_host, credentials)
+        self._phrases_version = 0
+        self._cached_config = None
+        self._cached_config_key = None
+        self._min_request_bytes = 0
+        self._max_request_bytes = int(
+            self.MAX_REQUEST_S * AUDIO_SAMPLE_SIZE * AUDIO_SAMPLE_RATE_HZ)
+        self._channel_factory = _ChannelFactory(api_host, credentials, endpoint)
         self._endpointer_cb = None
+        self._interim_cb = None
+        self._response_audio_cb = None
         self._audio_logging_enabled = False
-        self._request_log_wav = None
+        self._audio_log = None
+        self._request_log = None
+
+        self._audio_encoding = 'LINEAR16'
+        self._encoding = 'LINEAR16'
+        self._encoder = None
 
     def add_phrases(self, phrases):
         """Makes the recognition more likely to recognize the given phrase(s).
@@ -97,32 +487,104 @@ class GenericSpeechRequest(object):
         """
 
         self._phrases.extend(phrases.get_phrases())
+        self._phrases_version += 1
 
     def set_endpointer_cb(self, cb):
         """Callback to invoke on end of speech."""
         self._endpointer_cb = cb
 
-    def set_audio_logging_enabled(self, audio_logging_enabled=True):
+    def set_interim_cb(self, cb):
+        """Callback to invoke with interim transcripts, as cb(transcript,
+        stability), while the user is still speaking. Only the Cloud Speech API
+        sends interim results.
+        """
+        self._interim_cb = cb
+
+    def set_response_audio_cb(self, cb):
+        """Callback to invoke with each chunk of response audio, as it arrives.
+
+        It's called as cb(transcript, audio_data), where transcript is the
+        transcript received so far or None. The response audio is still
+        returned by do_request().
+        """
+        self._response_audio_cb = cb
+
+    def set_audio_encoding(self, encoding):
+        """Set the encoding of the audio sent to the server: one of ENCODINGS."""
+        if encoding not in ENCODINGS:
+            raise ValueError('unknown encoding: %s' % encoding)
+        self._audio_encoding = encoding
+
+    def set_audio_request_size(self, min_s=None, max_s=None):
+        """Set the amount of audio per request, in seconds. Each request waits
+        for at least min_s of audio, and takes up to max_s if more is queued,
+        which happens when the network lags.
+        """
+        bytes_per_s = AUDIO_SAMPLE_SIZE * AUDIO_SAMPLE_RATE_HZ
+        if min_s is not None:
+            self._min_request_bytes = int(min_s * bytes_per_s)
+        if max_s is not None:
+            self._max_request_bytes = int(max_s * bytes_per_s)
+        self._max_request_bytes = max(self._min_request_bytes, self._max_request_bytes)
+
+    def set_audio_logging_enabled(self, audio_logging_enabled=True, log_dir=None,
+                                  max_bytes=100 * 1024 * 1024, max_age_s=7 * 24 * 3600,
+                                  compress=False):
+        """Log request and response audio to WAV or FLAC files in log_dir
+        (default: AUDIO_LOG_DIR). The files are written in the background,
+        and the oldest are deleted to keep within max_bytes and max_age_s.
+        """
+        if self._audio_log:
+            self._audio_log.close()
+            self._audio_log = None
+
         self._audio_logging_enabled = audio_logging_enabled
 
         if audio_logging_enabled:
-            self._audio_log_dir = tempfile.mkdtemp()
+            self._audio_log = audio.AudioLogWriter(
+                log_dir or AUDIO_LOG_DIR, max_bytes, max_age_s, compress)
             self._audio_log_ix = 0
 
-    def reset(self):
-        while True:
-            try:
-                self._audio_queue.get(False)
-            except queue.Empty:
-                return
+    def prewarm(self):
+        """Connect to the API host in the background, so that the next request
+        can start sending audio straight away.
+        """
+        _submit(self._channel_factory.prewarm())
 
+    async def prewarm_async(self):
+        """Connect to the API host from the running event loop."""
+        await self._channel_factory.prewarm()
+
+    def close(self):
+        """Close the connection to the API host. The next request opens a
+        new one.
+        """
+        _run_sync(self._channel_factory.reset())
+
+    async def close_async(self):
+        """Close the connection from the running event loop. Callers that run
+        their own loop should call this before the loop is closed.
+        """
+        await self._channel_factory.reset()
+
+    def get_channel_stats(self):
+        return self._channel_factory.get_stats()
+
+    def get_credential_stats(self):
+        manager = self._channel_factory.credential_manager
+        return manager and manager.get_stats()
+
+    def reset(self):
+        self._audio_queue.clear()
         self.dialog_follow_on = False
 
     def add_data(self, data):
-        self._audio_queue.put(data)
+        tracing.mark('first_audio_queued')
+        # The recorder reuses its buffers, so copy the data before queueing it.
+        self._audio_queue.put(bytes(data))
 
     def end_audio(self):
-        self.add_data(None)
+        self._audio_queue.put(None)
 
     def _get_speech_context(self):
         """Return a SpeechContext instance to bias recognition towards certain
@@ -154,22 +616,97 @@ class GenericSpeechRequest(object):
         """
         return
 
-    def _request_stream(self):
+    def _choose_encoding(self):
+        """Pick the encoding for the next request, and start the encoder."""
+        encoding = self._audio_encoding
+        if self._encoder:
+            self._encoder.close()
+            self._encoder = None
+        if encoding == 'FLAC':
+            encoder = audio.FlacEncoder(1, AUDIO_SAMPLE_SIZE, AUDIO_SAMPLE_RATE_HZ)
+            try:
+                encoder.open()
+                self._encoder = encoder
+            except OSError:
+                logger.exception('Failed to start FLAC encoder, sending LINEAR16')
+                encoding = 'LINEAR16'
+
+        if encoding != self._encoding:
+            logger.info('audio encoding: %s', encoding)
+        self._encoding = encoding
+
+    async def _request_stream(self):
         """Yields a config request followed by requests constructed from the
         audio queue.
-        """
-        yield self._create_config_request()
 
-        while True:
-            data = self._audio_queue.get()
+        Queued chunks are coalesced into larger requests when the network
+        lags. The audio is encoded, if needed, off the event loop.
+        """
+        yield self._get_config_request()
 
+        loop = asyncio.get_event_loop()
+        encoder = self._encoder
+        try:
+            end = False
+            while not end:
+                data, end = await self._next_audio()
+
+                if data:
+                    if self._request_log:
+                        self._request_log.write(data)
+                    if encoder:
+                        data = await loop.run_in_executor(None, encoder.encode, data)
+                if end and encoder:
+                    # Send the end of the encoded stream.
+                    tail = await loop.run_in_executor(None, encoder.flush)
+                    data = data + tail if data else tail
+
+                if data:
+                    tracing.mark('first_request_sent')
+                    yield self._create_audio_request(data)
+        except audio.Error:
+            logger.exception('FLAC encoder failed')
+        finally:
+            if encoder:
+                encoder.close()
+
+    async def _next_audio(self):
+        """Wait for audio from the queue, and return (data, end), where end is
+        True if the end of the audio has been reached.
+
+        Chunks are joined until there are at least min_request_bytes, and any
+        more that are already queued are added, up to max_request_bytes.
+        """
+        chunks = []
+        size = 0
+        while size < self._max_request_bytes:
+            if not chunks or size < self._min_request_bytes:
+                data = await self._audio_queue.get()
+            else:
+                try:
+                    data = self._audio_queue.get_nowait()
+                except queue.Empty:
+                    break
             if not data:
-                return
+                return b''.join(chunks), True
+            chunks.append(data)
+            size += len(data)
 
-            if self._request_log_wav:
-                self._request_log_wav.writeframes(data)
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks), False
+
+    def _get_config_request(self):
+        """Return the config request, which is only rebuilt when the settings
+        it depends on change.
+        """
+        key = self._config_key()
+        if key != self._cached_config_key:
+            self._cached_config = self._create_config_request()
+            self._cached_config_key = key
+        return self._cached_config
 
-            yield self._create_audio_request(data)
+    def _config_key(self):
+        """Return the settings that the config request depends on."""
+        return (self._encoding, self._phrases_version)
 
     @abstractmethod
     def _create_response_stream(self, service, request_stream, deadline):
@@ -200,8 +737,9 @@ class GenericSpeechRequest(object):
         if self._endpointer_cb:
             self._endpointer_cb()
 
-    def _handle_response_stream(self, response_stream):
-        for resp in response_stream:
+    async def _handle_response_stream(self, response_stream):
+        async for resp in response_stream:
+            tracing.mark('first_response')
             if resp.error.code != error_code.OK:
                 self._end_audio_request()
                 raise Error('Server error: ' + resp.error.message)
@@ -215,23 +753,19 @@ class GenericSpeechRequest(object):
         return self._finish_request() or ''
 
     def _start_logging_request(self):
-        """Open a WAV file to log the request audio."""
+        """Open a file to log the request audio."""
         self._audio_log_ix += 1
-        request_filename = '%s/request.%03d.wav' % (
-            self._audio_log_dir, self._audio_log_ix)
-        logger.info('Writing request to %s', request_filename)
-
-        self._request_log_wav = wave.open(request_filename, 'w')
-
-        self._request_log_wav.setnchannels(1)
-        self._request_log_wav.setsampwidth(AUDIO_SAMPLE_SIZE)
-        self._request_log_wav.setframerate(AUDIO_SAMPLE_RATE_HZ)
+        self._audio_log_name = '%s-%03d' % (time.strftime('%Y%m%d-%H%M%S'), self._audio_log_ix)
+        self._request_log = self._audio_log.open_file(
+            self._audio_log_name + '.request', 1, AUDIO_SAMPLE_SIZE, AUDIO_SAMPLE_RATE_HZ)
+        logger.info('Writing request to %s', self._request_log.path)
 
     def _finish_request(self):
         """Called after the final response is received."""
 
-        if self._request_log_wav:
-            self._request_log_wav.close()
+        if self._request_log:
+            self._request_log.close()
+            self._request_log = None
 
         return _Result(None, None)
 
@@ -247,8 +781,15 @@ class GenericSpeechRequest(object):
 
         Raises speech.Error on error.
         """
+        return _run_sync(self.do_request_async())
+
+    async def do_request_async(self):
+        """The coroutine version of do_request(), for callers that run their
+        own event loop.
+        """
         try:
-            service = self._make_service(self._channel_factory.make_channel())
+            service = self._make_service(await self._channel_factory.make_channel())
+            self._choose_encoding()
 
             response_stream = self._create_response_stream(
                 service, self._request_stream(), self.DEADLINE_SECS)
@@ -256,12 +797,18 @@ class GenericSpeechRequest(object):
             if self._audio_logging_enabled:
                 self._start_logging_request()
 
-            return self._handle_response_stream(response_stream)
-        except (
-                google.auth.exceptions.GoogleAuthError,
-                grpc.RpcError,
-        ) as exc:
+            return await self._handle_response_stream(response_stream)
+        except grpc.RpcError as exc:
+            if (isinstance(exc, grpc.aio.AioRpcError) and
+                    exc.code() == grpc.StatusCode.UNAVAILABLE):
+                await self._channel_factory.reset()
             raise Error('Exception in speech request') from exc
+        except google.auth.exceptions.GoogleAuthError as exc:
+            raise Error('Exception in speech request') from exc
+        finally:
+            # If the call ended before the audio did, end the request stream,
+            # so gRPC's task that reads it finishes.
+            self.end_audio()
 
 
 class CloudSpeechRequest(GenericSpeechRequest):
@@ -270,35 +817,49 @@ class CloudSpeechRequest(GenericSpeechRequest):
 
     Args:
         credentials_file: path to service account credentials JSON file
+        endpoint: host:port of a server to use instead of the Cloud Speech
+            API, without credentials (eg fake_speech_server.py)
     """
 
     SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
 
-    def __init__(self, credentials_file):
-        os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_file
-        credentials, _ = google.auth.default(scopes=[self.SCOPE])
+    def __init__(self, credentials_file, endpoint=None):
+        credentials = None
+        if not endpoint:
+            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_file
+            credentials, _ = google.auth.default(scopes=[self.SCOPE])
 
-        super().__init__('speech.googleapis.com', credentials)
+        super().__init__('speech.googleapis.com', credentials, endpoint)
 
         self.language_code = i18n.get_language_code()
 
+        # Stop at the first pause. Batch transcription turns this off to
+        # transcribe whole files.
+        self.single_utterance = True
+
         if not hasattr(cloud_speech, 'StreamingRecognizeRequest'):
             raise ValueError("cloud_speech_pb2.py doesn't have StreamingRecognizeRequest.")
 
-        self._transcript = None
+        # The final transcripts received. There can be several when
+        # single_utterance is off.
+        self._transcripts = []
 
     def reset(self):
         super().reset()
-        self._transcript = None
+        self._transcripts = []
 
     def _make_service(self, channel):
         return cloud_speech.SpeechStub(channel)
 
+    def _config_key(self):
+        return super()._config_key() + (
+            self.language_code, self.single_utterance, self._interim_cb is not None)
+
     def _create_config_request(self):
         recognition_config = cloud_speech.RecognitionConfig(
             # There are a bunch of config options you can specify. See
             # https://goo.gl/KPZn97 for the full list.
-            encoding='LINEAR16',  # raw 16-bit signed LE samples
+            encoding=self._encoding,  # LINEAR16 is raw 16-bit signed LE samples
             sample_rate=AUDIO_SAMPLE_RATE_HZ,
             # For a list of supported languages see:
             # https://cloud.google.com/speech/docs/languages.
@@ -307,7 +868,9 @@ class CloudSpeechRequest(GenericSpeechRequest):
         )
         streaming_config = cloud_speech.StreamingRecognitionConfig(
             config=recognition_config,
-            single_utterance=True,  # TODO(rodrigoq): find a way to handle pauses
+            # TODO(rodrigoq): find a way to handle pauses
+            single_utterance=self.single_utterance,
+            interim_results=self._interim_cb is not None,
         )
 
         return cloud_speech.StreamingRecognizeRequest(
@@ -331,40 +894,63 @@ class CloudSpeechRequest(GenericSpeechRequest):
         return resp.endpointer_type == END_OF_AUDIO
 
     def _handle_response(self, resp):
-        """Store the last transcript we received."""
-        if resp.results:
-            self._transcript = ' '.join(
-                result.alternatives[0].transcript for result in resp.results)
-            logger.info('transcript: %s', self._transcript)
+        """Collect the final transcripts we receive, and pass interim ones on
+        to the interim callback.
+        """
+        if not resp.results:
+            return
+
+        interim = []
+        for result in resp.results:
+            if result.is_final:
+                tracing.mark('final_transcript')
+                logger.info('transcript: %s', result.alternatives[0].transcript)
+                self._transcripts.append(result.alternatives[0].transcript)
+            else:
+                interim.append(result)
+
+        if interim and self._interim_cb:
+            transcript = ' '.join(result.alternatives[0].transcript for result in resp.results)
+            stability = min(result.stability for result in interim)
+            logger.info('interim transcript: %s (stability %.2f)', transcript, stability)
+            self._interim_cb(transcript, stability)
 
     def _finish_request(self):
         super()._finish_request()
-        return _Result(self._transcript, None)
+        transcript = ' '.join(t.strip() for t in self._transcripts) if self._transcripts else None
+        return _Result(transcript, None)
 
 
 class AssistantSpeechRequest(GenericSpeechRequest):
 
-    """A request to the Assistant API, which returns audio and text."""
+    """A request to the Assistant API, which returns audio and text.
 
-    def __init__(self, credentials):
+    If an endpoint (host:port) is given, it's used instead of the Assistant
+    API, without credentials.
+    """
+
+    def __init__(self, credentials, endpoint=None):
 
-        super().__init__('embeddedassistant.googleapis.com', credentials)
+        super().__init__('embeddedassistant.googleapis.com', credentials, endpoint)
 
         self._conversation_state = None
-        self._response_audio = b''
+        self._response_audio = []
         self._transcript = None
 
     def reset(self):
         super().reset()
-        self._response_audio = b''
+        self._response_audio = []
         self._transcript = None
 
     def _make_service(self, channel):
         return embedded_assistant_pb2.EmbeddedAssistantStub(channel)
 
+    def _config_key(self):
+        return super()._config_key() + (self._conversation_state,)
+
     def _create_config_request(self):
         audio_in_config = embedded_assistant_pb2.AudioInConfig(
-            encoding='LINEAR16',
+            encoding=self._encoding,
             sample_rate_hertz=AUDIO_SAMPLE_RATE_HZ,
         )
         audio_out_config = embedded_assistant_pb2.AudioOutConfig(
@@ -398,14 +984,19 @@ class AssistantSpeechRequest(GenericSpeechRequest):
 
     def _handle_response(self, resp):
         """Accumulate audio and text from the remote end. It will be handled
-        in _finish_request().
+        in _finish_request(). Audio is also passed on to the response audio
+        callback as it arrives.
         """
 
         if resp.result.spoken_request_text:
+            tracing.mark('final_transcript')
             logger.info('transcript: %s', resp.result.spoken_request_text)
             self._transcript = resp.result.spoken_request_text
 
-        self._response_audio += resp.audio_out.audio_data
+        if resp.audio_out.audio_data:
+            self._response_audio.append(resp.audio_out.audio_data)
+            if self._response_audio_cb:
+                self._response_audio_cb(self._transcript, resp.audio_out.audio_data)
 
         if resp.result.conversation_state:
             self._conversation_state = resp.result.conversation_state
@@ -418,44 +1009,163 @@ class AssistantSpeechRequest(GenericSpeechRequest):
     def _finish_request(self):
         super()._finish_request()
 
-        if self._response_audio and self._audio_logging_enabled:
-            self._log_audio_out(self._response_audio)
+        response_audio = b''.join(self._response_audio)
+        if response_audio and self._audio_logging_enabled:
+            self._log_audio_out(response_audio)
 
-        return _Result(self._transcript, self._response_audio)
+        return _Result(self._transcript, response_audio)
 
     def _log_audio_out(self, frames):
-        response_filename = '%s/response.%03d.wav' % (
-            self._audio_log_dir, self._audio_log_ix)
-        logger.info('Writing response to %s', response_filename)
+        logger.info('Writing response to %s', self._audio_log_name + '.response')
+        self._audio_log.write_file(self._audio_log_name + '.response', frames,
+                                   1, AUDIO_SAMPLE_SIZE, AUDIO_SAMPLE_RATE_HZ)
 
-        response_wav = wave.open(response_filename, 'w')
-        response_wav.setnchannels(1)
-        response_wav.setsampwidth(AUDIO_SAMPLE_SIZE)
-        response_wav.setframerate(AUDIO_SAMPLE_RATE_HZ)
-        response_wav.writeframes(frames)
-        response_wav.close()
 
-if __name__ == '__main__':
+def _read_audio_file(path):
+    """Return the audio in a WAV or raw file as 16-bit mono at
+    AUDIO_SAMPLE_RATE_HZ. Raw files must already be in that format.
+    """
+    if not path.endswith('.wav'):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    with wave.open(path) as wav:
+        wav_format = audio.AudioFormat(
+            wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+        data = wav.readframes(wav.getnframes())
+
+    speech_format = audio.AudioFormat(1, AUDIO_SAMPLE_SIZE, AUDIO_SAMPLE_RATE_HZ)
+    if wav_format != speech_format:
+        data = bytes(audio.FormatConverter(wav_format, speech_format).convert(data))
+    return data
+
+
+def find_audio_files(paths, manifest=None):
+    """Expand directories to the WAV and raw files in them, and add the paths
+    listed in a manifest file.
+    """
+    if manifest:
+        with open(manifest) as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip()]
+
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in sorted(os.walk(path)):
+                for name in sorted(files):
+                    if name.endswith(('.wav', '.raw')):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def transcribe_batch(paths, make_request, concurrency=4, chunk_bytes=3200):
+    """Transcribe audio files with up to concurrency streaming requests at a
+    time, sharing one channel. Yields a dict for each file, in the order they
+    finish, with the transcript, the audio length and the request latency, or
+    the error.
+
+    make_request: returns a new CloudSpeechRequest or AssistantSpeechRequest
+    """
+    from concurrent import futures
+    # pylint: disable=protected-access
+
+    # Each request object handles one request at a time, so keep one per
+    # worker, all using the channel of the first.
+    requests_pool = queue.Queue()
+    channel_factory = None
+    for _ in range(concurrency):
+        request = make_request()
+        channel_factory = channel_factory or request._channel_factory
+        request._channel_factory = channel_factory
+        requests_pool.put(request)
+
+    def transcribe(path):
+        result = {'file': path}
+        request = requests_pool.get()
+        try:
+            data = _read_audio_file(path)
+            result['audio_s'] = len(data) / (AUDIO_SAMPLE_SIZE * AUDIO_SAMPLE_RATE_HZ)
+
+            request.reset()
+            for i in range(0, len(data), chunk_bytes):
+                request.add_data(data[i:i + chunk_bytes])
+            request.end_audio()
+
+            start = time.monotonic()
+            response = request.do_request()
+            result['latency_s'] = round(time.monotonic() - start, 3)
+            result['transcript'] = response.transcript
+        except (Error, OSError, EOFError, wave.Error) as exc:
+            result['error'] = str(exc)
+        finally:
+            requests_pool.put(request)
+        return result
+
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = [executor.submit(transcribe, path) for path in paths]
+        for future in futures.as_completed(pending):
+            yield future.result()
+
+
+def main():
     logging.basicConfig(level=logging.INFO)
 
-    # for testing: use audio from a file
     import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument('file', nargs='?', default='test_speech.raw')
+    import json
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description='Transcribe WAV or raw (16-bit mono 16 kHz) audio files, '
+        'and write the results as JSON lines')
+    parser.add_argument('paths', nargs='*', default=['test_speech.raw'],
+                        help='Audio files, or directories of them')
+    parser.add_argument('-m', '--manifest', help='File listing audio files, one per line')
+    parser.add_argument('-j', '--jobs', type=int, default=4,
+                        help='Number of requests to run at once (default: 4)')
+    parser.add_argument('-o', '--output', help='File to write the results to (default: stdout)')
+    parser.add_argument('--credentials', help='Service account credentials for the Cloud '
+                        'Speech API (default: ~/cloud_speech.json)')
+    parser.add_argument('--endpoint', help='host:port of a server to use instead of the '
+                        'Cloud Speech API, without credentials')
+    parser.add_argument('--encoding', default='LINEAR16', choices=ENCODINGS,
+                        help='Encoding of the audio sent (default: LINEAR16)')
     args = parser.parse_args()
 
-    if os.path.exists('/home/pi/credentials.json'):
-        # Legacy fallback: old location of credentials.
-        req = CloudSpeechRequest('/home/pi/credentials.json')
-    else:
-        req = CloudSpeechRequest('/home/pi/cloud_speech.json')
+    credentials_file = args.credentials
+    if not credentials_file and not args.endpoint:
+        if os.path.exists('/home/pi/credentials.json'):
+            # Legacy fallback: old location of credentials.
+            credentials_file = '/home/pi/credentials.json'
+        else:
+            credentials_file = os.path.expanduser('~/cloud_speech.json')
+
+    def make_request():
+        request = CloudSpeechRequest(credentials_file, args.endpoint)
+        request.single_utterance = False
+        request.set_audio_encoding(args.encoding)
+        return request
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    files = 0
+    errors = 0
+    audio_s = 0
+    start = time.monotonic()
+    try:
+        for result in transcribe_batch(find_audio_files(args.paths, args.manifest),
+                                       make_request, args.jobs):
+            files += 1
+            errors += 'error' in result
+            audio_s += result.get('audio_s', 0)
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if args.output:
+            output.close()
+
+    elapsed = time.monotonic() - start
+    logger.info('%d files (%d errors), %.1f s of audio in %.1f s: %.1fx real time',
+                files, errors, audio_s, elapsed, audio_s / max(elapsed, 1e-9))
 
-    with open(args.file, 'rb') as f:
-        while True:
-            chunk = f.read(64000)
-            if not chunk:
-                break
-            req.add_data(chunk)
-    req.end_audio()
 
-    print('down response:', req.do_request())
+if __name__ == '__main__':
+    main()
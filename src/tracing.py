@@ -0,0 +1,251 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Lightweight latency tracing for interactions.
+
+An interaction starts with start_trace() when the trigger fires, and ends
+with end_trace() once its response has been played. Each stage calls
+mark(name) when it's reached, and the time since the trigger is added to a
+histogram for that stage, once per interaction. Stages that take time
+on their own are timed with span(name), which adds the duration to a
+histogram.
+
+The histograms are kept in memory. get_stats() returns them, and
+format_stats() formats them as a table.
+
+Run this module to measure the overhead of marks and spans.
+"""
+
+import collections
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger('tracing')
+
+# Kinds of histogram.
+SINCE_TRIGGER = 'since trigger'
+DURATION = 'duration'
+
+SpanStats = collections.namedtuple('SpanStats', [
+    'kind', 'count', 'mean_s', 'p50_s', 'p90_s', 'p99_s', 'max_s'])
+
+
+class Histogram(object):
+
+    """Counts values in log-spaced buckets, from MIN_S to about 100 s. Each
+    bucket is 19% wider than the one before, and the last one holds anything
+    longer.
+    """
+
+    MIN_S = 1e-5
+    BUCKETS_PER_DOUBLING = 4
+    N_BUCKETS = 95
+
+    def __init__(self):
+        self._counts = [0] * (self.N_BUCKETS + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.MIN_S:
+            i = 0
+        else:
+            i = min(self.N_BUCKETS, 1 + int(
+                math.log2(value / self.MIN_S) * self.BUCKETS_PER_DOUBLING))
+        self._counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket with the p'th percentile, or
+        the maximum if that's lower.
+        """
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank and count:
+                if i == self.N_BUCKETS:
+                    break
+                bound = self.MIN_S * 2 ** (i / self.BUCKETS_PER_DOUBLING)
+                return min(bound, self.max)
+        return self.max
+
+
+class _Span(object):
+
+    __slots__ = ('_tracer', '_name', '_start')
+
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._name = name
+        self._start = 0
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, *args):
+        self._tracer._add(  # pylint: disable=protected-access
+            self._name, DURATION, time.monotonic() - self._start)
+
+
+class Tracer(object):
+
+    """Keeps the histograms for marks and spans. Marks are only recorded
+    while a trace is running, and only the first time in each trace.
+
+    To keep marks and spans cheap, they queue their values without taking a
+    lock, and the values are added to the histograms in batches.
+    """
+
+    MAX_PENDING = 1024
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = collections.OrderedDict()
+        self._pending = collections.deque()
+        # (start time, names marked), while a trace is running.
+        self._trace = None
+
+    def start_trace(self, t=None):
+        """Start a new interaction, at monotonic time t (default: now)."""
+        self._trace = (time.monotonic() if t is None else t, set())
+
+    def end_trace(self):
+        """Stop recording marks until the next trace starts."""
+        self._trace = None
+
+    def mark(self, name, t=None):
+        """Record that the stage has been reached, at monotonic time t
+        (default: now).
+        """
+        trace = self._trace
+        if trace is None or name in trace[1]:
+            return
+        trace[1].add(name)
+        self._add(name, SINCE_TRIGGER,
+                  (time.monotonic() if t is None else t) - trace[0])
+
+    def span(self, name):
+        """Return a context manager that records how long its body takes."""
+        return _Span(self, name)
+
+    def get_stats(self):
+        """Return a dict from the name of each mark and span to its
+        SpanStats.
+        """
+        with self._lock:
+            self._drain_locked()
+            return collections.OrderedDict(
+                (name, SpanStats(kind, h.count, h.total / h.count, h.percentile(50),
+                                 h.percentile(90), h.percentile(99), h.max))
+                for (name, kind), h in self._histograms.items())
+
+    def reset(self):
+        """Clear the histograms."""
+        with self._lock:
+            self._drain_locked()
+            self._histograms.clear()
+
+    def _add(self, name, kind, value):
+        pending = self._pending
+        pending.append((name, kind, value))
+        if len(pending) >= self.MAX_PENDING:
+            with self._lock:
+                self._drain_locked()
+
+    def _drain_locked(self):
+        pending = self._pending
+        histograms = self._histograms
+        while True:
+            try:
+                name, kind, value = pending.popleft()
+            except IndexError:
+                return
+            histogram = histograms.get((name, kind))
+            if not histogram:
+                histogram = histograms[(name, kind)] = Histogram()
+            histogram.add(value)
+
+
+def format_stats(stats):
+    """Format the stats from get_stats() as a table, in milliseconds."""
+    lines = ['%-20s %-13s %6s %8s %8s %8s %8s %8s' % (
+        'stage', 'kind', 'count', 'mean', 'p50', 'p90', 'p99', 'max')]
+    for name, s in stats.items():
+        lines.append('%-20s %-13s %6d %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+            name, s.kind, s.count, 1000 * s.mean_s, 1000 * s.p50_s, 1000 * s.p90_s,
+            1000 * s.p99_s, 1000 * s.max_s))
+    return '\n'.join(lines)
+
+
+# The tracer used by the other modules.
+_tracer = Tracer()
+
+start_trace = _tracer.start_trace
+end_trace = _tracer.end_trace
+mark = _tracer.mark
+span = _tracer.span
+get_stats = _tracer.get_stats
+reset = _tracer.reset
+
+
+def log_stats():
+    """Log the histograms, eg when asked to by a signal."""
+    logger.info('latency:\n%s', format_stats(get_stats()))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Measure the overhead of tracing')
+    parser.add_argument('-n', type=int, default=100000, help='Number of iterations')
+    args = parser.parse_args()
+
+    tracer = Tracer()
+    names = ['stage%d' % i for i in range(10)]
+
+    start = time.perf_counter()
+    for i in range(args.n):
+        tracer.start_trace()
+        tracer.mark(names[i % 10])
+    elapsed = time.perf_counter() - start
+    print('start_trace + mark: %.2f us' % (1e6 * elapsed / args.n))
+
+    start = time.perf_counter()
+    for _ in range(args.n):
+        tracer.mark(names[0])
+    elapsed = time.perf_counter() - start
+    print('repeated mark: %.2f us' % (1e6 * elapsed / args.n))
+
+    start = time.perf_counter()
+    for _ in range(args.n):
+        with tracer.span('span'):
+            pass
+    elapsed = time.perf_counter() - start
+    print('span: %.2f us' % (1e6 * elapsed / args.n))
+
+
+if __name__ == '__main__':
+    main()
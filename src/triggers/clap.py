@@ -17,6 +17,7 @@
 import logging
 import numpy as np
 
+import audio
 from triggers.trigger import Trigger
 
 logger = logging.getLogger('trigger')
@@ -26,12 +27,14 @@ class ClapTrigger(Trigger):
 
     """Detect claps in the audio stream."""
 
+    AUDIO_FORMAT = audio.AudioFormat(channels=1, bytes_per_sample=2, sample_rate_hz=16000)
+
     def __init__(self, recorder):
         super().__init__()
 
         self.have_clap = True  # don't start yet
         self.prev_sample = 0
-        recorder.add_processor(self)
+        recorder.add_processor(self, fmt=self.AUDIO_FORMAT)
 
     def start(self):
         self.prev_sample = 0
@@ -39,7 +42,7 @@ class ClapTrigger(Trigger):
 
     def add_data(self, data):
         """ audio is mono 16bit signed at 16kHz """
-        audio = np.fromstring(data, 'int16')
+        audio = np.frombuffer(data, 'int16')
         if not self.have_clap:
             # alternative: np.abs(audio).sum() > thresh
             shifted = np.roll(audio, 1)
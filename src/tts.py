@@ -25,6 +25,7 @@ import numpy as np
 from scipy import signal
 
 import i18n
+import tracing
 
 # Path to a tmpfs directory to avoid SD card wear
 TMP_DIR = '/run/user/%d' % os.getuid()
@@ -86,22 +87,23 @@ def say(player, words, eq_filter=None, lang='en-US'):
 
     os.close(fd)
 
-    try:
-        subprocess.call(['pico2wave', '-l', lang, '-w', raw_wav, words.encode('utf-8')])
-        with wave.open(raw_wav, 'rb') as f:
-            raw_bytes = f.readframes(f.getnframes())
-    finally:
-        os.unlink(raw_wav)
-
-    # Deserialize and apply equalization filter
-    eq_audio = np.frombuffer(raw_bytes, dtype=np.int16)
-    if eq_filter:
-        eq_audio = eq_filter(eq_audio)
-
-    # Clip and serialize
-    int16_info = np.iinfo(np.int16)
-    eq_audio = np.clip(eq_audio, int16_info.min, int16_info.max)
-    eq_bytes = eq_audio.astype(np.int16).tostring()
+    with tracing.span('tts_synthesis'):
+        try:
+            subprocess.call(['pico2wave', '-l', lang, '-w', raw_wav, words.encode('utf-8')])
+            with wave.open(raw_wav, 'rb') as f:
+                raw_bytes = f.readframes(f.getnframes())
+        finally:
+            os.unlink(raw_wav)
+
+        # Deserialize and apply equalization filter
+        eq_audio = np.frombuffer(raw_bytes, dtype=np.int16)
+        if eq_filter:
+            eq_audio = eq_filter(eq_audio)
+
+        # Clip and serialize
+        int16_info = np.iinfo(np.int16)
+        eq_audio = np.clip(eq_audio, int16_info.min, int16_info.max)
+        eq_bytes = eq_audio.astype(np.int16).tostring()
 
     player.play_bytes(eq_bytes, sample_rate=SAMPLE_RATE)
 
@@ -14,9 +14,12 @@
 
 '''Test the action base classes.'''
 
+import random
+import threading
 import unittest
 
 import actionbase
+import tracing
 
 
 class TestAction(object):
@@ -28,6 +31,20 @@ class TestAction(object):
         self.voice_command = voice_command
 
 
+class PreparableAction(TestAction):
+
+    def __init__(self):
+        super().__init__()
+        self.prepared = None
+        self.rolled_back = None
+
+    def prepare(self, voice_command):
+        self.prepared = voice_command
+
+    def rollback(self, voice_command):
+        self.rolled_back = voice_command
+
+
 class TestKeywordHandler(unittest.TestCase):
 
     def test_keyword_phrases(self):
@@ -92,5 +109,360 @@ class TestActor(unittest.TestCase):
         self.assertIsNone(foo_action.voice_command)
 
 
+class OtherHandler(object):
+
+    def __init__(self, word):
+        self.word = word
+        self.command = None
+
+    def can_handle(self, command):
+        return command.startswith(self.word)
+
+    def handle(self, command):
+        self.command = command
+        return True
+
+
+class TestKeywordMatcher(unittest.TestCase):
+
+    def test_finds_overlapping_keywords(self):
+        matcher = actionbase.KeywordMatcher()
+        for keyword in ['he', 'she', 'his', 'hers']:
+            matcher.add(keyword)
+        matches = sorted(matcher.find_all('ushers'))
+        self.assertEqual(matches, [(1, 4, 1), (2, 4, 0), (2, 6, 3)])
+
+    def test_first_added_wins(self):
+        matcher = actionbase.KeywordMatcher()
+        matcher.add('light')
+        matcher.add('the')
+        self.assertEqual(matcher.find_first('the light and the light'), (4, 9, 0))
+
+    def test_add_after_search(self):
+        matcher = actionbase.KeywordMatcher()
+        matcher.add('abc')
+        self.assertIsNone(matcher.find_first('xbcd'))
+        matcher.add('bcd')
+        self.assertEqual(matcher.find_first('xbcd'), (1, 4, 1))
+
+    def test_empty_keyword(self):
+        matcher = actionbase.KeywordMatcher()
+        matcher.add('foo')
+        matcher.add('')
+        self.assertEqual(matcher.find_first('bar'), (0, 0, 1))
+
+    def test_matches_substring_search(self):
+        rng = random.Random(1)
+        words = [''.join(rng.choice('ab') for _ in range(rng.randint(1, 4)))
+                 for _ in range(30)]
+        matcher = actionbase.KeywordMatcher()
+        for word in words:
+            matcher.add(word)
+
+        for _ in range(200):
+            text = ''.join(rng.choice('abc') for _ in range(rng.randint(0, 12)))
+            expected = [i for i, word in enumerate(words) if word in text]
+            first = matcher.find_first(text)
+            if expected:
+                self.assertEqual(first, (text.find(words[expected[0]]),
+                                         text.find(words[expected[0]]) + len(words[expected[0]]),
+                                         expected[0]))
+            else:
+                self.assertIsNone(first)
+
+
+class TestActorMatch(unittest.TestCase):
+
+    def test_match_positions(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('Lights On', TestAction())
+        match = actor.match('Turn the LIGHTS ON')
+        self.assertEqual((match.keyword, match.start, match.end), ('lights on', 9, 18))
+
+    def test_first_registered_wins(self):
+        actor = actionbase.Actor()
+        first = TestAction()
+        actor.add_keyword('on', first)
+        actor.add_keyword('lights', TestAction())
+        self.assertTrue(actor.handle('lights on'))
+        self.assertEqual(first.voice_command, 'lights on')
+
+    def test_keyword_added_after_match(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('foo', TestAction())
+        self.assertFalse(actor.can_handle('bar'))
+        actor.add_keyword('bar', TestAction())
+        self.assertTrue(actor.can_handle('bar'))
+
+    def test_other_handlers_keep_their_place(self):
+        actor = actionbase.Actor()
+        late = TestAction()
+        other = OtherHandler('moo')
+        actor.handlers.append(other)
+        actor.add_keyword('foo', late)
+
+        self.assertTrue(actor.handle('moo foo'))
+        self.assertEqual(other.command, 'moo foo')
+        self.assertIsNone(late.voice_command)
+
+        self.assertTrue(actor.handle('foo'))
+        self.assertEqual(late.voice_command, 'foo')
+
+    def test_removed_handler(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('foo', TestAction())
+        self.assertTrue(actor.can_handle('foo'))
+        del actor.handlers[0]
+        self.assertFalse(actor.can_handle('foo'))
+
+
+class TestFuzzyMatching(unittest.TestCase):
+
+    def test_phonetic_key(self):
+        self.assertEqual(actionbase.phonetic_key('four'), actionbase.phonetic_key('for'))
+        self.assertEqual(actionbase.phonetic_key('four'), actionbase.phonetic_key('4'))
+        self.assertEqual(actionbase.phonetic_key('lights'), actionbase.phonetic_key('lites'))
+        self.assertNotEqual(actionbase.phonetic_key('up'), actionbase.phonetic_key('on'))
+
+    def test_edit_distance(self):
+        self.assertEqual(actionbase.edit_distance('value', 'volume'), 2)
+        self.assertEqual(actionbase.edit_distance('', 'abc'), 3)
+        self.assertEqual(actionbase.edit_distance('abcdef', 'ab', max_distance=2), 3)
+
+    def test_misheard_keyword(self):
+        index = actionbase.FuzzyKeywordIndex()
+        index.add('radio four')
+        index.add('lights on')
+        score, start, end, keyword = index.find('play radio for', 0.8)
+        self.assertEqual((start, end, keyword), (5, 14, 0))
+        self.assertGreater(score, 0.8)
+        self.assertEqual(index.find('turn the lites on', 0.8)[3], 1)
+
+    def test_short_words_are_not_guessed(self):
+        index = actionbase.FuzzyKeywordIndex()
+        index.add('lights on')
+        self.assertIsNone(index.find('lights up', 0.65))
+
+    def test_near_misses_are_not_matched(self):
+        index = actionbase.FuzzyKeywordIndex()
+        for keyword in ('ip address', 'repeat after me', 'power off', 'turn off',
+                        'reboot', 'restart', 'volume', 'play', 'radio'):
+            index.add(keyword)
+        for command in ('restaurant near me', 'turn of the oven', 'repeat after',
+                        'pay the bill', 'radius of earth', 'red', 'value up'):
+            self.assertIsNone(index.find(command, 0.65), command)
+
+    def test_actor_runs_corrected_command(self):
+        actor = actionbase.Actor()
+        action = TestAction()
+        actor.add_keyword('radio four', action)
+        self.assertFalse(actor.handle('play radio for'))
+
+        actor.set_fuzzy_matching()
+        match = actor.match('play radio for')
+        self.assertEqual((match.keyword, match.start, match.end), ('radio four', 5, 14))
+        self.assertTrue(actor.handle('play radio for'))
+        self.assertEqual(action.voice_command, 'play radio four')
+
+    def test_exact_only_actions(self):
+        actor = actionbase.Actor()
+        action = TestAction()
+        action.fuzzy_match = False
+        actor.add_keyword('reboot', action)
+        actor.set_fuzzy_matching(0.5)
+        actor.add_keyword('restart', TestAction())
+        actor.handlers[-1].action.fuzzy_match = False
+        self.assertFalse(actor.can_handle('reboat'))
+        self.assertFalse(actor.can_handle('restard'))
+        self.assertTrue(actor.can_handle('reboot'))
+
+    def test_fuzzy_off_per_call(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('lights on', TestAction())
+        actor.set_fuzzy_matching()
+        self.assertTrue(actor.can_handle('lites on'))
+        self.assertFalse(actor.can_handle('lites on', fuzzy=False))
+        self.assertFalse(actor.handle('lites on', fuzzy=False))
+
+    def test_exact_match_comes_first(self):
+        actor = actionbase.Actor()
+        actor.set_fuzzy_matching(0.5)
+        fuzzy = TestAction()
+        exact = TestAction()
+        actor.add_keyword('volume', fuzzy)
+        actor.add_keyword('value', exact)
+        self.assertTrue(actor.handle('value'))
+        self.assertEqual(exact.voice_command, 'value')
+        self.assertIsNone(fuzzy.voice_command)
+
+    def test_turned_off(self):
+        actor = actionbase.Actor()
+        actor.add_keyword('volume', TestAction())
+        actor.set_fuzzy_matching()
+        actor.set_fuzzy_matching(None)
+        self.assertFalse(actor.can_handle('volum up'))
+
+
+class TestInterimCommands(unittest.TestCase):
+
+    def setUp(self):
+        self.actor = actionbase.Actor()
+        self.action = PreparableAction()
+        self.actor.add_keyword('volume up', self.action)
+
+    def test_prepares_stable_match(self):
+        self.assertFalse(self.actor.handle_interim('volume up', 0.9))
+        self.assertTrue(self.actor.handle_interim('volume up', 0.9))
+        self.assertEqual(self.action.prepared, 'volume up')
+
+        self.assertTrue(self.actor.handle('volume up'))
+        self.assertEqual(self.action.voice_command, 'volume up')
+        self.assertIsNone(self.action.rolled_back)
+
+    def test_ignores_unstable_results(self):
+        self.actor.handle_interim('volume up', 0.9)
+        self.actor.handle_interim('volume up', 0.1)
+        self.assertFalse(self.actor.handle_interim('volume up', 0.9))
+        self.assertIsNone(self.action.prepared)
+
+    def test_rolls_back_when_final_differs(self):
+        self.actor.handle_interim('volume up', 0.9)
+        self.actor.handle_interim('volume up', 0.9)
+
+        self.assertFalse(self.actor.handle('what is up'))
+        self.assertEqual(self.action.rolled_back, 'volume up')
+        self.assertIsNone(self.action.voice_command)
+
+    def test_rolls_back_without_final(self):
+        self.actor.handle_interim('volume up', 0.9)
+        self.actor.handle_interim('volume up', 0.9)
+        self.actor.rollback()
+        self.assertEqual(self.action.rolled_back, 'volume up')
+
+    def test_prepares_again_when_command_changes(self):
+        self.actor.add_keyword('volume', PreparableAction())
+        for _ in range(2):
+            self.actor.handle_interim('volume up', 0.9)
+        for _ in range(2):
+            self.actor.handle_interim('volume up twice', 0.9)
+        self.assertEqual(self.action.rolled_back, 'volume up')
+        self.assertEqual(self.action.prepared, 'volume up twice')
+
+    def test_action_without_prepare(self):
+        actor = actionbase.Actor()
+        action = TestAction()
+        actor.add_keyword('foo', action)
+        actor.handle_interim('foo', 0.9)
+        self.assertFalse(actor.handle_interim('foo', 0.9))
+        self.assertTrue(actor.handle('foo'))
+        self.assertEqual(action.voice_command, 'foo')
+
+    def test_handler_without_prepare(self):
+        self.actor.handle_interim('volume up', 0.9)
+        self.actor.handle_interim('volume up', 0.9)
+        self.actor.handlers.append(OtherHandler('turn'))
+
+        self.actor.handle_interim('turn it up', 0.9)
+        self.assertFalse(self.actor.handle_interim('turn it up', 0.9))
+        self.assertEqual(self.action.rolled_back, 'volume up')
+        self.assertTrue(self.actor.handle('turn it up'))
+
+    def test_handler_without_rollback(self):
+        handler = OtherHandler('turn')
+        handler.prepare = lambda command: True
+        self.actor.handlers.append(handler)
+        self.actor.handle_interim('turn it up', 0.9)
+        self.assertTrue(self.actor.handle_interim('turn it up', 0.9))
+
+        self.assertTrue(self.actor.handle('volume up'))
+        self.assertEqual(self.action.voice_command, 'volume up')
+
+
+class MediaAction(TestAction):
+
+    """Plays until stopped."""
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.stopped = threading.Event()
+
+    def run(self, voice_command):
+        super().run(voice_command)
+        self.started.set()
+        self.stopped.wait()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class FailingAction(object):
+
+    def run(self, voice_command):
+        raise RuntimeError('failed')
+
+
+class TestActionExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = actionbase.ActionExecutor(max_workers=2)
+        self.addCleanup(self.executor.shutdown)
+        self.actor = actionbase.Actor()
+
+    def test_dispatch_returns_while_action_runs(self):
+        media = MediaAction()
+        self.actor.add_keyword('play', media)
+
+        handle = self.actor.dispatch('play something', self.executor)
+        self.assertTrue(media.started.wait(1))
+        self.assertFalse(handle.done())
+        self.assertEqual(self.executor.get_running(), [handle])
+
+        handle.cancel()
+        self.assertTrue(handle.wait(1))
+        self.assertTrue(handle.cancelled())
+
+    def test_dispatch_unhandled_command(self):
+        self.assertIsNone(self.actor.dispatch('foo', self.executor))
+
+    def test_new_media_stops_old(self):
+        first = MediaAction()
+        second = MediaAction()
+        self.actor.add_keyword('play', first)
+        self.actor.add_keyword('radio', second)
+
+        first_handle = self.actor.dispatch('play', self.executor)
+        self.assertTrue(first.started.wait(1))
+        second_handle = self.actor.dispatch('radio', self.executor)
+
+        self.assertTrue(first_handle.wait(1))
+        self.assertTrue(second.started.wait(1))
+        second_handle.cancel()
+        self.assertTrue(second_handle.wait(1))
+
+    def test_short_actions_run_alongside_media(self):
+        media = MediaAction()
+        action = TestAction()
+        self.actor.add_keyword('play', media)
+        self.actor.add_keyword('time', action)
+
+        media_handle = self.actor.dispatch('play', self.executor)
+        self.assertTrue(self.actor.dispatch('what time is it', self.executor).wait(1))
+        self.assertEqual(action.voice_command, 'what time is it')
+        self.assertFalse(media_handle.done())
+        media_handle.cancel()
+
+    def test_times_actions(self):
+        tracing.reset()
+        self.actor.add_keyword('time', TestAction())
+        self.assertTrue(self.actor.dispatch('what time is it', self.executor).wait(1))
+        self.assertEqual(tracing.get_stats()['actor_handle'].count, 1)
+
+    def test_failing_action(self):
+        self.actor.add_keyword('foo', FailingAction())
+        with self.assertLogs('actionbase', 'ERROR'):
+            self.assertTrue(self.actor.dispatch('foo', self.executor).wait(1))
+
+
 if __name__ == '__main__':
     unittest.main()
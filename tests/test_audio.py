@@ -0,0 +1,867 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the audio recorder.'''
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import wave
+
+import numpy as np
+
+import audio
+
+
+class TestProcessor(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def add_data(self, data):
+        self.chunks.append(bytes(data))
+
+
+class TrickleStream(io.RawIOBase):
+
+    """A raw stream that returns at most a few bytes per read, like a pipe."""
+
+    def __init__(self, data, max_read):
+        self._data = io.BytesIO(data)
+        self._max_read = max_read
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self._data.read(min(len(b), self._max_read))
+        b[:len(data)] = data
+        return len(data)
+
+
+def make_recorder():
+    # 0.1 s chunks of mono 8-bit audio at 100 Hz are 10 bytes long.
+    return audio.Recorder(channels=1, bytes_per_sample=1, sample_rate_hz=100)
+
+
+class TestRecorder(unittest.TestCase):
+
+    def test_capture_splits_stream_into_chunks(self):
+        recorder = make_recorder()
+        processor = TestProcessor()
+        recorder.add_processor(processor)
+
+        recorder._capture(TrickleStream(bytes(range(30)), 7))
+
+        self.assertEqual(processor.chunks, [
+            bytes(range(0, 10)), bytes(range(10, 20)), bytes(range(20, 30))])
+
+    def test_capture_drops_partial_chunk(self):
+        recorder = make_recorder()
+        processor = TestProcessor()
+        recorder.add_processor(processor)
+
+        recorder._capture(TrickleStream(bytes(25), 10))
+
+        self.assertEqual(len(processor.chunks), 2)
+
+    def test_capture_wraps_around_ring(self):
+        recorder = make_recorder()
+        processor = TestProcessor()
+        recorder.add_processor(processor)
+        n_chunks = audio.Recorder.RING_CHUNKS * 2 + 1
+
+        recorder._capture(TrickleStream(bytes(range(n_chunks * 10)), 10))
+
+        self.assertEqual(processor.chunks[-1], bytes(range(n_chunks * 10 - 10, n_chunks * 10)))
+
+    def test_capture_passes_views(self):
+        recorder = make_recorder()
+        views = []
+
+        class ViewProcessor(object):
+
+            def add_data(self, data):
+                views.append(data)
+
+        recorder.add_processor(ViewProcessor())
+        recorder._capture(TrickleStream(bytes(20), 10))
+
+        self.assertTrue(all(isinstance(view, memoryview) for view in views))
+
+    def test_history_is_empty_before_capture(self):
+        self.assertEqual(make_recorder().get_history(), [])
+
+    def test_history_keeps_recent_chunks(self):
+        recorder = audio.Recorder(channels=1, bytes_per_sample=1, sample_rate_hz=100,
+                                  history_s=0.5)
+        recorder._capture(TrickleStream(bytes(range(100)), 10))
+
+        history = recorder.get_history()
+
+        self.assertEqual([chunk.frame for chunk in history], [50, 60, 70, 80, 90])
+        self.assertEqual(history[-1].data, bytes(range(90, 100)))
+
+    def test_history_since_timestamp(self):
+        recorder = make_recorder()
+        recorder._capture(TrickleStream(bytes(30), 10))
+
+        history = recorder.get_history()
+
+        self.assertEqual(recorder.get_history(history[0].timestamp), history)
+        self.assertEqual(
+            recorder.get_history(history[-1].timestamp + audio.Recorder.CHUNK_S), [])
+
+    def test_add_processor_with_history(self):
+        recorder = make_recorder()
+        recorder._capture(TrickleStream(bytes(range(20)), 10))
+        processor = TestProcessor()
+
+        recorder.add_processor(processor, since=0)
+        recorder._capture(TrickleStream(bytes(range(20, 30)), 10))
+
+        self.assertEqual(processor.chunks, [
+            bytes(range(0, 10)), bytes(range(10, 20)), bytes(range(20, 30))])
+
+    def test_processors_share_converted_format(self):
+        recorder = audio.Recorder(channels=2, bytes_per_sample=2, sample_rate_hz=100)
+        fmt = audio.AudioFormat(1, 2, 100)
+        first = TestProcessor()
+        second = TestProcessor()
+        recorder.add_processor(first, fmt=fmt)
+        recorder.add_processor(second, fmt=fmt)
+
+        stereo = np.array([[100, 300]] * 10, dtype='<i2')
+        recorder._capture(TrickleStream(stereo.tobytes(), 40))
+
+        self.assertEqual(len(recorder._outputs), 1)
+        self.assertEqual(first.chunks, [np.full(10, 200, dtype='<i2').tobytes()])
+        self.assertEqual(first.chunks, second.chunks)
+
+    def test_del_processor_removes_format(self):
+        recorder = make_recorder()
+        processor = TestProcessor()
+        recorder.add_processor(processor, fmt=audio.AudioFormat(1, 2, 100))
+        recorder.del_processor(processor)
+
+        self.assertEqual(recorder._outputs, [])
+
+
+def sine(frequency_hz, sample_rate_hz, n_frames):
+    t = np.arange(n_frames) / sample_rate_hz
+    return np.rint(16384 * np.sin(2 * np.pi * frequency_hz * t)).astype('<i2')
+
+
+class TestFormatConverter(unittest.TestCase):
+
+    def test_select_channel(self):
+        converter = audio.FormatConverter(
+            audio.AudioFormat(2, 2, 16000), audio.AudioFormat(1, 2, 16000), channel=1)
+        stereo = np.array([[1, 2], [3, 4]], dtype='<i2')
+
+        self.assertEqual(bytes(converter.convert(stereo.tobytes())),
+                         np.array([2, 4], dtype='<i2').tobytes())
+
+    def test_width_conversion(self):
+        converter = audio.FormatConverter(
+            audio.AudioFormat(1, 4, 16000), audio.AudioFormat(1, 2, 16000))
+        samples = np.array([65536, -65536, 2 ** 31 - 1], dtype='<i4')
+
+        self.assertEqual(bytes(converter.convert(samples.tobytes())),
+                         np.array([1, -1, 32767], dtype='<i2').tobytes())
+
+    def test_mono_to_stereo(self):
+        converter = audio.FormatConverter(
+            audio.AudioFormat(1, 2, 16000), audio.AudioFormat(2, 2, 16000))
+        mono = np.array([5, 6], dtype='<i2')
+
+        self.assertEqual(bytes(converter.convert(mono.tobytes())),
+                         np.array([5, 5, 6, 6], dtype='<i2').tobytes())
+
+    def test_resample_in_chunks(self):
+        converter = audio.FormatConverter(
+            audio.AudioFormat(1, 2, 48000), audio.AudioFormat(1, 2, 16000))
+        signal = sine(440, 48000, 48000)
+
+        out = b''.join(bytes(converter.convert(chunk.tobytes()))
+                       for chunk in np.split(signal, 10))
+        out = np.frombuffer(out, '<i2')
+
+        self.assertEqual(len(out), 16000)
+        # Compare with a 16 kHz sine, allowing for the filter delay and
+        # skipping the start of the filter response.
+        expected = sine(440, 16000, 16000)
+        error = min(np.max(np.abs(out[delay + 100:].astype(int) - expected[100:16000 - delay]))
+                    for delay in range(40))
+        self.assertLess(error, 50)
+
+    def test_upsample_length(self):
+        converter = audio.FormatConverter(
+            audio.AudioFormat(1, 2, 8000), audio.AudioFormat(1, 2, 22050))
+        n_out = sum(len(converter.convert(bytes(1600))) // 2 for _ in range(50))
+
+        self.assertEqual(n_out, 22050 * 5)
+
+    def test_unsupported_channels(self):
+        with self.assertRaises(ValueError):
+            audio.FormatConverter(audio.AudioFormat(3, 2, 16000), audio.AudioFormat(2, 2, 16000))
+
+
+class FlakyCapture(audio.CaptureBackend):
+
+    """A backend that fails after each chunk, then fails to open."""
+
+    def __init__(self, chunks, open_failures=0):
+        self.chunks = list(chunks)
+        self.open_failures = open_failures
+        self.opened = 0
+        self.has_chunk = False
+
+    def open(self):
+        self.opened += 1
+        if not self.chunks and self.open_failures:
+            self.open_failures -= 1
+            raise audio.Error('failed to open')
+        self.has_chunk = bool(self.chunks)
+
+    def readinto(self, view):
+        if not self.has_chunk:
+            return 0
+        self.has_chunk = False
+        chunk = self.chunks.pop(0)
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+    def eof(self):
+        return not self.chunks and not self.open_failures
+
+
+class TestRecorderRestart(unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(audio.Recorder, 'RESTART_DELAY_S', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_restarts_keep_processors(self):
+        backend = FlakyCapture([bytes([i] * 10) for i in range(3)])
+        recorder = audio.Recorder(channels=1, bytes_per_sample=1, sample_rate_hz=100,
+                                  backend=backend)
+        processor = TestProcessor()
+        recorder.add_processor(processor)
+
+        recorder.start()
+        recorder.join()
+
+        self.assertEqual(processor.chunks, [bytes([i] * 10) for i in range(3)])
+        self.assertEqual(recorder.restarts, 2)
+
+    @mock.patch('os._exit')
+    def test_exits_when_failures_are_used_up(self, mock_exit):
+        backend = FlakyCapture([bytes(10)], open_failures=10)
+        recorder = audio.Recorder(channels=1, bytes_per_sample=1, sample_rate_hz=100,
+                                  backend=backend, max_failures=3)
+
+        recorder.start()
+        recorder.join()
+
+        mock_exit.assert_called_once_with(1)
+        self.assertEqual(backend.opened, 4)
+
+    @mock.patch('os._exit')
+    def test_recovers_within_budget(self, mock_exit):
+        backend = FlakyCapture([bytes(10)], open_failures=3)
+        recorder = audio.Recorder(channels=1, bytes_per_sample=1, sample_rate_hz=100,
+                                  backend=backend, max_failures=3)
+
+        recorder.start()
+        recorder.join()
+
+        mock_exit.assert_not_called()
+        self.assertEqual(recorder.restarts, 3)
+
+
+class TestReplayCapture(unittest.TestCase):
+
+    def test_recorder_replays_stream(self):
+        backend = audio.ReplayCapture(io.BytesIO(bytes(range(30))), 1, 1, 100,
+                                      realtime=False)
+        recorder = audio.Recorder(channels=1, bytes_per_sample=1, sample_rate_hz=100,
+                                  backend=backend)
+        processor = TestProcessor()
+        recorder.add_processor(processor)
+
+        recorder.start()
+        recorder.join()
+
+        self.assertTrue(backend.eof())
+        self.assertEqual(b''.join(processor.chunks), bytes(range(30)))
+
+    def test_replay_wav_file(self):
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+            wav.writeframes(bytes(range(20)))
+
+        backend = audio.ReplayCapture(path, 1, 2, 16000, realtime=False)
+        backend.open()
+        buf = bytearray(64)
+
+        self.assertEqual(backend.readinto(memoryview(buf)), 20)
+        self.assertEqual(backend.readinto(memoryview(buf)), 0)
+        self.assertEqual(bytes(buf[:20]), bytes(range(20)))
+
+    def test_replay_wav_with_wrong_format(self):
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(2)
+            wav.setsampwidth(2)
+            wav.setframerate(16000)
+
+        with self.assertRaises(ValueError):
+            audio.ReplayCapture(path, 1, 2, 16000).open()
+
+    def test_closed_replay_stops_reading(self):
+        backend = audio.ReplayCapture(io.BytesIO(bytes(30)), 1, 1, 100, realtime=False)
+        backend.open()
+        backend.close()
+
+        self.assertEqual(backend.readinto(memoryview(bytearray(10))), 0)
+        self.assertFalse(backend.eof())
+
+
+class BlockedProcessor(TestProcessor):
+
+    """A processor that waits until it is released."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = threading.Event()
+
+    def add_data(self, data):
+        self.release.wait()
+        super().add_data(data)
+
+
+class TestAsyncProcessor(unittest.TestCase):
+
+    def test_processes_all_data(self):
+        processor = TestProcessor()
+        with audio.AsyncProcessor(processor) as async_processor:
+            for i in range(5):
+                async_processor.add_data(memoryview(bytes([i])))
+
+        self.assertEqual(processor.chunks, [bytes([i]) for i in range(5)])
+        self.assertEqual(async_processor.get_stats().chunks, 5)
+
+    def test_drop_oldest(self):
+        processor = BlockedProcessor()
+        async_processor = audio.AsyncProcessor(processor, max_chunks=2)
+        for i in range(10):
+            async_processor.add_data(bytes([i]))
+        processor.release.set()
+        async_processor.close()
+
+        # The first chunk may already be with the processor, the rest are the
+        # newest chunks.
+        self.assertEqual(processor.chunks[-2:], [bytes([8]), bytes([9])])
+        stats = async_processor.get_stats()
+        self.assertEqual(stats.chunks + stats.dropped, 10)
+
+    def test_drop_newest(self):
+        processor = BlockedProcessor()
+        async_processor = audio.AsyncProcessor(
+            processor, max_chunks=2, policy=audio.AsyncProcessor.DROP_NEWEST)
+        for i in range(10):
+            async_processor.add_data(bytes([i]))
+        processor.release.set()
+        async_processor.close()
+
+        self.assertEqual(processor.chunks[0], bytes([0]))
+        self.assertNotIn(bytes([9]), processor.chunks)
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            audio.AsyncProcessor(TestProcessor(), policy='wait')
+
+
+def write_wav(path, data, sample_rate_hz=16000, channels=1):
+    with wave.open(path, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate_hz)
+        wav.writeframes(data)
+
+
+class TestClipCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.cache = audio.ClipCache(audio.AudioFormat(1, 2, 16000), max_bytes=100)
+
+    def make_wav(self, name, data, sample_rate_hz=16000):
+        path = os.path.join(self.dir.name, name)
+        write_wav(path, data, sample_rate_hz)
+        return path
+
+    def test_hit_after_miss(self):
+        path = self.make_wav('a.wav', bytes(range(40)))
+
+        self.assertEqual(bytes(self.cache.get(path)), bytes(range(40)))
+        self.assertEqual(bytes(self.cache.get(path)), bytes(range(40)))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_reloads_modified_file(self):
+        path = self.make_wav('a.wav', bytes(40))
+        self.cache.get(path)
+        write_wav(path, bytes(range(40)))
+        os.utime(path, ns=(0, 0))
+
+        self.assertEqual(bytes(self.cache.get(path)), bytes(range(40)))
+        self.assertEqual(self.cache.misses, 2)
+
+    def test_evicts_least_recently_used(self):
+        first = self.make_wav('a.wav', bytes(40))
+        second = self.make_wav('b.wav', bytes(40))
+        third = self.make_wav('c.wav', bytes(40))
+        self.cache.get(first)
+        self.cache.get(second)
+        self.cache.get(first)
+        self.cache.get(third)
+
+        self.cache.get(first)
+        self.assertEqual(self.cache.misses, 3)
+        self.cache.get(second)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_converts_to_output_format(self):
+        path = self.make_wav('a.wav', bytes(40), sample_rate_hz=8000)
+
+        self.assertEqual(len(self.cache.get(path)), 80)
+
+    @mock.patch.object(audio.ClipCache, 'MMAP_BYTES', 10)
+    def test_maps_large_files(self):
+        cache = audio.ClipCache(audio.AudioFormat(1, 2, 16000), max_bytes=400)
+        first = self.make_wav('a.wav', bytes(range(200)))
+        second = self.make_wav('b.wav', bytes(range(200)))
+        third = self.make_wav('c.wav', bytes(range(200)))
+
+        clip = cache.get(first)
+
+        self.assertIsInstance(clip, memoryview)
+        self.assertEqual(bytes(clip), bytes(range(200)))
+        self.assertEqual(bytes(cache.get(first)), bytes(range(200)))
+        self.assertEqual(cache.hits, 1)
+
+        # Mapped clips count towards the size of the cache.
+        cache.get(second)
+        cache.get(third)
+        cache.get(first)
+        self.assertEqual(cache.misses, 4)
+
+    def test_maps_converted_clips(self):
+        # A second of speech, played in the default output format.
+        cache_dir = os.path.join(self.dir.name, 'cache')
+        cache = audio.ClipCache(audio.AudioFormat(2, 2, 48000), max_bytes=100000,
+                                cache_dir=cache_dir)
+        path = self.make_wav('a.wav', sine(440, 16000, 16000).tobytes())
+        expected = bytes(audio.FormatConverter(
+            audio.AudioFormat(1, 2, 16000), audio.AudioFormat(2, 2, 48000)).convert(
+                sine(440, 16000, 16000).tobytes()))
+
+        with mock.patch.object(audio.ClipCache, 'MMAP_BYTES', 100000), \
+                mock.patch.object(audio.ClipCache, 'CONVERT_FRAMES', 1000):
+            clip = cache.get(path)
+            self.assertIsInstance(clip, memoryview)
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            self.assertEqual(len(clip), len(expected))
+            self.assertEqual(bytes(clip), expected)
+
+            # Too large to keep, but the converted file is mapped again.
+            with mock.patch.object(audio, 'FormatConverter') as converter:
+                self.assertEqual(bytes(cache.get(path)), expected)
+            converter.assert_not_called()
+            self.assertEqual(cache.misses, 2)
+
+    def test_rejects_stereo_files(self):
+        path = os.path.join(self.dir.name, 'stereo.wav')
+        write_wav(path, bytes(40), channels=2)
+
+        with self.assertRaises(ValueError):
+            self.cache.get(path)
+
+
+def wait_for(condition, timeout=1):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.001)
+
+
+def noise(n_frames, amplitude=20):
+    return np.random.RandomState(0).randint(-amplitude, amplitude, n_frames).astype('<i2')
+
+
+class TestVadEndpointer(unittest.TestCase):
+
+    def setUp(self):
+        self.processor = TestProcessor()
+        self.ends = 0
+
+    def on_end(self):
+        self.ends += 1
+
+    def feed(self, vad, samples):
+        vad.set_end_cb(self.on_end)
+        # 0.1 s chunks, like the Recorder.
+        for i in range(0, len(samples), 1600):
+            vad.add_data(samples[i:i + 1600].tobytes())
+
+    def test_ends_after_trailing_silence(self):
+        vad = audio.VadEndpointer(self.processor, trailing_silence_s=0.5)
+        self.feed(vad, np.concatenate((noise(8000), sine(440, 16000, 16000), noise(4800))))
+        self.assertEqual(self.ends, 0)
+
+        self.feed(vad, noise(16000))
+        self.assertEqual(self.ends, 1)
+        self.assertTrue(vad.speech_started)
+        # Everything up to the end is passed on, and nothing after.
+        self.assertEqual(len(b''.join(self.processor.chunks)), 2 * 16000 * 2)
+
+    def test_skips_leading_silence(self):
+        vad = audio.VadEndpointer(self.processor, skip_leading_silence=True)
+        self.feed(vad, np.concatenate((noise(32000), sine(440, 16000, 16000))))
+
+        data = b''.join(self.processor.chunks)
+        pad_bytes = 2 * 16000 * vad.LEADING_PAD_S
+        self.assertLessEqual(len(data), 2 * 16000 + pad_bytes + 3200)
+        self.assertGreaterEqual(len(data), 2 * 16000)
+
+    def test_max_utterance_length(self):
+        vad = audio.VadEndpointer(self.processor, max_utterance_s=1)
+        self.feed(vad, sine(440, 16000, 32000))
+
+        self.assertEqual(self.ends, 1)
+        self.assertEqual(len(b''.join(self.processor.chunks)), 2 * 16000)
+
+    def test_ends_in_recorder_history(self):
+        recorder = audio.Recorder(history_s=3)
+        utterance = np.concatenate((noise(8000), sine(440, 16000, 16000), noise(16000)))
+        recorder._capture(TrickleStream(utterance.tobytes(), 3200))
+
+        vad = audio.VadEndpointer(self.processor, trailing_silence_s=0.5)
+        vad.set_end_cb(lambda: recorder.del_processor(vad))
+        thread = threading.Thread(target=recorder.add_processor, args=(vad,),
+                                  kwargs={'since': 0}, daemon=True)
+        thread.start()
+        thread.join(5)
+
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(vad.ended)
+        self.assertEqual(recorder._outputs, [])
+
+    def test_ends_without_speech(self):
+        vad = audio.VadEndpointer(self.processor, skip_leading_silence=True,
+                                  max_leading_silence_s=1)
+        self.feed(vad, noise(32000))
+
+        self.assertEqual(self.ends, 1)
+        self.assertFalse(vad.speech_started)
+        self.assertEqual(self.processor.chunks, [])
+
+
+class TestOutput(audio.OutputBackend):
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = 0
+        self.data = b''
+
+    def open(self):
+        self.opened += 1
+
+    def write(self, data):
+        self.data += bytes(data)
+
+    def close(self):
+        self.closed += 1
+
+
+class SilenceOutput(TestOutput):
+
+    NEEDS_SILENCE = True
+
+
+class TestPlayer(unittest.TestCase):
+
+    def setUp(self):
+        self.output = TestOutput()
+        # A high rate so clips are short.
+        self.player = audio.Player(backend=self.output,
+                                   output_format=audio.AudioFormat(1, 2, 1000000))
+        self.addCleanup(self.player.close)
+
+    def test_reuses_output_stream(self):
+        self.player.play_bytes(bytes(20), 1000000)
+        self.player.play_bytes(bytes(20), 1000000)
+
+        self.assertEqual(self.output.opened, 1)
+        self.assertEqual(self.output.data, bytes(40))
+
+    def test_converts_clips(self):
+        samples = np.array([0, 1, -1], dtype='i1')
+        self.player.play_bytes(samples.tobytes(), 1000000, sample_width=1)
+
+        self.assertEqual(self.output.data,
+                         np.array([0, 256, -256], dtype='<i2').tobytes())
+
+    def test_resamples_clips(self):
+        self.player.play_bytes(bytes(2000), 500000)
+
+        self.assertEqual(len(self.output.data), 4000)
+
+    def test_upmixes_clips_to_stereo(self):
+        player = audio.Player(backend=self.output,
+                              output_format=audio.AudioFormat(2, 2, 1000000))
+        self.addCleanup(player.close)
+        player.play_bytes(bytes(2000), 500000)
+
+        self.assertEqual(player.get_format().channels, 2)
+        self.assertEqual(len(self.output.data), 8000)
+
+    @mock.patch.object(audio.Player, 'IDLE_TIMEOUT_S', 0.01)
+    def test_closes_idle_stream(self):
+        self.player.play_bytes(bytes(20), 1000000)
+        time.sleep(0.1)
+        self.player.play_bytes(bytes(20), 1000000)
+
+        self.assertEqual(self.output.closed, 1)
+        self.assertEqual(self.output.opened, 2)
+
+    @mock.patch.object(audio.Player, 'IDLE_TIMEOUT_S', 0.05)
+    def test_feeds_output_with_silence(self):
+        output = SilenceOutput()
+        player = audio.Player(backend=output, output_format=audio.AudioFormat(1, 2, 1000))
+        self.addCleanup(player.close)
+        player.play_bytes(b'\x01\x00' * 10, 1000)
+
+        # The clip is followed by silence until the idle output is closed.
+        wait_for(lambda: output.closed)
+        self.assertEqual(output.data[:20], b'\x01\x00' * 10)
+        self.assertGreater(len(output.data), 20)
+        self.assertEqual(output.data[20:], bytes(len(output.data) - 20))
+
+    def test_aplay_starts_with_a_small_buffer(self):
+        output = audio.AplayOutput('hw:0', 2, 2, 48000)
+        with mock.patch('subprocess.Popen') as popen:
+            output.open()
+
+        cmd = popen.call_args[0][0]
+        self.assertEqual(cmd[:2], ['aplay', '-q'])
+        self.assertIn('--buffer-time=%d' % output.BUFFER_US, cmd)
+        self.assertIn('--start-delay=%d' % output.START_DELAY_US, cmd)
+        self.assertTrue(output.NEEDS_SILENCE)
+
+    def test_stream_waits_for_jitter_buffer(self):
+        stream = self.player.open_stream(1000000, jitter_s=0.00002)
+        stream.write(bytes(20))
+        time.sleep(0.05)
+        self.assertEqual(self.output.data, b'')
+
+        stream.write(bytes(20))
+        wait_for(lambda: len(self.output.data) == 40)
+
+        stream.write(bytes(10))
+        wait_for(lambda: len(self.output.data) == 50)
+        stream.close()
+
+    def test_stream_close_plays_buffer(self):
+        with self.player.open_stream(1000000) as stream:
+            stream.write(bytes(20))
+
+        self.assertEqual(self.output.data, bytes(20))
+
+    def test_play_without_blocking(self):
+        handle = self.player.play_bytes(bytes(20), 1000000, block=False)
+
+        self.assertTrue(handle.wait(timeout=1))
+        self.assertTrue(handle.done())
+        self.assertEqual(self.output.data, bytes(20))
+
+    def test_mixes_sources_with_clips(self):
+        source = self.player.add_source(1000000, jitter_s=0)
+        # Hold the lock so both arrive in the same block.
+        with self.player._cond:  # pylint: disable=protected-access
+            source.write(np.full(20, 30000, dtype='<i2').tobytes())
+            handle = self.player.play_bytes(np.full(10, 10000, dtype='<i2').tobytes(),
+                                            1000000, block=False)
+        handle.wait()
+        source.close()
+
+        samples = np.frombuffer(self.output.data, dtype='<i2')
+        self.assertEqual(list(samples), [32767] * 10 + [30000] * 10)
+
+    def test_ducks_sources(self):
+        self.player.duck()
+        with self.player.add_source(1000000, jitter_s=0) as source:
+            source.write(np.full(20, 10000, dtype='<i2').tobytes())
+
+        samples = np.frombuffer(self.output.data, dtype='<i2')
+        self.assertEqual(list(samples), [2000] * 20)
+
+
+class TestPlayerQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.output = TestOutput()
+        # Slow enough that playback can be interrupted.
+        self.player = audio.Player(backend=self.output,
+                                   output_format=audio.AudioFormat(1, 1, 1000))
+        self.addCleanup(self.player.close)
+
+    def play(self, value, seconds, priority):
+        return self.player.play_bytes(bytes([value]) * int(seconds * 1000), 1000,
+                                      sample_width=1, priority=priority, block=False)
+
+    def test_cancel_stops_playback(self):
+        handle = self.play(1, 2, audio.Player.RESPONSE)
+        wait_for(lambda: self.output.data)
+
+        handle.cancel()
+        self.assertTrue(handle.wait(timeout=0.5))
+        self.assertTrue(handle.cancelled())
+        self.assertLess(len(self.output.data), 500)
+
+    def test_plays_in_priority_order(self):
+        self.play(1, 0.2, audio.Player.RESPONSE)
+        wait_for(lambda: self.output.data)
+        last = self.play(2, 0.01, audio.Player.RESPONSE)
+        self.play(3, 0.01, audio.Player.EARCON)
+        last.wait()
+
+        order = [value for i, value in enumerate(self.output.data)
+                 if not i or value != self.output.data[i - 1]]
+        self.assertEqual(order, [1, 3, 2])
+
+    def test_stop_cancels_queued_clips(self):
+        first = self.play(1, 2, audio.Player.RESPONSE)
+        wait_for(lambda: self.output.data)
+        second = self.play(2, 2, audio.Player.SPEECH)
+
+        self.player.stop()
+        self.assertTrue(first.wait(timeout=0.5))
+        self.assertTrue(second.wait(timeout=0.5))
+        self.assertNotIn(2, self.output.data)
+
+        # The player can still be used afterwards.
+        self.play(3, 0.01, audio.Player.EARCON).wait()
+        self.assertEqual(self.output.data[-10:], bytes([3]) * 10)
+
+
+class TestAudioLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+
+    def make_writer(self, **kwargs):
+        writer = audio.AudioLogWriter(self.log_dir, **kwargs)
+        self.addCleanup(writer.close)
+        return writer
+
+    def test_writes_wav(self):
+        writer = self.make_writer()
+        log_file = writer.open_file('request', 1, 2, 16000)
+        log_file.write(bytes(100))
+        log_file.write(bytes(100))
+        log_file.close()
+        writer.close()
+
+        with wave.open(os.path.join(self.log_dir, 'request.wav')) as wav:
+            self.assertEqual(wav.getframerate(), 16000)
+            self.assertEqual(wav.readframes(1000), bytes(200))
+
+    def test_drops_audio_when_behind(self):
+        writer = self.make_writer(max_queued_bytes=250)
+        # Hold the lock so the writer thread can't catch up.
+        with writer._cond:  # pylint: disable=protected-access
+            log_file = writer.open_file('request', 1, 2, 16000)
+            for _ in range(5):
+                log_file.write(bytes(100))
+            log_file.close()
+        writer.close()
+
+        self.assertEqual(log_file.dropped_bytes, 300)
+        self.assertEqual(writer.dropped_bytes, 300)
+        with wave.open(log_file.path) as wav:
+            self.assertEqual(wav.getnframes(), 100)
+
+    def test_deletes_oldest_logs(self):
+        writer = self.make_writer(max_bytes=1000)
+        for i in range(3):
+            writer.write_file('clip%d' % i, bytes(400), 1, 2, 16000)
+            writer.close()
+            # Give each file a distinct modification time.
+            path = os.path.join(self.log_dir, 'clip%d.wav' % i)
+            os.utime(path, (time.time() - 100 + i,) * 2)
+            writer = self.make_writer(max_bytes=1000)
+        writer.write_file('clip3', bytes(400), 1, 2, 16000)
+        writer.close()
+
+        self.assertEqual(sorted(os.listdir(self.log_dir)), ['clip2.wav', 'clip3.wav'])
+
+    def test_deletes_old_logs(self):
+        old_path = os.path.join(self.log_dir, 'old.wav')
+        with open(old_path, 'wb') as f:
+            f.write(bytes(10))
+        os.utime(old_path, (0, 0))
+
+        writer = self.make_writer(max_age_s=3600)
+        writer.write_file('new', bytes(10), 1, 2, 16000)
+        writer.close()
+
+        self.assertEqual(os.listdir(self.log_dir), ['new.wav'])
+
+
+@unittest.skipUnless(shutil.which('flac'), 'needs the flac encoder')
+class TestFlacEncoder(unittest.TestCase):
+
+    def test_encodes_stream(self):
+        raw = sine(440, 16000, 16000).tobytes()
+
+        data = b''
+        with audio.FlacEncoder(1, 2, 16000) as encoder:
+            for i in range(0, len(raw), 3200):
+                data += encoder.encode(raw[i:i + 3200])
+            data += encoder.flush()
+
+        self.assertTrue(data.startswith(b'fLaC'))
+        self.assertLess(len(data), len(raw) / 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
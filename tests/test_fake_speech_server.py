@@ -0,0 +1,236 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the speech requests against the fake server.'''
+
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import actionbase
+import tracing
+
+try:
+    import fake_speech_server
+    from fake_speech_server import make_turn
+    from google.cloud.grpc.speech.v1beta1 import cloud_speech_pb2 as cloud_speech
+    import speech
+except ImportError:
+    fake_speech_server = None
+
+# 0.1 s of 16-bit audio at 16 kHz.
+CHUNK = bytes(3200)
+
+
+class Preparable(object):
+
+    def __init__(self):
+        self.prepared = None
+
+    def prepare(self, voice_command):
+        self.prepared = voice_command
+
+    def run(self, voice_command):
+        pass
+
+
+@unittest.skipUnless(fake_speech_server, 'needs grpc and the Google API packages')
+class TestFakeSpeechServer(unittest.TestCase):
+
+    def serve(self, turns, **kwargs):
+        server = fake_speech_server.FakeSpeechServer(turns, **kwargs)
+        server.start()
+        self.addCleanup(server.stop)
+        return server
+
+    def send_audio(self, request, seconds):
+        request.reset()
+        for _ in range(int(seconds * 10)):
+            request.add_data(CHUNK)
+
+    def test_cloud_speech_transcript(self):
+        server = self.serve([make_turn(transcript='hello', interim=['he'], speech_end_s=0.5)])
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+        ended = []
+        request.set_endpointer_cb(lambda: ended.append(True))
+
+        self.send_audio(request, 2)
+        result = request.do_request()
+
+        self.assertEqual(result.transcript, 'hello')
+        self.assertEqual(ended, [True])
+
+    def test_interim_transcripts(self):
+        server = self.serve([make_turn(transcript='volume up', interim=['volume', 'volume up'])])
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+        interim = []
+        request.set_interim_cb(lambda transcript, stability: interim.append(transcript))
+
+        self.send_audio(request, 2)
+        result = request.do_request()
+
+        self.assertEqual(result.transcript, 'volume up')
+        self.assertEqual(interim, ['volume', 'volume up'])
+
+    def test_prepares_stable_interim_command(self):
+        server = self.serve([make_turn(transcript='volume up', interim=['volume up', 'volume up'],
+                                       stability=0.9)])
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+        actor = actionbase.Actor()
+        action = Preparable()
+        actor.add_keyword('volume up', action)
+        request.set_interim_cb(actor.handle_interim)
+
+        self.send_audio(request, 2)
+        result = request.do_request()
+
+        self.assertEqual(result.transcript, 'volume up')
+        self.assertEqual(action.prepared, 'volume up')
+
+    def test_several_final_results(self):
+        server = self.serve([make_turn(transcript=['turn on', 'the lights'])])
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+        request.single_utterance = False
+
+        self.send_audio(request, 2)
+        result = request.do_request()
+
+        self.assertEqual(result.transcript, 'turn on the lights')
+
+    def test_assistant_response_audio(self):
+        server = self.serve([make_turn(transcript='hi', response_s=0.5, dialog_follow_on=True)])
+        request = speech.AssistantSpeechRequest(None, endpoint=server.target)
+
+        self.send_audio(request, 2)
+        result = request.do_request()
+
+        self.assertEqual(result.transcript, 'hi')
+        self.assertEqual(len(result.response_audio), 16000)
+        self.assertTrue(request.dialog_follow_on)
+
+    def test_async_request(self):
+        server = self.serve([make_turn(transcript='hello', speech_end_s=0.5)])
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+
+        async def run():
+            request.reset()
+            response = asyncio.ensure_future(request.do_request_async())
+            for _ in range(10):
+                request.add_data(CHUNK)
+                await asyncio.sleep(0.01)
+            request.end_audio()
+            result = await response
+            await request.close_async()
+            return result
+
+        # A new loop each time, so the channel is remade for the second.
+        self.assertEqual(asyncio.run(run()).transcript, 'hello')
+        self.assertEqual(asyncio.run(run()).transcript, 'hello')
+        self.assertEqual(request.get_channel_stats().channels_created, 2)
+
+    def test_injected_error(self):
+        server = self.serve([make_turn(error='UNAVAILABLE', error_after_s=0.2)])
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+
+        self.send_audio(request, 1)
+        with self.assertRaises(speech.Error):
+            request.do_request()
+        self.assertEqual(server.get_stats().errors, 1)
+
+    def test_throttling(self):
+        server = self.serve(None, max_concurrent=0)
+        request = speech.CloudSpeechRequest(None, endpoint=server.target)
+
+        self.send_audio(request, 1)
+        with self.assertRaises(speech.Error):
+            request.do_request()
+        self.assertEqual(server.get_stats().throttled, 1)
+
+    def test_batch_transcription(self):
+        server = self.serve([make_turn(transcript='one'), make_turn(transcript='two')])
+        audio_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, audio_dir)
+        for name in ('a.raw', 'b.raw', 'c.raw'):
+            with open(os.path.join(audio_dir, name), 'wb') as f:
+                f.write(CHUNK * 15)
+
+        def make_request():
+            request = speech.CloudSpeechRequest(None, endpoint=server.target)
+            request.single_utterance = False
+            return request
+
+        results = list(speech.transcribe_batch(
+            speech.find_audio_files([audio_dir]), make_request, concurrency=2))
+
+        self.assertEqual(len(results), 3)
+        self.assertEqual(sorted(r['transcript'] for r in results), ['one', 'one', 'two'])
+        self.assertTrue(all(r['audio_s'] == 1.5 for r in results))
+
+
+class Phrases(object):
+
+    def get_phrases(self):
+        return ['lights on']
+
+
+@unittest.skipUnless(fake_speech_server, 'needs grpc and the Google API packages')
+class TestSpeechRequest(unittest.TestCase):
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.request = speech.CloudSpeechRequest(None, endpoint='localhost:1')
+
+    def test_coalesces_queued_audio(self):
+        self.request.set_audio_request_size(max_s=0.5)
+        for _ in range(12):
+            self.request.add_data(CHUNK)
+        self.request.end_audio()
+
+        sizes = []
+        end = False
+        while not end:
+            data, end = asyncio.run(self.request._next_audio())
+            sizes.append(len(data))
+        self.assertEqual(sizes, [16000, 16000, 6400])
+
+    def test_marks_final_transcript_when_it_arrives(self):
+        tracing.reset()
+        tracing.start_trace()
+        self.addCleanup(tracing.end_trace)
+
+        interim = cloud_speech.StreamingRecognizeResponse(results=[
+            cloud_speech.StreamingRecognitionResult(alternatives=[
+                cloud_speech.SpeechRecognitionAlternative(transcript='he')])])
+        self.request._handle_response(interim)
+        self.assertNotIn('final_transcript', tracing.get_stats())
+
+        final = cloud_speech.StreamingRecognizeResponse(results=[
+            cloud_speech.StreamingRecognitionResult(is_final=True, alternatives=[
+                cloud_speech.SpeechRecognitionAlternative(transcript='hello')])])
+        self.request._handle_response(final)
+        self.assertEqual(tracing.get_stats()['final_transcript'].count, 1)
+
+    def test_caches_config_request(self):
+        config = self.request._get_config_request()
+        self.assertIs(self.request._get_config_request(), config)
+
+        self.request.add_phrases(Phrases())
+        self.assertIsNot(self.request._get_config_request(), config)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the recognition loop with fake devices.'''
+
+import collections
+import time
+import unittest
+from unittest import mock
+
+try:
+    import main
+except ImportError:
+    main = None
+
+
+class FakeStatusUi(object):
+
+    def __init__(self, events, sound_s=0):
+        self.events = events
+        self.sound_s = sound_s
+
+    def status(self, status):
+        self.events.append(('status', status))
+        if status == 'listening':
+            # Like playing the trigger sound.
+            time.sleep(self.sound_s)
+
+
+class FakeRecorder(object):
+
+    def __init__(self, events):
+        self.events = events
+
+    def add_processor(self, processor, since=None, fmt=None):
+        self.events.append(('add_processor', time.monotonic() - since))
+
+    def del_processor(self, processor):
+        pass
+
+
+@unittest.skipUnless(main, 'needs the packages imported by main and action')
+class TestSyncMicRecognizer(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        self.status_ui = FakeStatusUi(self.events, sound_s=0.2)
+        self.recognizer = main.SyncMicRecognizer(
+            mock.Mock(), mock.Mock(), FakeRecorder(self.events), mock.Mock(),
+            mock.Mock(), mock.Mock(), self.status_ui, False, preroll_s=0.3)
+
+    def test_records_before_trigger_sound(self):
+        self.recognizer.recognize()
+
+        self.assertEqual([event for event, _ in self.events],
+                         ['add_processor', 'status'])
+        # Only the pre-roll has to come from the recorder's history.
+        self.assertLess(self.events[0][1], 0.4)
+        self.assertTrue(self.recognizer.recognizer_event.is_set())
+
+
+Result = collections.namedtuple('Result', ['transcript', 'response_audio'])
+
+
+@unittest.skipUnless(main, 'needs the packages imported by main and action')
+class TestHandleResult(unittest.TestCase):
+
+    # pylint: disable=protected-access
+
+    def setUp(self):
+        self.actor = mock.Mock()
+        self.player = mock.Mock()
+        self.stream = mock.Mock()
+        self.recognizer = main.SyncMicRecognizer(
+            self.actor, mock.Mock(), mock.Mock(), self.player, mock.Mock(), mock.Mock(),
+            FakeStatusUi([]), False)
+        self.recognizer._response_stream = self.stream
+
+    def test_local_command_cancels_response(self):
+        self.recognizer._handle_result(Result('volume up', b'response'))
+
+        self.actor.handle.assert_called_once_with('volume up', False)
+        self.stream.cancel.assert_called_once_with()
+        self.stream.close.assert_not_called()
+        self.player.play_bytes.assert_not_called()
+
+    def test_response_plays_without_local_command(self):
+        self.actor.can_handle.return_value = False
+        self.actor.handle.return_value = False
+        self.recognizer._handle_result(Result('what time is it', b'response'))
+
+        self.stream.cancel.assert_not_called()
+        self.stream.close.assert_called_once_with()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Test the latency tracing.'''
+
+import unittest
+
+import tracing
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = tracing.Histogram()
+        for i in range(1, 101):
+            histogram.add(i / 1000)
+
+        self.assertEqual(histogram.count, 100)
+        self.assertAlmostEqual(histogram.total, 5.05)
+        self.assertEqual(histogram.max, 0.1)
+        # Buckets are 19% wide.
+        self.assertAlmostEqual(histogram.percentile(50), 0.05, delta=0.05 * 0.2)
+        self.assertAlmostEqual(histogram.percentile(90), 0.09, delta=0.09 * 0.2)
+        self.assertEqual(histogram.percentile(100), 0.1)
+
+    def test_out_of_range(self):
+        histogram = tracing.Histogram()
+        histogram.add(0)
+        histogram.add(1000)
+        self.assertEqual(histogram.percentile(50), tracing.Histogram.MIN_S)
+        self.assertEqual(histogram.percentile(100), 1000)
+
+    def test_empty(self):
+        self.assertEqual(tracing.Histogram().percentile(50), 0)
+
+
+class TestTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = tracing.Tracer()
+
+    def test_marks_once_per_trace(self):
+        self.tracer.start_trace(t=10)
+        self.tracer.mark('first_response', t=10.5)
+        self.tracer.mark('first_response', t=11)
+        self.tracer.start_trace(t=20)
+        self.tracer.mark('first_response', t=20.3)
+
+        stats = self.tracer.get_stats()['first_response']
+        self.assertEqual(stats.kind, tracing.SINCE_TRIGGER)
+        self.assertEqual(stats.count, 2)
+        self.assertAlmostEqual(stats.mean_s, 0.4)
+        self.assertAlmostEqual(stats.max_s, 0.5)
+
+    def test_no_marks_without_trace(self):
+        self.tracer.mark('first_response')
+        self.tracer.start_trace()
+        self.tracer.end_trace()
+        self.tracer.mark('first_response')
+        self.assertEqual(self.tracer.get_stats(), {})
+
+    def test_span(self):
+        with self.tracer.span('actor_handle'):
+            pass
+        stats = self.tracer.get_stats()['actor_handle']
+        self.assertEqual(stats.kind, tracing.DURATION)
+        self.assertEqual(stats.count, 1)
+
+    def test_many_values(self):
+        for _ in range(3 * tracing.Tracer.MAX_PENDING):
+            with self.tracer.span('tts_synthesis'):
+                pass
+        self.assertEqual(self.tracer.get_stats()['tts_synthesis'].count,
+                         3 * tracing.Tracer.MAX_PENDING)
+
+    def test_format_stats(self):
+        self.tracer.start_trace(t=0)
+        self.tracer.mark('endpointer', t=1.5)
+        table = tracing.format_stats(self.tracer.get_stats())
+        self.assertIn('endpointer', table)
+        self.assertIn('1500.0', table)
+
+        self.tracer.reset()
+        self.assertEqual(self.tracer.get_stats(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()